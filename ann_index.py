@@ -0,0 +1,357 @@
+import os
+import json
+import numpy as np
+import utils
+from encoding_array import EncodingArray
+from result_sink import read_results
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+def normalize(encodings):
+    """
+    Scale encodings to unit length, so the dot product equals the cosine similarity.
+    :param encodings: Array of shape (n, dim)
+    :return: float32 array of unit vectors
+    """
+    encodings = np.asarray(encodings, dtype=np.float32)
+    norms = np.linalg.norm(encodings, axis=-1, keepdims=True)
+    return encodings / np.maximum(norms, 1e-12)
+
+
+def kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """
+    Spherical k-means used as the coarse quantizer of the IVF index.
+    :param vectors: Unit vectors of shape (n, dim)
+    :param n_clusters: Number of centroids
+    :return: Unit centroid vectors of shape (n_clusters, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = vectors[assignment == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = normalize(centroids)
+    return centroids
+
+
+class ClusterIndex:
+    """
+    Approximate nearest-neighbour index over the encodings of every cluster.
+
+    Vectors are L2-normalized so scores are cosine similarities, matching the threshold used by
+    find_cluster_for_new_face. The default backend is an inverted-file (IVF) index in NumPy:
+    a k-means coarse quantizer and one vector list per centroid, of which only the n_probe
+    closest lists are scanned per query. backend="hnsw" uses hnswlib when it is installed.
+    """
+
+    def __init__(self, dim=128, backend="ivf", n_probe=8):
+        """
+        :param dim: Length of a face encoding
+        :param backend: "ivf" (NumPy) or "hnsw" (requires hnswlib)
+        :param n_probe: Number of inverted lists scanned per query by the IVF backend
+        """
+        if backend == "hnsw" and hnswlib is None:
+            raise ImportError("backend='hnsw' requires the hnswlib package")
+        if backend not in ("ivf", "hnsw"):
+            raise ValueError(f"Unknown index backend: {backend}")
+        self.dim = dim
+        self.backend = backend
+        self.n_probe = n_probe
+        self.label_names = []  # label id -> cluster name
+        self.versions = {}  # cluster name -> version of the cluster's members when they were indexed
+        self._label_index = {}
+        # IVF state: coarse centroids, and per list the unit vectors and their label ids
+        self._centroids = np.zeros((0, dim), dtype=np.float32)
+        self._list_vectors = []
+        self._list_labels = []
+        # HNSW state
+        self._hnsw = None
+        self._hnsw_labels = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        if self.backend == "hnsw":
+            return len(self._hnsw_labels)
+        return sum(len(labels) for labels in self._list_labels)
+
+    def __contains__(self, label):
+        return label in self._label_index
+
+    def build(self, encodings, labels, n_lists=None):
+        """
+        Build the index from scratch.
+        :param encodings: Array of shape (n, dim)
+        :param labels: Cluster name of every encoding
+        :param n_lists: Number of IVF lists, sqrt(n) by default
+        :return: self
+        """
+        vectors = normalize(encodings).reshape(-1, self.dim)
+        if self.backend == "ivf":
+            n_lists = n_lists or int(np.clip(np.sqrt(len(vectors)), 1, 1024))
+            n_lists = max(min(n_lists, len(vectors)), 1)
+            # Train the quantizer on a sample; more points barely move the centroids
+            rng = np.random.default_rng(0)
+            sample = vectors if len(vectors) <= 50000 else vectors[rng.choice(len(vectors), 50000, replace=False)]
+            self._centroids = kmeans(sample, n_lists) if len(sample) else np.zeros((1, self.dim), np.float32)
+            self._list_vectors = [np.zeros((0, self.dim), dtype=np.float32) for _ in range(len(self._centroids))]
+            self._list_labels = [np.zeros(0, dtype=np.int32) for _ in range(len(self._centroids))]
+        self.add(vectors, labels)
+        return self
+
+    def add(self, encodings, labels):
+        """
+        Insert encodings, e.g. the members of a cluster created after the index was built.
+        :param encodings: Array of shape (n, dim)
+        :param labels: Cluster name of every encoding, or a single name for all of them
+        """
+        vectors = normalize(encodings).reshape(-1, self.dim)
+        if isinstance(labels, str):
+            labels = [labels] * len(vectors)
+        label_ids = np.array([self._label_id(label) for label in labels], dtype=np.int32)
+        if len(vectors) == 0:
+            return
+
+        if self.backend == "hnsw":
+            if self._hnsw is None:
+                self._hnsw = hnswlib.Index(space='ip', dim=self.dim)
+                self._hnsw.init_index(max_elements=max(len(vectors), 1024), ef_construction=200, M=16)
+            needed = len(self._hnsw_labels) + len(vectors)
+            if needed > self._hnsw.get_max_elements():
+                self._hnsw.resize_index(max(needed, 2 * self._hnsw.get_max_elements()))
+            self._hnsw.add_items(vectors, np.arange(len(self._hnsw_labels), needed))
+            self._hnsw_labels = np.concatenate([self._hnsw_labels, label_ids])
+            return
+
+        if len(self._centroids) == 0:
+            # Adding to an empty index: a single list until build() is called with enough data
+            self._centroids = vectors[:1].copy()
+            self._list_vectors = [np.zeros((0, self.dim), dtype=np.float32)]
+            self._list_labels = [np.zeros(0, dtype=np.int32)]
+        assignment = np.argmax(vectors @ self._centroids.T, axis=1)
+        for c in np.unique(assignment):
+            mask = assignment == c
+            self._list_vectors[c] = np.concatenate([self._list_vectors[c], vectors[mask]])
+            self._list_labels[c] = np.concatenate([self._list_labels[c], label_ids[mask]])
+
+    def remove(self, label):
+        """
+        Remove every encoding of a cluster, e.g. before adding its current members again.
+        :param label: Cluster name
+        """
+        self.versions.pop(label, None)
+        if label not in self._label_index:
+            return
+        label_id = self._label_index[label]
+        if self.backend == "hnsw":
+            for item in np.flatnonzero(self._hnsw_labels == label_id):
+                self._hnsw.mark_deleted(int(item))
+            self._hnsw_labels[self._hnsw_labels == label_id] = -1
+            return
+        for c in range(len(self._list_labels)):
+            keep = self._list_labels[c] != label_id
+            if not keep.all():
+                self._list_vectors[c] = self._list_vectors[c][keep]
+                self._list_labels[c] = self._list_labels[c][keep]
+
+    def search(self, encoding, k=5):
+        """
+        Find the clusters holding the most similar encodings.
+        :param encoding: Face encoding
+        :param k: Number of clusters to return
+        :return: List of (cluster name, cosine similarity) pairs, best first
+        """
+        return self.search_batch(np.asarray(encoding).reshape(1, self.dim), k)[0]
+
+    def search_batch(self, encodings, k=5):
+        """
+        Search many encodings at once with one vectorized pass per scanned list.
+        :param encodings: Array of shape (n, dim)
+        :param k: Number of clusters to return per encoding
+        :return: One list of (cluster name, cosine similarity) pairs per encoding, best first
+        """
+        queries = normalize(encodings).reshape(-1, self.dim)
+        if len(self) == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+
+        # Score each cluster by its most similar member, as the exhaustive scan does
+        best = np.full((len(queries), len(self.label_names)), -np.inf, dtype=np.float32)
+        if self.backend == "hnsw":
+            self._hnsw.set_ef(max(50, 4 * k))
+            ids, distances = self._hnsw.knn_query(queries, k=min(max(4 * k, 32), len(self._hnsw_labels)))
+            rows = np.repeat(np.arange(len(queries)), ids.shape[1])
+            np.maximum.at(best, (rows, self._hnsw_labels[ids.ravel()]), 1.0 - distances.ravel())
+        else:
+            probe = np.argsort(-(queries @ self._centroids.T), axis=1)[:, :self.n_probe]
+            for c in np.unique(probe):
+                if len(self._list_labels[c]) == 0:
+                    continue
+                rows = np.flatnonzero((probe == c).any(axis=1))
+                similarities = queries[rows] @ self._list_vectors[c].T
+                np.maximum.at(best, (rows[:, None], self._list_labels[c][None, :]), similarities)
+
+        results = []
+        for scores in best:
+            top = np.argsort(-scores)[:k]
+            results.append([(self.label_names[i], float(scores[i])) for i in top if np.isfinite(scores[i])])
+        return results
+
+    def save(self, path):
+        """
+        Write the index to disk.
+        :param path: Index directory
+        """
+        utils.create_dir(path)
+        with open(os.path.join(path, 'index.json'), 'w', encoding='utf-8') as f:
+            json.dump({"dim": self.dim, "backend": self.backend, "n_probe": self.n_probe,
+                       "labels": self.label_names, "versions": self.versions}, f)
+        if self.backend == "hnsw":
+            self._hnsw.save_index(os.path.join(path, 'index.hnsw'))
+            np.save(os.path.join(path, 'hnsw_labels.npy'), self._hnsw_labels)
+            return
+        sizes = np.array([len(labels) for labels in self._list_labels], dtype=np.int64)
+        np.savez(os.path.join(path, 'ivf.npz'), centroids=self._centroids, sizes=sizes,
+                 vectors=np.concatenate(self._list_vectors) if self._list_vectors else self._centroids[:0],
+                 labels=np.concatenate(self._list_labels) if self._list_labels else np.zeros(0, np.int32))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read an index written by save().
+        :param path: Index directory
+        :return: ClusterIndex
+        """
+        with open(os.path.join(path, 'index.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        index = cls(dim=meta["dim"], backend=meta["backend"], n_probe=meta["n_probe"])
+        for label in meta["labels"]:
+            index._label_id(label)
+        # Indexes saved without versions get every cluster refreshed by the next update
+        index.versions = meta.get("versions", {})
+        if index.backend == "hnsw":
+            index._hnsw_labels = np.load(os.path.join(path, 'hnsw_labels.npy'))
+            index._hnsw = hnswlib.Index(space='ip', dim=index.dim)
+            index._hnsw.load_index(os.path.join(path, 'index.hnsw'),
+                                   max_elements=max(len(index._hnsw_labels), 1024))
+            return index
+        with np.load(os.path.join(path, 'ivf.npz')) as ivf:
+            index._centroids = ivf["centroids"]
+            bounds = np.concatenate([[0], np.cumsum(ivf["sizes"])])
+            vectors, labels = ivf["vectors"], ivf["labels"]
+            index._list_vectors = [vectors[bounds[c]:bounds[c + 1]] for c in range(len(bounds) - 1)]
+            index._list_labels = [labels[bounds[c]:bounds[c + 1]] for c in range(len(bounds) - 1)]
+        return index
+
+    def _label_id(self, label):
+        if label not in self._label_index:
+            self._label_index[label] = len(self.label_names)
+            self.label_names.append(label)
+        return self._label_index[label]
+
+
+def _cluster_file_versions(cluster_path):
+    # Cluster name -> [size, mtime_ns] of its pickle, which changes whenever the cluster is rewritten
+    versions = {}
+    for pkl_file in sorted(os.listdir(cluster_path)):
+        if pkl_file.endswith('.pkl'):
+            stat = os.stat(os.path.join(cluster_path, pkl_file))
+            versions[pkl_file[:-len('.pkl')]] = [stat.st_size, stat.st_mtime_ns]
+    return versions
+
+
+def build_cluster_index(cluster_path, backend="ivf"):
+    """
+    Build an index over every `<name>.pkl` cluster file in a directory.
+    :param cluster_path: Directory holding the cluster pickle files
+    :param backend: "ivf" or "hnsw"
+    :return: ClusterIndex
+    """
+    versions = _cluster_file_versions(cluster_path)
+    encodings, labels = EncodingArray(), []
+    for label in versions:
+        cluster_encodings = utils.load_cluster_in_pickle(os.path.join(cluster_path, f"{label}.pkl"))
+        encodings.extend(cluster_encodings)
+        labels.extend([label] * len(cluster_encodings))
+    index = ClusterIndex(backend=backend).build(encodings.to_float32(), labels)
+    index.versions = versions
+    return index
+
+
+def _refresh(index, versions, load_members):
+    # Re-index the clusters whose version changed, add the new ones and drop the vanished ones
+    changed = [label for label, version in versions.items() if index.versions.get(label) != version]
+    removed = sorted(set(index.versions) - set(versions))
+    for label in removed:
+        index.remove(label)
+    for label in changed:
+        index.remove(label)
+        encodings = load_members(label)
+        if len(encodings):
+            index.add(encodings, label)
+        index.versions[label] = versions[label]
+    return changed + removed
+
+
+def update_cluster_index(index, cluster_path):
+    """
+    Bring an index up to date with the cluster directory: clusters whose pickle changed since
+    they were indexed (new members, merges) are indexed again, new clusters are added and
+    clusters whose pickle is gone are removed.
+    :param index: ClusterIndex
+    :param cluster_path: Directory holding the cluster pickle files
+    :return: Names of the clusters that were added, indexed again or removed
+    """
+    def load_members(label):
+        encodings = EncodingArray()
+        encodings.extend(utils.load_cluster_in_pickle(os.path.join(cluster_path, f"{label}.pkl")))
+        return encodings.to_float32()
+
+    return _refresh(index, _cluster_file_versions(cluster_path), load_members)
+
+
+def build_catalog_index(catalog, backend="ivf"):
+    """
+    Build an index over the faces of every cluster of a FaceCatalog, read in one indexed query.
+    :param catalog: FaceCatalog
+    :param backend: "ivf" or "hnsw"
+    :return: ClusterIndex
+    """
+    encodings, labels = catalog.cluster_encodings()
+    index = ClusterIndex(backend=backend).build(encodings, labels)
+    index.versions = catalog.cluster_versions()
+    return index
+
+
+def update_catalog_index(index, catalog):
+    """
+    Bring an index up to date with a FaceCatalog, like update_cluster_index: clusters whose
+    members changed are indexed again, new ones added and vanished ones removed.
+    :param index: ClusterIndex
+    :param catalog: FaceCatalog
+    :return: Names of the clusters that were added, indexed again or removed
+    """
+    return _refresh(index, catalog.cluster_versions(), lambda label: catalog.cluster_encodings([label])[0])
+
+
+def build_results_index(results_path, backend="ivf", versions=None):
+    """
+    Build an index from a columnar results table in one read, without the cluster pickles.
+    :param results_path: .parquet or .arrow file written by result_sink.ArrowResultSink
+    :param backend: "ivf" or "hnsw"
+    :param versions: Versions of the clusters in the source that later updates read, e.g.
+                     FaceCatalog.cluster_versions(), so they only refresh the clusters that changed;
+                     None makes the first update index every cluster again
+    :return: ClusterIndex with clusters named like their pickle files (face_<label>)
+    """
+    results = read_results(results_path)
+    clustered = results["cluster"] >= 0
+    labels = [f"face_{label}" for label in results["cluster"][clustered]]
+    index = ClusterIndex(dim=results["encoding"].shape[1], backend=backend).build(results["encoding"][clustered],
+                                                                                  labels)
+    index.versions = dict(versions or {})
+    return index
@@ -0,0 +1,186 @@
+"""
+Offline benchmark of the clustering pipeline on synthetic encodings (see benchmarks/synthetic.py).
+
+For every dataset size it times
+- assign:  main.py-style sequential assignment of each face to the closest cluster (ClusterStore.match,
+           on the cluster summaries or with --assign-exact on every member),
+- cluster: batch clustering with each of --methods (clustering.cluster_faces),
+- lookup:  the index query behind find_cluster_for_new_face (ClusterIndex build, batched and single search),
+and records pairwise precision/recall (or top-1 accuracy for lookup) next to the time and the
+peak RSS of the task, so a speedup cannot silently cost accuracy. Each task runs in its own
+process so its peak memory is measured on its own. Results are appended as JSON lines to --output.
+
+Usage: python benchmarks/clustering_suite.py [--sizes 10000 100000 1000000] [--tasks assign cluster lookup]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from synthetic import load_dataset, pairwise_precision_recall
+from metrics import peak_rss_bytes
+
+TASKS = ("assign", "cluster", "lookup")
+
+
+def bench_assign(encodings, identities, args):
+    from cluster_store import ClusterStore
+    encodings, identities = np.asarray(encodings[:args.assign_limit]), identities[:args.assign_limit]
+    labels = np.empty(len(encodings), dtype=np.int64)
+    with tempfile.TemporaryDirectory() as cluster_path:
+        store = ClusterStore(cluster_path, flush_interval=sys.maxsize)  # nothing is written during the run
+        tic = time.perf_counter()
+        for i, encoding in enumerate(encodings):
+            name = store.match(encoding, args.threshold, exact=args.assign_exact)
+            if name is None:
+                name = str(len(store))
+                store.new_cluster(name, encoding)
+            else:
+                store.append(name, encoding)
+            labels[i] = int(name)
+        seconds = time.perf_counter() - tic
+    precision, recall, f1 = pairwise_precision_recall(labels, identities)
+    return {"faces": len(encodings), "exact": args.assign_exact, "seconds": seconds, "faces_per_second": len(encodings) / seconds,
+            "clusters": len(store), "precision": precision, "recall": recall, "f1": f1}
+
+
+def bench_cluster(encodings, identities, args, method):
+    from clustering import cluster_faces
+    encodings = np.ascontiguousarray(encodings)
+    with tempfile.TemporaryDirectory() as graph_dir:
+        tic = time.perf_counter()
+        labels = cluster_faces(encodings, method, eps=args.eps, min_samples=args.min_samples,
+                               graph_path=os.path.join(graph_dir, 'neighbour_graph.npz'))
+        seconds = time.perf_counter() - tic
+    precision, recall, f1 = pairwise_precision_recall(labels, identities)
+    return {"method": method, "faces": len(encodings), "seconds": seconds,
+            "faces_per_second": len(encodings) / seconds, "clusters": int(labels.max(initial=-1) + 1),
+            "noise": int(np.sum(labels < 0)), "precision": precision, "recall": recall, "f1": f1}
+
+
+def bench_lookup(encodings, identities, args):
+    from ann_index import ClusterIndex, normalize
+    # Hold out query faces of identities that also appear in the gallery
+    rng = np.random.default_rng(args.seed)
+    _, first, inverse, counts = np.unique(identities, return_index=True, return_inverse=True, return_counts=True)
+    candidates = np.flatnonzero(counts[inverse] > 1)
+    candidates = np.setdiff1d(candidates, first)  # the first face of every identity stays in the gallery
+    queries = rng.choice(candidates, min(args.queries, len(candidates)), replace=False)
+    gallery = np.setdiff1d(np.arange(len(identities)), queries)
+    gallery_encodings, gallery_labels = np.asarray(encodings[gallery]), identities[gallery]
+    query_encodings = np.asarray(encodings[queries])
+
+    tic = time.perf_counter()
+    index = ClusterIndex().build(gallery_encodings, [str(label) for label in gallery_labels])
+    build_seconds = time.perf_counter() - tic
+    tic = time.perf_counter()
+    results = index.search_batch(query_encodings, k=1)
+    batch_seconds = time.perf_counter() - tic
+    tic = time.perf_counter()
+    for encoding in query_encodings[:100]:
+        index.search(encoding, k=1)
+    single_ms = 1000 * (time.perf_counter() - tic) / min(len(query_encodings), 100)
+
+    predicted = np.array([int(matches[0][0]) if matches else -1 for matches in results])
+    # Exhaustive cosine search as the reference the index approximates
+    unit_gallery, unit_queries = normalize(gallery_encodings), normalize(query_encodings)
+    exact = np.empty(len(queries), dtype=np.int64)
+    for start in range(0, len(queries), 64):
+        similarities = unit_queries[start:start + 64] @ unit_gallery.T
+        exact[start:start + 64] = gallery_labels[np.argmax(similarities, axis=1)]
+    return {"gallery": len(gallery), "queries": len(queries), "build_seconds": build_seconds,
+            "batch_queries_per_second": len(queries) / batch_seconds, "single_query_ms": single_ms,
+            "accuracy": float(np.mean(predicted == identities[queries])),
+            "exact_accuracy": float(np.mean(exact == identities[queries])),
+            "recall_vs_exact": float(np.mean(predicted == exact))}
+
+
+def run_task(task, size, method, args):
+    encodings, identities = load_dataset(size, seed=args.seed, cache_dir=args.cache_dir, intra=args.intra,
+                                         inter=args.inter)
+    if task == "assign":
+        result = bench_assign(encodings, identities, args)
+    elif task == "cluster":
+        result = bench_cluster(encodings, identities, args, method)
+    else:
+        result = bench_lookup(encodings, identities, args)
+    result.update(task=task, size=size, peak_rss_bytes=peak_rss_bytes())
+    return result
+
+
+def _run_in_child(queue, task, size, method, args):
+    try:
+        queue.put(run_task(task, size, method, args))
+    except Exception as e:
+        queue.put({"task": task, "size": size, "method": method, "error": repr(e)})
+
+
+def run_isolated(task, size, method, args):
+    # A fresh process per task, so peak RSS is that of the task alone
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(queue, task, size, method, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def describe(result):
+    if "error" in result:
+        return f"{result['task']:<8} {result['size']:>8}  ERROR {result['error']}"
+    rss = f"{result['peak_rss_bytes'] / 2 ** 20:.0f} MiB" if result.get("peak_rss_bytes") else "n/a"
+    if result["task"] == "lookup":
+        return (f"{'lookup':<8} {result['size']:>8}  build {result['build_seconds']:.2f}s  "
+                f"{result['batch_queries_per_second']:.0f} q/s batched  {result['single_query_ms']:.2f} ms single  "
+                f"acc {result['accuracy']:.3f} (exact {result['exact_accuracy']:.3f})  rss {rss}")
+    name = result["task"] if result["task"] == "assign" else result["method"]
+    return (f"{name:<8} {result['size']:>8}  {result['seconds']:.2f}s  {result['faces_per_second']:.0f} faces/s  "
+            f"P {result['precision']:.3f} R {result['recall']:.3f} F1 {result['f1']:.3f}  rss {rss}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=list(TASKS))
+    parser.add_argument('--methods', nargs='+', default=["dbscan", "graph_dbscan"],
+                        help="Clustering methods timed by the cluster task")
+    parser.add_argument('--assign-limit', type=int, default=20000,
+                        help="Faces assigned by the assign task, which is quadratic in the number of faces")
+    parser.add_argument('--assign-exact', action='store_true',
+                        help="Match on the exact average distance over all members instead of the cluster summaries")
+    parser.add_argument('--queries', type=int, default=1000, help="Held-out faces queried by the lookup task")
+    parser.add_argument('--threshold', type=float, default=0.5, help="Match threshold of the assign task")
+    parser.add_argument('--eps', type=float, default=0.5)
+    parser.add_argument('--min-samples', type=int, default=3)
+    parser.add_argument('--intra', type=float, default=0.4, help="Typical distance between faces of one identity")
+    parser.add_argument('--inter', type=float, default=0.9, help="Typical distance between different identities")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'),
+                        help="Where generated datasets are kept between runs")
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl'))
+    parser.add_argument('--in-process', action='store_true', help="Run every task in this process (no RSS isolation)")
+    args = parser.parse_args()
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    for size in args.sizes:
+        for task in args.tasks:
+            for method in (args.methods if task == "cluster" else [None]):
+                run = run_task if args.in_process else run_isolated
+                result = run(task, size, method, args)
+                print(describe(result), flush=True)
+                result.update(started=started, eps=args.eps, min_samples=args.min_samples, intra=args.intra,
+                              inter=args.inter, seed=args.seed)
+                with open(args.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(result) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Speed/recall tradeoff of downscale-then-detect.
+
+Runs HOG detection at full resolution as the reference, then at each max long edge, and
+reports the time per image and the fraction of reference faces found again (IoU >= 0.5).
+
+Usage: python benchmarks/detection_scale.py <image_dir> [--edges 2400 1600 1200 800] [--limit 50]
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import face_recognition
+from face_loading import loading_face
+from face_detection import detect_face_locations
+
+allowed_extensions = {'.png', '.jpeg', '.jpg', '.gif', '.bmp', '.tiff'}
+
+
+def iou(a, b):
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, bottom - top) * max(0, right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def count_matches(reference, found, min_iou=0.5):
+    matched = 0
+    remaining = list(found)
+    for box in reference:
+        scores = [iou(box, other) for other in remaining]
+        if scores and max(scores) >= min_iou:
+            remaining.pop(scores.index(max(scores)))
+            matched += 1
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir')
+    parser.add_argument('--edges', type=int, nargs='+', default=[2400, 1600, 1200, 800])
+    parser.add_argument('--limit', type=int, default=50, help="Maximum number of images to load")
+    parser.add_argument('--model', default="hog")
+    args = parser.parse_args()
+
+    paths = []
+    for root, dirs, files in os.walk(args.image_dir):
+        for file in sorted(files):
+            if os.path.splitext(file.lower())[1] in allowed_extensions:
+                paths.append(os.path.join(root, file))
+    images = [image for image in (loading_face(path, face_recognition) for path in paths[:args.limit])
+              if image is not None]
+    if not images:
+        sys.exit(f"No images found in {args.image_dir}")
+
+    def run(max_long_edge):
+        tic = time.perf_counter()
+        locations = [detect_face_locations(image, face_recognition, model=args.model, max_long_edge=max_long_edge)
+                     for image in images]
+        return locations, (time.perf_counter() - tic) / len(images)
+
+    reference, reference_time = run(None)
+    total_faces = sum(len(locations) for locations in reference)
+    print(f"{len(images)} images, {total_faces} faces at full resolution")
+    print(f"{'max long edge':>14} {'ms/image':>10} {'speedup':>8} {'recall':>8} {'faces':>7}")
+    print(f"{'full':>14} {reference_time * 1000:>10.1f} {1.0:>8.2f} {1.0:>8.3f} {total_faces:>7}")
+    for edge in args.edges:
+        found, elapsed = run(edge)
+        matched = sum(count_matches(ref, locs) for ref, locs in zip(reference, found))
+        recall = matched / total_faces if total_faces else 1.0
+        print(f"{edge:>14} {elapsed * 1000:>10.1f} {reference_time / elapsed:>8.2f} {recall:>8.3f} "
+              f"{sum(len(locs) for locs in found):>7}")
+
+
+if __name__ == "__main__":
+    main()
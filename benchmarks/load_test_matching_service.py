@@ -0,0 +1,90 @@
+"""
+Load test for matching_service.py.
+
+Sends batches of random 128-d encodings from concurrent clients for a fixed duration and
+reports p50/p99 request latency and throughput in requests and encodings per second.
+
+Usage: python benchmarks/load_test_matching_service.py [--host 127.0.0.1] [--port 8765]
+       [--socket PATH] [--clients 16] [--batch 1] [--duration 10]
+"""
+import json
+import time
+import socket
+import argparse
+import threading
+import http.client
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help="Connect to this Unix socket instead of TCP")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--batch', type=int, default=1, help="Encodings per request")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds to run")
+    args = parser.parse_args()
+
+    def connect():
+        if args.socket:
+            return UnixHTTPConnection(args.socket)
+        return http.client.HTTPConnection(args.host, args.port)
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client(seed):
+        rng = np.random.default_rng(seed)
+        while time.perf_counter() < deadline:
+            body = json.dumps({"encodings": (rng.normal(size=(args.batch, 128)) * 0.1).tolist()})
+            tic = time.perf_counter()
+            connection = connect()
+            try:
+                connection.request('POST', '/match', body, {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+                if not ok:
+                    with lock:
+                        errors.append(f"HTTP {response.status}")
+            except OSError as e:
+                ok = False
+                with lock:
+                    errors.append(str(e))
+            finally:
+                connection.close()
+            if ok:
+                with lock:
+                    latencies.append(time.perf_counter() - tic)
+
+    threads = [threading.Thread(target=client, args=(seed,)) for seed in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if not latencies:
+        raise SystemExit(f"No successful requests ({len(errors)} errors): {errors[:1]}")
+    latencies_ms = np.array(latencies) * 1000
+    print(f"clients={args.clients} batch={args.batch} duration={elapsed:.1f}s")
+    print(f"requests: {len(latencies)} ok, {len(errors)} failed")
+    print(f"latency p50={np.percentile(latencies_ms, 50):.2f} ms p99={np.percentile(latencies_ms, 99):.2f} ms")
+    print(f"throughput: {len(latencies) / elapsed:.1f} req/s, {len(latencies) * args.batch / elapsed:.1f} encodings/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Synthetic face-encoding datasets with a known identity structure, and clustering accuracy metrics.
+
+Each identity is a Gaussian blob in 128-d space. The spreads are set from the typical euclidean
+distance between two faces of the same person (intra) and of different people (inter); the
+defaults follow dlib's encoder, whose 0.6 same-person threshold sits between the two. Identity
+sizes follow a power law, as in a photo collection where a few people appear in most photos,
+and a fraction of faces are strangers seen once. To keep the task from being trivially separable,
+face quality varies (each face's spread is scaled by a log-normal factor) and some identities are
+lookalikes placed close to another identity, as relatives are.
+"""
+import os
+import numpy as np
+
+
+def make_dataset(n_faces, n_identities=None, dim=128, intra=0.4, inter=0.9, stranger_fraction=0.05,
+                 zipf_exponent=0.8, quality_spread=0.3, lookalike_fraction=0.1, lookalike_distance=0.6, seed=0):
+    """
+    Generate a labelled set of encodings.
+    :param n_faces: Number of faces
+    :param n_identities: Number of recurring identities, n_faces / 20 by default
+    :param intra: Typical distance between two faces of the same identity
+    :param inter: Typical distance between two faces of different identities
+    :param stranger_fraction: Share of faces that belong to an identity of their own
+    :param zipf_exponent: Skew of the identity sizes, 0 for equal sizes
+    :param quality_spread: Sigma of the log-normal factor scaling each face's distance from its identity
+    :param lookalike_fraction: Share of identities placed near another identity
+    :param lookalike_distance: Typical distance between a lookalike's centre and the identity it resembles
+    :return: Tuple (encodings float32 (n_faces, dim), identities int64 (n_faces,)); faces are shuffled
+    """
+    rng = np.random.default_rng(seed)
+    n_identities = n_identities or max(n_faces // 20, 1)
+    n_strangers = int(n_faces * stranger_fraction)
+    n_recurring = n_faces - n_strangers
+
+    # Pairwise distance of two samples of N(0, s^2 I) is about s * sqrt(2 * dim)
+    face_spread = intra / np.sqrt(2 * dim)
+    centre_spread = np.sqrt(max(inter ** 2 - intra ** 2, 0.0)) / np.sqrt(2 * dim)
+
+    weights = 1.0 / np.arange(1, n_identities + 1) ** zipf_exponent
+    identities = np.concatenate([rng.choice(n_identities, n_recurring, p=weights / weights.sum()),
+                                 n_identities + np.arange(n_strangers)])
+    rng.shuffle(identities)
+
+    encodings = np.empty((n_faces, dim), dtype=np.float32)
+    centres = rng.normal(0.0, centre_spread, (n_identities + n_strangers, dim)).astype(np.float32)
+    n_lookalikes = int(lookalike_fraction * (n_identities - 1))
+    lookalikes = rng.choice(np.arange(1, n_identities), n_lookalikes, replace=False)
+    for identity in lookalikes:
+        resembled = rng.integers(identity)
+        centres[identity] = centres[resembled] + rng.normal(0.0, lookalike_distance / np.sqrt(2 * dim), dim)
+    for start in range(0, n_faces, 65536):  # in blocks, so 1M faces never need a float64 copy
+        block = identities[start:start + 65536]
+        quality = rng.lognormal(0.0, quality_spread, (len(block), 1))
+        noise = quality * rng.normal(0.0, face_spread, (len(block), dim))
+        encodings[start:start + len(block)] = centres[block] + noise
+    return encodings, identities.astype(np.int64)
+
+
+def load_dataset(n_faces, seed=0, cache_dir=None, **kwargs):
+    """
+    Generate a dataset once and reuse it from cache_dir on later runs (memory-mapped).
+    :return: Tuple (encodings, identities) as returned by make_dataset
+    """
+    if cache_dir is None:
+        return make_dataset(n_faces, seed=seed, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    suffix = "".join(f"_{key}{value}" for key, value in sorted(kwargs.items()))
+    stem = os.path.join(cache_dir, f"synthetic_{n_faces}_seed{seed}{suffix}")
+    if not os.path.exists(stem + "_identities.npy"):
+        encodings, identities = make_dataset(n_faces, seed=seed, **kwargs)
+        np.save(stem + "_encodings.npy", encodings)
+        np.save(stem + "_identities.npy", identities)
+    return np.load(stem + "_encodings.npy", mmap_mode='r'), np.load(stem + "_identities.npy")
+
+
+def pairwise_precision_recall(labels, identities):
+    """
+    Pairwise clustering accuracy: of all face pairs put in the same cluster, the share that are
+    the same identity (precision), and of all same-identity pairs, the share put together (recall).
+    Noise (label -1) counts as a cluster of its own per face.
+    :param labels: Predicted cluster per face
+    :param identities: True identity per face
+    :return: Tuple (precision, recall, f1)
+    """
+    labels = np.asarray(labels, dtype=np.int64).copy()
+    noise = labels < 0
+    labels[noise] = labels.max(initial=0) + 1 + np.arange(noise.sum())
+
+    def pairs(counts):
+        return float(np.sum(counts.astype(np.float64) * (counts - 1) / 2))
+
+    _, joint = np.unique(np.stack([labels, np.asarray(identities, dtype=np.int64)]), axis=1, return_counts=True)
+    together = pairs(joint)
+    predicted = pairs(np.unique(labels, return_counts=True)[1])
+    actual = pairs(np.unique(identities, return_counts=True)[1])
+    precision = together / predicted if predicted else 1.0
+    recall = together / actual if actual else 1.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return precision, recall, f1
@@ -0,0 +1,347 @@
+import os
+import numpy as np
+import utils
+from encoding_array import EncodingArray, distance_error
+
+# Number of encodings the storage type's accuracy is checked on, and most taken from one cluster
+ACCURACY_SAMPLE = 256
+ACCURACY_SAMPLE_PER_CLUSTER = 16
+
+
+class ClusterStore:
+    """
+    Resident store of every cluster's encodings.
+
+    All encodings live in one contiguous EncodingArray (float32, or float16/int8 to save memory)
+    with a parallel array of cluster indices, so matching a new face against every cluster is a
+    single vectorized query.
+    Clusters are still persisted as `<id>.pkl` files in the cluster directory, but only
+    dirty clusters are written, and only every `flush_interval` changes or on `flush()`.
+
+    Every cluster also keeps a summary that is updated on append: the running sum and sum of
+    squares of its members (giving its centroid and RMS radius) and a reservoir sample of up to
+    `representatives` members. `match` uses the summaries only, so assigning a face costs the
+    same whatever the size of the clusters.
+    """
+
+    def __init__(self, cluster_path, dim=128, flush_interval=500, initial_capacity=1024, representatives=8, seed=0,
+                 dtype="float32", tolerance=None):
+        """
+        :param cluster_path: Directory holding the `<id>.pkl` cluster files
+        :param dim: Length of a face encoding
+        :param flush_interval: Number of appended encodings between automatic flushes
+        :param initial_capacity: Number of rows to preallocate in the encoding matrix
+        :param representatives: Number of sampled members kept per cluster for matching
+        :param seed: Seed of the representative sampling
+        :param dtype: Storage type of the encodings, "float32", "float16" or "int8"
+        :param tolerance: Largest distance error the storage type may cause, checked on a sample of the
+                          first encodings loaded or appended, taken across clusters (see
+                          encoding_array.distance_error). Encodings stay float32 until the check
+                          passes, and for good if it fails; None skips the check
+        """
+        self.cluster_path = cluster_path
+        self.dim = dim
+        self.flush_interval = flush_interval
+        self.tolerance = tolerance
+        self.dtype = dtype
+        checked = tolerance is None or dtype == "float32"
+        self._encodings = EncodingArray(dim, dtype if checked else "float32", initial_capacity)
+        self._cluster_ids = np.empty(initial_capacity, dtype=np.int32)
+        self._size = 0
+        self._names = []  # cluster index -> cluster name (pickle file stem)
+        self._index = {}  # cluster name -> cluster index
+        self._dirty = set()
+        self._pending = 0
+        # float32 copies of the first encodings, until the accuracy of the storage type is checked
+        self._accuracy_rows = None if checked else []
+        # Per-cluster summaries, indexed like _names and grown with it
+        self._rng = np.random.default_rng(seed)
+        self._counts = np.zeros(0, dtype=np.int64)
+        self._sums = np.zeros((0, dim), dtype=np.float64)
+        self._square_sums = np.zeros(0, dtype=np.float64)
+        self._centroids = np.zeros((0, dim), dtype=np.float32)
+        self._representatives = np.zeros((0, representatives, dim), dtype=np.float32)
+        self._representative_counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def names(self):
+        return list(self._names)
+
+    @property
+    def encodings(self):
+        """All stored encodings as float32; a read-only view when they are stored as float32."""
+        return self._encodings.to_float32()
+
+    @property
+    def cluster_ids(self):
+        """Read-only view of the cluster index of every stored encoding."""
+        view = self._cluster_ids[:self._size]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def centroids(self):
+        """Read-only view of the mean encoding of every cluster, indexed like `names`."""
+        view = self._centroids[:len(self._names)]
+        view.flags.writeable = False
+        return view
+
+    @property
+    def radii(self):
+        """RMS distance between the members of every cluster and its centroid, indexed like `names`."""
+        clusters = len(self._names)
+        counts = self._counts[:clusters]
+        variance = self._square_sums[:clusters] / counts - np.einsum(
+            'ij,ij->i', self._sums[:clusters], self._sums[:clusters]) / counts ** 2
+        return np.sqrt(np.maximum(variance, 0.0))
+
+    def load(self):
+        """
+        Load every `<id>.pkl` cluster file found in the cluster directory.
+        :return: self
+        """
+        if not os.path.isdir(self.cluster_path):
+            return self
+        for filename in sorted(os.listdir(self.cluster_path)):
+            if not filename.endswith('.pkl'):
+                continue
+            encoding_list = utils.load_cluster_in_pickle(os.path.join(self.cluster_path, filename))
+            if len(encoding_list) == 0:
+                continue
+            rows = np.asarray(encoding_list, dtype=np.float32).reshape(-1, self.dim)
+            cluster = self._register(filename[:-len('.pkl')])
+            self._append_rows(cluster, rows)
+        self._check_accuracy()
+        return self
+
+    def new_cluster(self, name, encoding):
+        """
+        Create a cluster holding a single encoding.
+        :param name: Cluster name, used as the pickle file stem and output directory name
+        :param encoding: First face encoding of the cluster
+        """
+        if name in self._index:
+            raise ValueError(f"Cluster {name} already exists")
+        self.append(self._register(name), encoding)
+
+    def append(self, name, encoding):
+        """
+        Append an encoding to an existing cluster.
+        :param name: Cluster name
+        :param encoding: Face encoding to add
+        """
+        cluster = self._index[name] if not isinstance(name, (int, np.integer)) else int(name)
+        self._append_rows(cluster, np.asarray(encoding, dtype=np.float32).reshape(1, self.dim))
+        self._dirty.add(cluster)
+        self._pending += 1
+        if self._pending >= self.flush_interval:
+            self.flush()
+
+    def mean_distances(self, encoding):
+        """
+        Average euclidean distance between an encoding and the members of every cluster.
+        :param encoding: Face encoding
+        :return: Array of average distances indexed like `names`
+        """
+        if self._size == 0:
+            return np.empty(0, dtype=np.float32)
+        query = np.asarray(encoding, dtype=np.float32)
+        distances = np.linalg.norm(self._encodings.to_float32() - query, axis=1)
+        ids = self._cluster_ids[:self._size]
+        sums = np.bincount(ids, weights=distances, minlength=len(self._names))
+        counts = np.bincount(ids, minlength=len(self._names))
+        return sums / counts
+
+    def estimated_mean_distances(self, encoding, clusters=None):
+        """
+        Estimate the average distance between an encoding and the members of clusters from their summaries.
+        The average over the representatives is kept within the bounds the centroid and radius give:
+        the distance to the centroid (the average distance can't be lower) and
+        sqrt(distance to centroid ** 2 + radius ** 2) (the root mean square distance, which it can't exceed).
+        Clusters with no more members than representatives get their exact average.
+        :param encoding: Face encoding
+        :param clusters: Indices of the clusters to estimate, all clusters if None
+        :return: Array of estimated average distances, one per cluster in `clusters`
+        """
+        return self.cluster_distances(np.asarray(encoding, dtype=np.float32).reshape(1, -1), clusters)[0]
+
+    def cluster_distances(self, encodings, clusters=None, exact=False, statistic="mean"):
+        """
+        Distances between several encodings and clusters as one faces x members distance matrix,
+        reduced per cluster with np.add.reduceat (np.minimum.reduceat for "min") over the members
+        grouped by cluster.
+        :param encodings: Array of shape (faces, dim)
+        :param clusters: Indices of the clusters to compare with, all clusters if None
+        :param exact: Reduce over every member instead of the representatives; estimated averages
+                      are clipped like in estimated_mean_distances
+        :param statistic: "mean" for the average distance, "min" for the distance to the closest member
+        :return: Array of shape (faces, len(clusters))
+        """
+        clusters = np.arange(len(self._names)) if clusters is None else np.asarray(clusters, dtype=np.int64)
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        if len(clusters) == 0 or len(queries) == 0:
+            return np.empty((len(queries), len(clusters)))
+        if exact:
+            # Members of the selected clusters, grouped by cluster in the order of `clusters`
+            ids = self._cluster_ids[:self._size]
+            position = np.full(len(self._names), -1)
+            position[clusters] = np.arange(len(clusters))
+            selected = np.flatnonzero(position[ids] >= 0)
+            members = selected[np.argsort(position[ids[selected]], kind='stable')]
+            counts = np.bincount(position[ids[members]], minlength=len(clusters))
+            rows = self._encodings[members]
+        else:
+            counts = self._representative_counts[clusters]
+            valid = np.arange(self._representatives.shape[1]) < counts[:, None]
+            rows = self._representatives[clusters][valid]
+        distances = _pairwise_distances(queries, rows)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        if statistic == "min":
+            return np.minimum.reduceat(distances, starts, axis=1)
+        if statistic != "mean":
+            raise ValueError(f"Unknown statistic: {statistic}")
+        means = np.add.reduceat(distances, starts, axis=1) / counts
+        if exact:
+            return means
+        centroid_distances = _pairwise_distances(queries, self._centroids[clusters])
+        upper = np.sqrt(centroid_distances ** 2 + self.radii[clusters] ** 2)
+        return np.clip(means, centroid_distances, upper)
+
+    def match(self, encoding, threshold=0.5, exact=False):
+        """
+        Find the cluster whose members are closest on average to an encoding, in two stages:
+        the centroids rule out every cluster whose centroid is already `threshold` away (the
+        average distance to the members is at least the distance to the centroid), then the
+        remaining candidates are compared on their estimated average distance.
+        :param encoding: Face encoding
+        :param threshold: Maximum average distance for a match
+        :param exact: Compare the candidates on their exact average distance over all members,
+                      at a cost that grows with the cluster sizes
+        :return: Name of the best matching cluster, or None if no cluster is close enough
+        """
+        return self.match_faces(np.asarray(encoding, dtype=np.float32).reshape(1, -1), threshold, exact)[0]
+
+    def match_faces(self, encodings, threshold=0.5, exact=False, images=None):
+        """
+        Match all the faces of an image (or of a batch of images) at once, like match(), with
+        at most one face of an image per cluster: the (face, cluster) pairs under the threshold
+        are taken in order of increasing average distance, skipping faces already matched and
+        clusters already taken by another face of the same image.
+        :param encodings: Array of shape (faces, dim)
+        :param threshold: Maximum average distance for a match
+        :param exact: Compare the candidates on their exact average distance over all members
+        :param images: Image index of every face, None when all faces come from one image
+        :return: List with the name of the matched cluster, or None, for every face
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        matches = [None] * len(queries)
+        if not self._names or len(queries) == 0:
+            return matches
+        centroid_distances = _pairwise_distances(queries, self.centroids)
+        candidates = np.flatnonzero(np.any(centroid_distances < threshold, axis=0))
+        if len(candidates) == 0:
+            return matches
+        distances = self.cluster_distances(queries, candidates, exact)
+        distances[centroid_distances[:, candidates] >= threshold] = np.inf
+        faces, columns = np.nonzero(distances < threshold)
+        order = np.argsort(distances[faces, columns], kind='stable')
+        images = np.zeros(len(queries), dtype=np.int64) if images is None else np.asarray(images)
+        taken = set()
+        for face, column in zip(faces[order].tolist(), columns[order].tolist()):
+            if matches[face] is None and (images[face], column) not in taken:
+                matches[face] = self._names[candidates[column]]
+                taken.add((images[face], column))
+        return matches
+
+    def flush(self):
+        """Write every cluster changed since the last flush back to its pickle file."""
+        self._check_accuracy()
+        if not self._dirty:
+            return
+        utils.create_dir(self.cluster_path)
+        ids = self._cluster_ids[:self._size]
+        order = np.argsort(ids, kind='stable')
+        bounds = np.searchsorted(ids[order], np.arange(len(self._names) + 1))
+        for cluster in sorted(self._dirty):
+            rows = self._encodings[order[bounds[cluster]:bounds[cluster + 1]]]
+            # Keep the on-disk format readable by the rest of the scripts: a list of float64 arrays
+            utils.save_cluster_in_pickle(os.path.join(self.cluster_path, f"{self._names[cluster]}.pkl"),
+                                         list(rows.astype(np.float64)))
+        self._dirty.clear()
+        self._pending = 0
+
+    def _register(self, name):
+        cluster = len(self._names)
+        if cluster == len(self._counts):
+            capacity = max(2 * cluster, 64)
+            self._counts = np.resize(self._counts, capacity)
+            self._sums = np.resize(self._sums, (capacity, self.dim))
+            self._square_sums = np.resize(self._square_sums, capacity)
+            self._centroids = np.resize(self._centroids, (capacity, self.dim))
+            self._representatives = np.resize(self._representatives, (capacity,) + self._representatives.shape[1:])
+            self._representative_counts = np.resize(self._representative_counts, capacity)
+        self._counts[cluster] = 0
+        self._sums[cluster] = 0.0
+        self._square_sums[cluster] = 0.0
+        self._representative_counts[cluster] = 0
+        self._index[name] = cluster
+        self._names.append(name)
+        return cluster
+
+    def _update_summary(self, cluster, rows):
+        # Running moments give the centroid and radius; reservoir sampling keeps every member
+        # equally likely to be a representative however the cluster grew
+        capacity = self._representatives.shape[1]
+        for row in rows:
+            self._counts[cluster] += 1
+            taken = self._representative_counts[cluster]
+            if taken < capacity:
+                self._representatives[cluster, taken] = row
+                self._representative_counts[cluster] += 1
+            else:
+                slot = self._rng.integers(self._counts[cluster])
+                if slot < capacity:
+                    self._representatives[cluster, slot] = row
+        self._sums[cluster] += rows.sum(axis=0, dtype=np.float64)
+        self._square_sums[cluster] += np.einsum('ij,ij->', rows, rows, dtype=np.float64)
+        self._centroids[cluster] = self._sums[cluster] / self._counts[cluster]
+
+    def _check_accuracy(self):
+        # Runs once, on whatever was sampled: ACCURACY_SAMPLE rows, or fewer at the end of load() or on flush()
+        # A failed check warns instead of raising, so a run is never stopped halfway through
+        if not self._accuracy_rows:
+            return
+        rows, self._accuracy_rows = np.asarray(self._accuracy_rows), None
+        error = distance_error(rows, self.dtype)
+        if error > self.tolerance:
+            print(f"Warning: {self.dtype} encodings change distances by up to {error:.4f}, more than "
+                  f"{self.tolerance}; keeping the encodings as float32.")
+            self.dtype = "float32"
+            return
+        self._encodings = EncodingArray.from_array(self._encodings.to_float32(), self.dim, self.dtype)
+
+    def _append_rows(self, cluster, rows):
+        if self._accuracy_rows is not None:
+            # A few rows per call, so the loaded clusters and the appended faces all contribute
+            self._accuracy_rows.extend(rows[:ACCURACY_SAMPLE_PER_CLUSTER])
+            if len(self._accuracy_rows) >= ACCURACY_SAMPLE:
+                self._check_accuracy()
+        needed = self._size + len(rows)
+        if needed > len(self._cluster_ids):
+            cluster_ids = np.empty(max(needed, 2 * len(self._cluster_ids)), dtype=np.int32)
+            cluster_ids[:self._size] = self._cluster_ids[:self._size]
+            self._cluster_ids = cluster_ids
+        self._encodings.extend(rows)
+        self._cluster_ids[self._size:needed] = cluster
+        self._size = needed
+        self._update_summary(cluster, rows)
+
+
+def _pairwise_distances(queries, rows):
+    # Euclidean distances between every query and every row, without a (queries, rows, dim) temporary
+    queries, rows = queries.astype(np.float64), rows.astype(np.float64)
+    squares = np.einsum('ij,ij->i', queries, queries)[:, None] + np.einsum('ij,ij->i', rows, rows)[None, :]
+    return np.sqrt(np.maximum(squares - 2 * queries @ rows.T, 0.0))
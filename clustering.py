@@ -0,0 +1,245 @@
+import os
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import DBSCAN
+
+CLUSTERING_METHODS = ("dbscan", "graph_dbscan", "connected_components", "chinese_whispers")
+
+
+class NeighbourGraph:
+    """
+    Sparse euclidean neighbour graph over face encodings.
+
+    Every pair of encodings closer than `radius` is stored (at most `max_neighbours` per point),
+    so any clustering with eps <= radius only has to filter edges instead of recomputing
+    distances. The graph is built in chunks of at most chunk_size rows and about 32M distances,
+    so memory stays bounded for large N, and it can be extended with rows appended to the
+    encoding store since it was built.
+    """
+
+    def __init__(self, n, radius, max_neighbours, rows, cols, distances):
+        self.n = n
+        self.radius = radius
+        self.max_neighbours = max_neighbours
+        self.rows = rows
+        self.cols = cols
+        self.distances = distances
+
+    @classmethod
+    def build(cls, encodings, radius=0.6, max_neighbours=64, chunk_size=4096):
+        """
+        :param encodings: Contiguous float32 array of shape (n, dim), e.g. a memory-mapped store column
+        :param radius: Largest distance stored in the graph, the maximum usable eps
+        :param max_neighbours: Maximum number of neighbours kept per point
+        :param chunk_size: Number of rows whose distances are computed at once
+        :return: NeighbourGraph
+        """
+        graph = cls(0, radius, max_neighbours, np.zeros(0, np.int32), np.zeros(0, np.int32),
+                    np.zeros(0, np.float32))
+        graph.extend(encodings, chunk_size)
+        return graph
+
+    def extend(self, encodings, chunk_size=4096):
+        """
+        Add the edges of rows appended to encodings since the graph was built.
+        Every row keeps its max_neighbours nearest neighbours within the radius, and an edge is
+        stored in both directions when either end keeps it. Rows already in the graph are capped
+        again with the new rows as candidates, so extending gives the same graph as a fresh build.
+        :param encodings: Array of shape (n, dim) whose first self.n rows are already in the graph
+        """
+        encodings = np.asarray(encodings, dtype=np.float32)
+        squared_norms = np.einsum('ij,ij->i', encodings, encodings)
+        # Candidate edges (row, neighbour); the stored edges hold the nearest neighbours of every old row
+        rows, cols, distances = [self.rows], [self.cols], [self.distances]
+        # Fewer rows per chunk for large N keeps each chunk x N distance block (and its transpose) around 128 MB
+        chunk_size = max(1, min(chunk_size, 2 ** 25 // max(len(encodings), 1)))
+        for start in range(self.n, len(encodings), chunk_size):
+            end = min(start + chunk_size, len(encodings))
+            # |a - b|^2 = |a|^2 + |b|^2 - 2ab, against every row up to the end of this chunk
+            chunk = squared_norms[start:end, None] + squared_norms[None, :end] - 2 * encodings[start:end] @ encodings[:end].T
+            chunk = np.sqrt(np.maximum(chunk, 0))
+            chunk[np.arange(end - start), np.arange(start, end)] = np.inf  # no self edges
+            chunk[chunk > self.radius] = np.inf
+            # Nearest neighbours of the chunk rows among every earlier row...
+            nearest = _nearest(chunk, self.max_neighbours)
+            chunk_distances = np.take_along_axis(chunk, nearest, axis=1)
+            keep = np.isfinite(chunk_distances)
+            rows.append(np.broadcast_to(np.arange(start, end)[:, None], nearest.shape)[keep])
+            cols.append(nearest[keep])
+            distances.append(chunk_distances[keep])
+            # ...and of every earlier row among the chunk rows, which may displace its current ones
+            earlier = np.ascontiguousarray(chunk[:, :start].T)
+            nearest = _nearest(earlier, self.max_neighbours)
+            chunk_distances = np.take_along_axis(earlier, nearest, axis=1)
+            keep = np.isfinite(chunk_distances)
+            rows.append(np.broadcast_to(np.arange(start)[:, None], nearest.shape)[keep])
+            cols.append(start + nearest[keep])
+            distances.append(chunk_distances[keep])
+        rows, cols, distances = np.concatenate(rows), np.concatenate(cols), np.concatenate(distances)
+        self.n = len(encodings)
+
+        # Keep the max_neighbours nearest candidates of every row, then store each kept edge both ways
+        rows, cols, distances = _unique_edges(rows, cols, distances, self.n)
+        order = np.lexsort((distances, rows))
+        rows, cols, distances = rows[order], cols[order], distances[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        keep = rank < self.max_neighbours
+        rows, cols, distances = rows[keep], cols[keep], distances[keep]
+        self.rows, self.cols, self.distances = _unique_edges(
+            np.concatenate([rows, cols]).astype(np.int32), np.concatenate([cols, rows]).astype(np.int32),
+            np.concatenate([distances, distances]).astype(np.float32), self.n)
+        return self
+
+    def edges(self, eps):
+        """
+        Sparse distance matrix holding the edges shorter than eps.
+        :param eps: Neighbourhood radius, at most self.radius
+        :return: CSR matrix of shape (n, n)
+        """
+        if eps > self.radius:
+            raise ValueError(f"eps={eps} exceeds the graph radius {self.radius}; rebuild the graph")
+        keep = self.distances <= eps
+        # Zero distances (identical encodings) are kept as explicit entries, i.e. still neighbours
+        return sparse.csr_matrix((self.distances[keep], (self.rows[keep], self.cols[keep])), shape=(self.n, self.n))
+
+    def save(self, path):
+        np.savez(path, n=self.n, radius=self.radius, max_neighbours=self.max_neighbours,
+                 rows=self.rows, cols=self.cols, distances=self.distances)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as graph:
+            return cls(int(graph["n"]), float(graph["radius"]), int(graph["max_neighbours"]),
+                       graph["rows"], graph["cols"], graph["distances"])
+
+
+def _nearest(distances, k):
+    # Column indices of the k smallest distances of every row (all of them when there are no more than k)
+    if distances.shape[1] > k:
+        return np.argpartition(distances, k, axis=1)[:, :k]
+    return np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+
+
+def _unique_edges(rows, cols, distances, n):
+    # A pair may be found from both ends, or be stored already
+    if len(rows) == 0:
+        return rows, cols, distances
+    _, unique = np.unique(rows.astype(np.int64) * max(n, 1) + cols, return_index=True)
+    return rows[unique], cols[unique], distances[unique]
+
+
+def eps_degrees(encodings, rows, eps, chunk_size=4096):
+    """
+    Exact size of the eps-neighbourhood (the point included, as in DBSCAN) of some rows, whatever
+    the max_neighbours cap of the neighbour graph.
+    :param encodings: Array of shape (n, dim)
+    :param rows: Indices of the rows to count the neighbours of
+    :param eps: Neighbourhood radius
+    :return: Array of neighbour counts, one per row in rows
+    """
+    encodings = np.asarray(encodings, dtype=np.float32)
+    rows = np.asarray(rows, dtype=np.int64)
+    squared_norms = np.einsum('ij,ij->i', encodings, encodings)
+    degrees = np.zeros(len(rows), dtype=np.int64)
+    chunk_size = max(1, min(chunk_size, 2 ** 25 // max(len(encodings), 1)))
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows = rows[start:start + chunk_size]
+        chunk = squared_norms[chunk_rows, None] + squared_norms[None, :] - 2 * encodings[chunk_rows] @ encodings.T
+        degrees[start:start + len(chunk_rows)] = np.count_nonzero(chunk <= eps ** 2, axis=1)
+    return degrees
+
+
+def load_or_build_graph(encodings, path, radius=0.6, max_neighbours=64):
+    """
+    Reuse the neighbour graph saved at path, extending it with new rows, or build it.
+    :param encodings: Array of shape (n, dim)
+    :param path: .npz file of the saved graph, None to build without saving
+    :param radius: Largest distance stored in the graph
+    :param max_neighbours: Maximum number of neighbours kept per point
+    :return: NeighbourGraph covering every row of encodings
+    """
+    if path is not None and os.path.exists(path):
+        graph = NeighbourGraph.load(path)
+        if graph.n <= len(encodings) and graph.radius >= radius and graph.max_neighbours == max_neighbours:
+            if graph.n < len(encodings):
+                graph.extend(encodings)
+                graph.save(path)
+            return graph
+    graph = NeighbourGraph.build(encodings, radius, max_neighbours)
+    if path is not None:
+        graph.save(path)
+    return graph
+
+
+def chinese_whispers(edges, iterations=20, seed=0):
+    """
+    Chinese Whispers graph clustering, as used by dlib for face clustering.
+    Each pass, half of the nodes (chosen at random) adopt the label with the highest total edge
+    weight among their neighbours; weights are 1 - distance.
+    :param edges: Sparse symmetric distance matrix
+    :return: Array of labels, one per node
+    """
+    rng = np.random.default_rng(seed)
+    coo = edges.tocoo()
+    weights = np.maximum(1.0 - coo.data, 1e-6)
+    labels = np.arange(edges.shape[0])
+    for _ in range(iterations):
+        # Total weight of every (node, neighbour label) pair, then the heaviest label per node
+        pair_keys = coo.row.astype(np.int64) * edges.shape[0] + labels[coo.col]
+        unique_keys, inverse = np.unique(pair_keys, return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+        nodes, candidate_labels = unique_keys // edges.shape[0], unique_keys % edges.shape[0]
+        order = np.lexsort((-totals, nodes))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = nodes[order][1:] != nodes[order][:-1]
+        best_nodes, best_labels = nodes[order][first], candidate_labels[order][first]
+        if np.array_equal(labels[best_nodes], best_labels):
+            break  # converged: every node already holds its heaviest neighbour label
+        update = rng.random(len(best_nodes)) < 0.5
+        labels = labels.copy()
+        labels[best_nodes[update]] = best_labels[update]
+    return labels
+
+
+def _relabel(labels, min_samples):
+    # Consecutive labels from 0, with clusters smaller than min_samples marked as noise (-1)
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    sizes = counts[inverse]
+    kept = np.unique(inverse[sizes >= min_samples])
+    mapping = np.full(len(counts), -1)
+    mapping[kept] = np.arange(len(kept))
+    return mapping[inverse]
+
+
+def cluster_faces(encodings, method="dbscan", eps=0.5, min_samples=3, graph=None, graph_path=None,
+                  graph_radius=0.6):
+    """
+    Cluster face encodings.
+    :param encodings: Contiguous float32 array of shape (n, dim)
+    :param method: "dbscan" (sklearn on the raw encodings), "graph_dbscan" (DBSCAN on the
+                   precomputed neighbour graph), "connected_components" (single linkage on the graph)
+                   or "chinese_whispers" (label propagation on the graph)
+    :param eps: Maximum distance between two faces of the same neighbourhood
+    :param min_samples: Minimum neighbourhood (DBSCAN) or cluster (graph methods) size
+    :param graph: NeighbourGraph with radius >= eps; loaded or built from graph_path if not given
+    :param graph_path: .npz file where the neighbour graph is reused from and saved to
+    :param graph_radius: Radius of a newly built graph, the largest eps it can serve
+    :return: Array of cluster labels, -1 for noise
+    """
+    if method not in CLUSTERING_METHODS:
+        raise ValueError(f"Unknown clustering method: {method}")
+    if len(encodings) == 0:
+        return np.zeros(0, dtype=int)
+    if method == "dbscan":
+        return DBSCAN(eps=eps, min_samples=min_samples, metric="euclidean").fit_predict(encodings)
+
+    if graph is None:
+        graph = load_or_build_graph(encodings, graph_path, radius=max(graph_radius, eps))
+    edges = graph.edges(eps)
+    if method == "graph_dbscan":
+        return DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed").fit_predict(edges)
+    if method == "connected_components":
+        _, labels = connected_components(edges, directed=False)
+        return _relabel(labels, min_samples)
+    return _relabel(chinese_whispers(edges), min_samples)
@@ -3,6 +3,85 @@ input_path = r'G:\My Drive\OMER_PERSONAL\Omer\Gallery\Wedding\magnets_photos\Dan
 cluster_path =  'cluster'
 sorted_path = 'sorted'
 
+# Resolution used for face detection. Boxes found on the downscaled copy are mapped back and
+# encodings are always computed from the full-resolution pixels.
+# detection_max_long_edge caps the longest image side in pixels (None keeps full resolution);
+# detection_scale is a fixed factor such as 0.5 and takes precedence when set.
+# Run benchmarks/detection_scale.py on a sample folder to pick a value.
+detection_max_long_edge = None
+detection_scale = None
 
+# Time budget in seconds per image of the "tiered" detection model, which runs HOG first and the
+# CNN detector only on images where HOG probably missed faces (none found, faces near the smallest
+# size HOG finds, or a dark scene). The CNN pass is downscaled to fit the budget. None for no limit.
+tiered_time_budget = 2.0
 
+# Persistent cache of face locations and encodings, kept outside cluster_path and sorted_path
+# which are wiped on every run. encoding_cache_key is "stat" (path, size and mtime) or
+# "content" (SHA-1 of the file, survives renames but reads every file).
+encoding_cache_path = 'encoding_cache.sqlite'
+encoding_cache_key = 'stat'
 
+# Append-only columnar store of every detected face (encodings, locations, image paths),
+# used as the main_v2.py checkpoint and read memory-mapped by the clustering scripts
+encoding_store_path = 'encoding_store'
+
+# Storage type of the encodings held in memory by the cluster store: "float32", or "float16" / "int8"
+# (half / a quarter of the memory). A compact type is only used once a sample of the first encodings
+# shows it moves their distances by at most encoding_max_distance_error; otherwise a warning is printed
+# and the encodings stay float32 (None skips the check).
+encoding_dtype = 'float32'
+encoding_max_distance_error = 0.01
+
+# SQLite catalog of the results (images, faces with their encodings and crops, clusters), indexed
+# by path, folder, image and cluster. The clustering scripts rewrite it with cluster_path, and the
+# cluster index, the summary thumbnails and find_cluster_for_new_face read from it.
+face_catalog_path = 'face_catalog.sqlite'
+
+# Approximate nearest-neighbour index over the cluster encodings, used by find_cluster_for_new_face.
+# It is rebuilt whenever the clustering scripts rewrite cluster_path.
+cluster_index_path = 'cluster_index'
+
+# Clustering of the collected encodings: "dbscan" (sklearn on the raw encodings), or a method on a
+# sparse neighbour graph that is saved next to the encodings and reused, so re-clustering at a new
+# eps (up to neighbour_graph_radius) only filters edges: "graph_dbscan", "connected_components"
+# or "chinese_whispers".
+clustering_method = 'dbscan'
+clustering_eps = 0.5
+clustering_min_samples = 3
+neighbour_graph_radius = 0.6
+
+# Listing of input_path saved by the threaded scanner; the next run only lists again the directories
+# whose mtime changed. None always lists every directory.
+scan_manifest_path = 'scan_manifest.json'
+
+# Burst shots and exported copies are grouped before detection by a difference hash of a reduced
+# decode; only the first file of a group is detected and encoded and the others reuse its faces.
+# near_duplicate_max_distance is the number of differing bits (of 64) still counted as a duplicate,
+# None disables the pre-pass.
+near_duplicate_max_distance = 4
+
+# How the original photos are placed in the sorted folders: "hardlink" (no extra disk space, needs the
+# same volume), "symlink", "reflink" (copy-on-write clone on btrfs, XFS or APFS), "copy", "move" (takes
+# them out of input_path) or "manifest" (no files, only the manifest). Links the file system refuses
+# fall back to a copy. Every placement is listed in output_manifest_name (.csv or .json) in sorted_path.
+output_mode = 'hardlink'
+output_manifest_name = 'output_manifest.csv'
+
+# Face crops are captured as JPEG thumbnails during the encoding pass and stored with the encodings,
+# so the output stage and the summary grids never decode the original photos again.
+# face_crop_max_edge caps the longest crop side in pixels (None keeps the detected size).
+face_crop_max_edge = 256
+
+# Besides face_clusters.csv, the clustering scripts can write a columnar results table with the
+# encodings included (sorted/face_clusters.parquet or .arrow), loaded in one read by downstream
+# matching: None, "parquet" or "arrow". Requires pyarrow.
+results_table_format = None
+
+# Per-stage timings (read, decode, detect, encode, cluster, write, ...), image and face counts and
+# peak RSS are written as a JSON summary at the end of a run. prometheus_path optionally names a
+# Prometheus text file (e.g. in the node_exporter textfile directory) rewritten every
+# prometheus_interval seconds while the run is going.
+metrics_path = 'pipeline_metrics.json'
+prometheus_path = None
+prometheus_interval = 15
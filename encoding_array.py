@@ -0,0 +1,128 @@
+import numpy as np
+
+ENCODING_DTYPES = ("float32", "float16", "int8")
+
+
+class EncodingArray:
+    """
+    Growable N x dim matrix of face encodings in one contiguous buffer.
+
+    Encodings are stored as float32 by default, or compacted to float16 (half the memory) or to
+    int8 (a quarter), quantized linearly over [-value_range, value_range]; dlib's encodings stay
+    well inside the default range of 0.5. Rows are returned as float32 whatever the storage.
+    """
+
+    __slots__ = ("dim", "dtype", "value_range", "_data", "_size")
+
+    def __init__(self, dim=128, dtype="float32", capacity=1024, value_range=0.5):
+        """
+        :param dim: Length of a face encoding
+        :param dtype: Storage type, one of ENCODING_DTYPES
+        :param capacity: Number of rows to preallocate
+        :param value_range: Largest absolute value represented by int8 storage
+        """
+        if dtype not in ENCODING_DTYPES:
+            raise ValueError(f"Unknown encoding dtype: {dtype}")
+        self.dim = dim
+        self.dtype = dtype
+        self.value_range = value_range
+        self._data = np.empty((capacity, dim), dtype=dtype)
+        self._size = 0
+
+    @classmethod
+    def from_array(cls, encodings, dim=128, dtype="float32", value_range=0.5):
+        """Build an array holding a copy of encodings."""
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, dim)
+        array = cls(dim, dtype, max(len(encodings), 1), value_range)
+        array.extend(encodings)
+        return array
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, rows):
+        return self._decode(self._data[:self._size][rows])
+
+    @property
+    def nbytes(self):
+        """Bytes used by the stored rows."""
+        return self._size * self.dim * self._data.itemsize
+
+    @property
+    def raw(self):
+        """Read-only view of the stored rows in their storage type."""
+        view = self._data[:self._size]
+        view.flags.writeable = False
+        return view
+
+    def append(self, encoding):
+        """Append one encoding."""
+        self.extend(np.asarray(encoding, dtype=np.float32).reshape(1, self.dim))
+
+    def extend(self, encodings):
+        """Append the rows of an (n, dim) array or a list of encodings."""
+        rows = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        needed = self._size + len(rows)
+        if needed > len(self._data):
+            data = np.empty((max(needed, 2 * len(self._data)), self.dim), dtype=self.dtype)
+            data[:self._size] = self._data[:self._size]
+            self._data = data
+        self._data[self._size:needed] = self._encode(rows)
+        self._size = needed
+
+    def to_float32(self):
+        """
+        All rows as a float32 (n, dim) array; a read-only view without copying for float32 storage.
+        """
+        if self.dtype == "float32":
+            return self.raw
+        return self._decode(self._data[:self._size])
+
+    def _encode(self, rows):
+        if self.dtype == "int8":
+            return np.clip(np.rint(rows * (127.0 / self.value_range)), -127, 127)
+        return rows
+
+    def _decode(self, rows):
+        if self.dtype == "int8":
+            return rows.astype(np.float32) * np.float32(self.value_range / 127.0)
+        return rows.astype(np.float32, copy=False)
+
+
+def distance_error(encodings, dtype, value_range=0.5, sample=1000, seed=0):
+    """
+    Largest change of the euclidean distance between two encodings caused by storing them as dtype,
+    over the pairs of a random sample.
+    :param encodings: Array of shape (n, dim)
+    :param dtype: One of ENCODING_DTYPES
+    :param value_range: int8 quantization range
+    :param sample: Number of encodings sampled
+    :return: Maximum absolute distance error
+    """
+    encodings = np.asarray(encodings, dtype=np.float32)
+    if len(encodings) > sample:
+        encodings = encodings[np.random.default_rng(seed).choice(len(encodings), sample, replace=False)]
+    stored = EncodingArray.from_array(encodings, encodings.shape[1], dtype, value_range).to_float32()
+
+    def distances(vectors):
+        vectors = vectors.astype(np.float64)
+        squares = np.einsum('ij,ij->i', vectors, vectors)
+        return np.sqrt(np.maximum(squares[:, None] + squares[None, :] - 2 * vectors @ vectors.T, 0.0))
+
+    return float(np.max(np.abs(distances(stored) - distances(encodings)), initial=0.0))
+
+
+def check_accuracy(encodings, dtype, tolerance, value_range=0.5):
+    """
+    Raise ValueError if storing encodings as dtype moves a pairwise distance by more than tolerance.
+    :param encodings: Array of shape (n, dim)
+    :param dtype: One of ENCODING_DTYPES
+    :param tolerance: Largest accepted distance error, e.g. 0.01 next to a 0.5 match threshold
+    :param value_range: int8 quantization range
+    :return: The measured distance error
+    """
+    error = distance_error(encodings, dtype, value_range)
+    if error > tolerance:
+        raise ValueError(f"{dtype} encodings change distances by up to {error:.4f}, more than {tolerance}; "
+                         f"use a wider storage type")
+    return error
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import sqlite3
+import numpy as np
+
+
+class EncodingCache:
+    """
+    Durable cache of face locations and encodings per image file.
+
+    Entries are keyed by the file (its content hash, or path + size + mtime) together with the
+    detector settings, so a re-run only decodes and encodes files that changed. Results are kept
+    in a single SQLite file that lives outside the cluster/sorted directories wiped on every run.
+    """
+
+    def __init__(self, path, key_mode="stat", commit_interval=100):
+        """
+        :param path: Path of the SQLite cache file
+        :param key_mode: "stat" keys files by absolute path, size and mtime; "content" by a SHA-1 of the bytes
+        :param commit_interval: Number of stored entries between commits
+        """
+        if key_mode not in ("stat", "content"):
+            raise ValueError(f"Unknown cache key mode: {key_mode}")
+        self.path = path
+        self.key_mode = key_mode
+        self.commit_interval = commit_interval
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS encodings ("
+            " file_key TEXT NOT NULL,"
+            " settings TEXT NOT NULL,"
+            " locations TEXT NOT NULL,"
+            " encodings BLOB NOT NULL,"
+            " crop_lengths TEXT,"
+            " crops BLOB,"
+            " encoding_dtype TEXT,"
+            " PRIMARY KEY (file_key, settings))")
+        # Caches created before face crops were stored get the crop columns, empty for old entries;
+        # entries without an encoding_dtype hold float64 encodings
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(encodings)")}
+        for column, column_type in (("crop_lengths", "TEXT"), ("crops", "BLOB"), ("encoding_dtype", "TEXT")):
+            if column not in columns:
+                self._connection.execute(f"ALTER TABLE encodings ADD COLUMN {column} {column_type}")
+        self._connection.commit()
+
+    @staticmethod
+    def settings_key(model, max_long_edge=None, scale=None, crop_max_edge=None, tiers=None):
+        """
+        Fingerprint of the detector settings that produced an entry.
+        :param crop_max_edge: Maximum longest side of the stored face crops
+        :param tiers: Settings of tiered detection (see face_detection.tier_settings), ignored for other models
+        :return: String identifying the settings
+        """
+        return json.dumps({"model": model, "max_long_edge": max_long_edge, "scale": scale,
+                           "crop_max_edge": crop_max_edge, "tiers": tiers if model == "tiered" else None},
+                          sort_keys=True)
+
+    def file_key(self, file_path):
+        """
+        Key identifying the current state of a file.
+        :param file_path: Path to the image file
+        :return: Key string
+        """
+        if self.key_mode == "content":
+            digest = hashlib.sha1()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            return digest.hexdigest()
+        stat = os.stat(file_path)
+        return f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def get(self, file_key, settings):
+        """
+        Look up a cached result.
+        :return: Tuple (face_locations, face_encodings, face_crops), or None on a miss; face_encodings
+                 are float32 and face_crops is None for entries stored without crops
+        """
+        row = self._connection.execute(
+            "SELECT locations, encodings, crop_lengths, crops, encoding_dtype FROM encodings"
+            " WHERE file_key = ? AND settings = ?", (file_key, settings)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        face_locations = [tuple(location) for location in json.loads(row[0])]
+        if not face_locations:
+            return [], [], []
+        encodings = np.frombuffer(row[1], dtype=row[4] or np.float64).reshape(len(face_locations), -1)
+        face_encodings = list(encodings.astype(np.float32))
+        face_crops = None
+        if row[2] is not None:
+            bounds = np.concatenate([[0], np.cumsum(json.loads(row[2]))])
+            face_crops = [row[3][start:end] or None for start, end in zip(bounds[:-1], bounds[1:])]
+        return face_locations, face_encodings, face_crops
+
+    def put(self, file_key, settings, face_locations, face_encodings, face_crops=None):
+        """
+        Store the result for a file; an empty face_locations list records a file without faces.
+        face_crops optionally holds the JPEG crop (bytes or None) of every face.
+        """
+        locations = json.dumps([[int(value) for value in location] for location in face_locations])
+        encodings = np.asarray(face_encodings, dtype=np.float32).tobytes()
+        crop_lengths, crops = None, None
+        if face_crops is not None:
+            crop_lengths = json.dumps([len(crop) if crop else 0 for crop in face_crops])
+            crops = b''.join(crop for crop in face_crops if crop)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO encodings (file_key, settings, locations, encodings, crop_lengths, crops,"
+            " encoding_dtype) VALUES (?, ?, ?, ?, ?, ?, 'float32')",
+            (file_key, settings, locations, encodings, crop_lengths, crops))
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self):
+        self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
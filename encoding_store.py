@@ -0,0 +1,272 @@
+import os
+import json
+import numpy as np
+
+
+class EncodingStore:
+    """
+    Append-only columnar store of detected faces.
+
+    A store is a directory holding one raw file per column:
+    - encodings.f32: N x dim float32 face encodings
+    - locations.i32: N x 4 int32 (top, right, bottom, left) face locations
+    - path_ids.i32: N int32 indices into the path table
+    - paths.jsonl: interned image paths, one JSON string per line
+    - crop_spans.i64: N x 2 int64 (offset, length) of each face's JPEG crop in crops.bin,
+      length 0 when no crop was stored
+    - crops.bin: concatenated JPEG face crops
+    - meta.json: the committed row, path and crop byte counts
+
+    Appending a batch writes only the new rows, and readers memory-map the columns without
+    copying. Rows written after the last flush() are discarded when the store is reopened,
+    so a crash never leaves the columns out of step.
+    """
+
+    def __init__(self, path, dim=128):
+        """
+        Open a store for appending, creating it if needed.
+        :param path: Store directory
+        :param dim: Length of a face encoding
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = self._read_meta(path)
+        self.dim = meta.get("dim", dim)
+        self._count = meta.get("count", 0)
+        self._paths = self._read_paths(path, meta.get("path_count", 0))
+        self._path_index = {file_path: i for i, file_path in enumerate(self._paths)}
+        self._committed_paths = len(self._paths)
+        self._crop_bytes = self._committed_crop_bytes = meta.get("crop_bytes", 0)
+
+        # Drop anything written after the last committed flush; stores written before crops were
+        # kept get a zero (no crop) span for every row
+        for name, size in self._columns() + [('crops.bin', self._crop_bytes)]:
+            column_path = os.path.join(path, name)
+            with open(column_path, 'ab') as f:
+                f.truncate(size)
+        with open(os.path.join(path, 'paths.jsonl'), 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(file_path) + '\n' for file_path in self._paths)
+        self._open_files()
+
+    def _open_files(self):
+        self._encodings_file = open(os.path.join(self.path, 'encodings.f32'), 'ab')
+        self._locations_file = open(os.path.join(self.path, 'locations.i32'), 'ab')
+        self._path_ids_file = open(os.path.join(self.path, 'path_ids.i32'), 'ab')
+        self._paths_file = open(os.path.join(self.path, 'paths.jsonl'), 'a', encoding='utf-8')
+        self._crop_spans_file = open(os.path.join(self.path, 'crop_spans.i64'), 'ab')
+        self._crops_file = open(os.path.join(self.path, 'crops.bin'), 'ab')
+        self._pending = 0
+
+    def __len__(self):
+        return self._count + self._pending
+
+    def __contains__(self, file_path):
+        return file_path in self._path_index
+
+    @property
+    def paths(self):
+        """Paths of the images with faces in the store."""
+        return list(self._paths)
+
+    def append(self, file_path, face_locations, face_encodings, face_crops=None):
+        """
+        Append the faces found in one image.
+        :param file_path: Path of the image
+        :param face_locations: List of (top, right, bottom, left) tuples
+        :param face_encodings: List of encodings, one per location
+        :param face_crops: Optional list of JPEG crops (bytes or None), one per location
+        """
+        if len(face_locations) == 0:
+            return
+        if file_path not in self._path_index:
+            self._path_index[file_path] = len(self._paths)
+            self._paths.append(file_path)
+            self._paths_file.write(json.dumps(file_path) + '\n')
+        encodings = np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.dim)
+        self._encodings_file.write(encodings.tobytes())
+        self._locations_file.write(np.asarray(face_locations, dtype=np.int32).reshape(-1, 4).tobytes())
+        self._path_ids_file.write(np.full(len(encodings), self._path_index[file_path], dtype=np.int32).tobytes())
+        spans = np.zeros((len(encodings), 2), dtype=np.int64)
+        for i, crop in enumerate(face_crops or []):
+            if crop:
+                spans[i] = self._crop_bytes, len(crop)
+                self._crops_file.write(crop)
+                self._crop_bytes += len(crop)
+        self._crop_spans_file.write(spans.tobytes())
+        self._pending += len(encodings)
+
+    def flush(self):
+        """Commit every appended row to disk."""
+        for f in self._files():
+            f.flush()
+            os.fsync(f.fileno())
+        self._count += self._pending
+        self._pending = 0
+        self._committed_paths = len(self._paths)
+        self._committed_crop_bytes = self._crop_bytes
+        self._write_meta()
+
+    def remove(self, file_paths):
+        """
+        Rewrite the store without the faces of some images, e.g. images that changed or were deleted.
+        The rows after a removed one are renumbered, so anything indexed by row (the neighbour graph,
+        incremental clustering state) must be rebuilt. The store is committed empty while the columns
+        are rewritten: after a crash, RunJournal.recover() puts the journalled faces back.
+        :param file_paths: Paths of the images to remove
+        :return: Number of faces removed
+        """
+        self.flush()
+        removed = {self._path_index[file_path] for file_path in file_paths if file_path in self._path_index}
+        if not removed:
+            return 0
+        table = self.load(self.path)
+        keep_paths = np.array([path_id not in removed for path_id in range(len(self._paths))], dtype=bool)
+        keep = keep_paths[table.path_ids] if len(table) else np.zeros(0, dtype=bool)
+        path_ids = (np.cumsum(keep_paths) - 1)[table.path_ids[keep]].astype(np.int32)
+        spans = np.array(table.crop_spans[keep], dtype=np.int64)
+        paths = [file_path for file_path, kept in zip(self._paths, keep_paths) if kept]
+
+        for f in self._files():
+            f.close()
+        count = self._count
+        self._count, self._committed_paths, self._committed_crop_bytes = 0, 0, 0
+        self._write_meta()
+        columns = {'encodings.f32': np.ascontiguousarray(table.encodings[keep]),
+                   'locations.i32': np.ascontiguousarray(table.locations[keep]),
+                   'path_ids.i32': path_ids}
+        for name, column in columns.items():
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(column.tobytes())
+        # Crops are copied one by one, so the crop file is never held in memory
+        with open(os.path.join(self.path, 'crops.bin.tmp'), 'wb') as f:
+            offset = 0
+            for span in spans:
+                if span[1]:
+                    f.write(table.crops[span[0]:span[0] + span[1]].tobytes())
+                    span[0] = offset
+                    offset += span[1]
+        del table
+        os.replace(os.path.join(self.path, 'crops.bin.tmp'), os.path.join(self.path, 'crops.bin'))
+        with open(os.path.join(self.path, 'crop_spans.i64'), 'wb') as f:
+            f.write(spans.tobytes())
+        with open(os.path.join(self.path, 'paths.jsonl'), 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(file_path) + '\n' for file_path in paths)
+
+        self._count = int(keep.sum())
+        self._paths = paths
+        self._path_index = {file_path: i for i, file_path in enumerate(paths)}
+        self._committed_paths = len(paths)
+        self._crop_bytes = self._committed_crop_bytes = int(offset)
+        self._write_meta()
+        self._open_files()
+        return count - self._count
+
+    def close(self):
+        self.flush()
+        for f in self._files():
+            f.close()
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.json'))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-map the committed contents of a store.
+        :param path: Store directory
+        :return: FaceTable over the store columns
+        """
+        meta = cls._read_meta(path)
+        count, dim = meta.get("count", 0), meta.get("dim", 128)
+        return FaceTable(
+            encodings=cls._map(os.path.join(path, 'encodings.f32'), np.float32, (count, dim)),
+            locations=cls._map(os.path.join(path, 'locations.i32'), np.int32, (count, 4)),
+            path_ids=cls._map(os.path.join(path, 'path_ids.i32'), np.int32, (count,)),
+            paths=cls._read_paths(path, meta.get("path_count", 0)),
+            crop_spans=cls._map(os.path.join(path, 'crop_spans.i64'), np.int64, (count, 2)),
+            crops=cls._map(os.path.join(path, 'crops.bin'), np.uint8, (meta.get("crop_bytes", 0),)))
+
+    def _columns(self):
+        # (file name, committed size in bytes) of every per-row column
+        return [('encodings.f32', self._count * 4 * self.dim), ('locations.i32', self._count * 16),
+                ('path_ids.i32', self._count * 4), ('crop_spans.i64', self._count * 16)]
+
+    def _files(self):
+        return (self._encodings_file, self._locations_file, self._path_ids_file, self._crop_spans_file,
+                self._crops_file, self._paths_file)
+
+    def _write_meta(self):
+        # Write then rename so the committed counts are replaced atomically
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({"dim": self.dim, "count": self._count, "path_count": self._committed_paths,
+                       "crop_bytes": self._committed_crop_bytes}, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    @staticmethod
+    def _read_meta(path):
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return {}
+        with open(meta_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _read_paths(path, path_count):
+        paths_path = os.path.join(path, 'paths.jsonl')
+        if path_count == 0 or not os.path.exists(paths_path):
+            return []
+        with open(paths_path, encoding='utf-8') as f:
+            return [json.loads(line) for _, line in zip(range(path_count), f)]
+
+    @staticmethod
+    def _map(file_path, dtype, shape):
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode='r', shape=shape)
+
+
+class FaceTable:
+    """Read-only columns of an EncodingStore; row i is one detected face."""
+
+    def __init__(self, encodings, locations, path_ids, paths, crop_spans=None, crops=None):
+        self.encodings = encodings
+        self.locations = locations
+        self.path_ids = path_ids
+        self.paths = paths
+        self.crop_spans = crop_spans
+        self.crops = crops
+
+    def __len__(self):
+        return len(self.encodings)
+
+    def image_path(self, i):
+        return self.paths[self.path_ids[i]]
+
+    def location(self, i):
+        return tuple(int(value) for value in self.locations[i])
+
+    def crop(self, i):
+        """JPEG crop of face i stored during encoding, or None if none was stored."""
+        if self.crop_spans is None:
+            return None
+        offset, length = (int(value) for value in self.crop_spans[i])
+        return self.crops[offset:offset + length].tobytes() if length else None
+
+    @classmethod
+    def from_records(cls, data, dim=128):
+        """
+        Build a table from the legacy list of {"imagePath", "loc", "encoding"} dicts.
+        :param data: List of face dicts, as pickled in data_checkpoint.pkl
+        :return: FaceTable
+        """
+        paths, path_index = [], {}
+        for item in data:
+            if item["imagePath"] not in path_index:
+                path_index[item["imagePath"]] = len(paths)
+                paths.append(item["imagePath"])
+        return cls(encodings=np.asarray([item["encoding"] for item in data], dtype=np.float32).reshape(-1, dim),
+                   locations=np.asarray([item["loc"] for item in data], dtype=np.int32).reshape(-1, 4),
+                   path_ids=np.asarray([path_index[item["imagePath"]] for item in data], dtype=np.int32),
+                   paths=paths)
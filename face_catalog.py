@@ -0,0 +1,219 @@
+import os
+import json
+import sqlite3
+import numpy as np
+
+
+class FaceCatalog:
+    """
+    Local SQLite catalog of the clustering results: one table of images, one of faces (location,
+    encoding, JPEG crop and cluster) and one of clusters, indexed by image path, directory,
+    image and cluster.
+
+    Questions such as "which photos contain cluster 17" or "all faces from this folder" are
+    indexed queries instead of scans of the cluster pickles and face_clusters.csv, and the
+    cluster index, the summary thumbnails and the output stages read their data from here.
+    Clusters are named like their `<name>.pkl` file in cluster_path.
+    """
+
+    def __init__(self, path, dim=128, commit_interval=500):
+        """
+        :param path: Path of the SQLite catalog file, kept outside the directories wiped on every run
+        :param dim: Length of a face encoding
+        :param commit_interval: Number of images added between commits
+        """
+        self.path = path
+        self.dim = dim
+        self.commit_interval = commit_interval
+        self._pending = 0
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS images ("
+            " id INTEGER PRIMARY KEY,"
+            " path TEXT NOT NULL UNIQUE,"
+            " directory TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS clusters ("
+            " id INTEGER PRIMARY KEY,"
+            " name TEXT NOT NULL UNIQUE);"
+            "CREATE TABLE IF NOT EXISTS faces ("
+            " id INTEGER PRIMARY KEY,"
+            " image_id INTEGER NOT NULL REFERENCES images (id),"
+            " location TEXT NOT NULL,"
+            " encoding BLOB NOT NULL,"
+            " crop BLOB,"
+            " cluster_id INTEGER REFERENCES clusters (id));"
+            "CREATE INDEX IF NOT EXISTS images_directory ON images (directory);"
+            "CREATE INDEX IF NOT EXISTS faces_image ON faces (image_id);"
+            "CREATE INDEX IF NOT EXISTS faces_cluster ON faces (cluster_id);")
+        self._connection.commit()
+        self._clusters = dict(self._connection.execute("SELECT name, id FROM clusters"))
+
+    def __len__(self):
+        """Number of faces in the catalog."""
+        return self._connection.execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path)
+
+    def clear(self):
+        """Remove every image, face and cluster, for runs that recluster everything."""
+        with self._connection:
+            self._connection.execute("DELETE FROM faces")
+            self._connection.execute("DELETE FROM clusters")
+            self._connection.execute("DELETE FROM images")
+        self._clusters = {}
+        self._pending = 0
+
+    def add_image(self, file_path, face_locations=(), face_encodings=(), cluster_names=None, face_crops=None):
+        """
+        Record an image and its faces, replacing what was recorded for it before.
+        :param file_path: Path of the image; an image without faces is recorded with no face rows
+        :param face_locations: List of (top, right, bottom, left) tuples
+        :param face_encodings: List of encodings, one per location
+        :param cluster_names: Cluster name of every face, None for faces in no cluster
+        :param face_crops: Optional list of JPEG crops (bytes or None), one per location
+        """
+        image_id = self._image_id(file_path)
+        self._connection.execute("DELETE FROM faces WHERE image_id = ?", (image_id,))
+        cluster_names = cluster_names or [None] * len(face_locations)
+        face_crops = face_crops or [None] * len(face_locations)
+        self._connection.executemany(
+            "INSERT INTO faces (image_id, location, encoding, crop, cluster_id) VALUES (?, ?, ?, ?, ?)",
+            [(image_id, json.dumps([int(value) for value in location]),
+              np.asarray(encoding, dtype=np.float32).tobytes(), crop or None, self._cluster_id(name))
+             for location, encoding, name, crop in zip(face_locations, face_encodings, cluster_names, face_crops)])
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self.commit()
+
+    def add_face_table(self, faces, cluster_names, start=0):
+        """
+        Record the faces of an EncodingStore table from row `start` on, in one transaction.
+        Face ids are the store rows, so set_clusters() can update them after an incremental run.
+        :param faces: FaceTable of the encoding store
+        :param cluster_names: Cluster name of every row of the table, None for faces in no cluster
+        :param start: First row to record; the rows before it are already in the catalog
+        """
+        with self._connection:
+            image_ids = [self._image_id(file_path) for file_path in faces.paths]
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO faces (id, image_id, location, encoding, crop, cluster_id)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                ((row, image_ids[faces.path_ids[row]], json.dumps(faces.location(row)),
+                  np.asarray(faces.encodings[row], dtype=np.float32).tobytes(), faces.crop(row),
+                  self._cluster_id(cluster_names[row]))
+                 for row in range(start, len(faces))))
+        self._pending = 0
+
+    def add_images(self, file_paths):
+        """Record images without faces."""
+        with self._connection:
+            for file_path in file_paths:
+                self._image_id(file_path)
+
+    def set_clusters(self, face_ids, cluster_names):
+        """
+        Move faces to other clusters and drop the clusters left without faces.
+        :param face_ids: Face ids, i.e. store rows for catalogs filled by add_face_table()
+        :param cluster_names: New cluster name of every face, None for no cluster
+        """
+        with self._connection:
+            self._connection.executemany("UPDATE faces SET cluster_id = ? WHERE id = ?",
+                                         [(self._cluster_id(name), int(face_id))
+                                          for face_id, name in zip(face_ids, cluster_names)])
+            self._connection.execute("DELETE FROM clusters WHERE id NOT IN"
+                                     " (SELECT cluster_id FROM faces WHERE cluster_id IS NOT NULL)")
+        self._clusters = dict(self._connection.execute("SELECT name, id FROM clusters"))
+
+    def cluster_names(self):
+        """Names of every cluster, sorted."""
+        return [row[0] for row in self._connection.execute("SELECT name FROM clusters ORDER BY name")]
+
+    def cluster_versions(self):
+        """
+        Version of the members of every cluster, which changes when faces join or leave it.
+        :return: Dict of cluster name -> [face count, sum of face ids]
+        """
+        return {name: [count, id_sum] for name, count, id_sum in self._connection.execute(
+            "SELECT clusters.name, COUNT(*), SUM(faces.id) FROM faces JOIN clusters ON clusters.id = faces.cluster_id"
+            " GROUP BY clusters.id")}
+
+    def cluster_images(self, name):
+        """Paths of the images containing a face of a cluster."""
+        return [row[0] for row in self._connection.execute(
+            "SELECT DISTINCT images.path FROM faces JOIN images ON images.id = faces.image_id"
+            " WHERE faces.cluster_id = ? ORDER BY images.path", (self._clusters.get(name),))]
+
+    def image_clusters(self, file_path):
+        """Cluster name of every face of an image, in face order; None for faces in no cluster."""
+        return [row[0] for row in self._connection.execute(
+            "SELECT clusters.name FROM faces JOIN images ON images.id = faces.image_id"
+            " LEFT JOIN clusters ON clusters.id = faces.cluster_id WHERE images.path = ? ORDER BY faces.id",
+            (os.path.abspath(file_path),))]
+
+    def directory_faces(self, directory):
+        """
+        Faces of the images directly in a directory.
+        :return: List of (image path, location, cluster name or None) tuples
+        """
+        return [(path, tuple(json.loads(location)), name) for path, location, name in self._connection.execute(
+            "SELECT images.path, faces.location, clusters.name FROM images JOIN faces ON faces.image_id = images.id"
+            " LEFT JOIN clusters ON clusters.id = faces.cluster_id WHERE images.directory = ?"
+            " ORDER BY images.path, faces.id", (os.path.abspath(directory),))]
+
+    def cluster_crops(self, name, limit=None):
+        """First `limit` stored JPEG crops of a cluster's faces."""
+        return [row[0] for row in self._connection.execute(
+            "SELECT crop FROM faces WHERE cluster_id = ? AND crop IS NOT NULL ORDER BY id LIMIT ?",
+            (self._clusters.get(name), -1 if limit is None else limit))]
+
+    def cluster_encodings(self, names=None):
+        """
+        Encodings of the faces of clusters.
+        :param names: Cluster names, every cluster if None
+        :return: Tuple (encodings of shape (n, dim) float32, cluster name of every row)
+        """
+        if names is None:
+            rows = self._connection.execute(
+                "SELECT clusters.name, faces.encoding FROM faces JOIN clusters ON clusters.id = faces.cluster_id"
+                " ORDER BY clusters.name, faces.id").fetchall()
+        else:
+            rows = [(name, encoding) for name in names for (encoding,) in self._connection.execute(
+                "SELECT encoding FROM faces WHERE cluster_id = ? ORDER BY id", (self._clusters.get(name),))]
+        encodings = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.float32).reshape(-1, self.dim)
+        return encodings, [row[0] for row in rows]
+
+    def commit(self):
+        self._connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._connection.close()
+
+    def _image_id(self, file_path):
+        file_path = os.path.abspath(file_path)
+        self._connection.execute("INSERT OR IGNORE INTO images (path, directory) VALUES (?, ?)",
+                                 (file_path, os.path.dirname(file_path)))
+        return self._connection.execute("SELECT id FROM images WHERE path = ?", (file_path,)).fetchone()[0]
+
+    def _cluster_id(self, name):
+        if name is None:
+            return None
+        name = str(name)
+        if name not in self._clusters:
+            self._clusters[name] = self._connection.execute(
+                "INSERT INTO clusters (name) VALUES (?)", (name,)).lastrowid
+        return self._clusters[name]
+
+
+def label_names(labels):
+    """
+    Cluster names of the labels of a clustering run, as used for the `face_<label>` directories
+    and pickles; -1 (noise) has no cluster.
+    :param labels: Cluster label of every face
+    :return: List of names, None for noise
+    """
+    return [f"face_{label}" if label >= 0 else None for label in np.asarray(labels).tolist()]
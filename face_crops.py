@@ -0,0 +1,86 @@
+import io
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def encode_face_crop(image, location, max_edge=None, rgb=True, quality=90):
+    """
+    Cut a face out of a decoded image and compress it as JPEG.
+    :param image: Image array, RGB as loaded by face_recognition or BGR as loaded by cv2
+    :param location: (top, right, bottom, left) face location
+    :param max_edge: Maximum longest side of the crop in pixels, None keeps the original size
+    :param rgb: Whether image is RGB (cv2 encodes BGR)
+    :param quality: JPEG quality
+    :return: JPEG bytes, or None for an empty crop
+    """
+    top, right, bottom, left = location
+    crop = image[max(top, 0):bottom, max(left, 0):right]
+    if crop.size == 0:
+        return None
+    if rgb:
+        crop = cv2.cvtColor(crop, cv2.COLOR_RGB2BGR)
+    long_edge = max(crop.shape[:2])
+    if max_edge is not None and long_edge > max_edge:
+        factor = max_edge / long_edge
+        crop = cv2.resize(crop, (max(round(crop.shape[1] * factor), 1), max(round(crop.shape[0] * factor), 1)),
+                          interpolation=cv2.INTER_AREA)
+    ok, data = cv2.imencode('.jpg', crop, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return data.tobytes() if ok else None
+
+
+def read_image(image_path):
+    """Decode an image with cv2 (BGR), also for paths with non-ASCII characters; None on failure."""
+    try:
+        return cv2.imdecode(np.fromfile(image_path, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except (OSError, ValueError, cv2.error):
+        return None
+
+
+def iter_face_crops(faces, rows, max_edge=None):
+    """
+    Yield the JPEG crop of every requested face, decoding each source image at most once.
+    Crops stored with the encodings are used as they are; the remaining faces are grouped by
+    source image, so a group photo is decoded once for all of its faces.
+    :param faces: FaceTable of the encoding store
+    :param rows: Rows of the faces to crop
+    :param max_edge: Maximum longest side of crops cut from the original images
+    :return: Generator of (row, JPEG bytes or None if the image could not be loaded)
+    """
+    missing = []
+    for row in rows:
+        crop = faces.crop(row)
+        if crop is not None:
+            yield row, crop
+        else:
+            missing.append(row)
+
+    missing = np.asarray(missing, dtype=np.int64)
+    path_ids = np.asarray(faces.path_ids)[missing]
+    order = np.argsort(path_ids, kind='stable')
+    missing, path_ids = missing[order], path_ids[order]
+    for group in np.split(np.arange(len(missing)), np.flatnonzero(np.diff(path_ids)) + 1):
+        if len(group) == 0:
+            continue
+        image = read_image(faces.image_path(missing[group[0]]))
+        for row in missing[group]:
+            yield int(row), None if image is None else encode_face_crop(image, faces.location(row), max_edge,
+                                                                        rgb=False)
+
+
+def crop_grid(crops, thumbnail_size=(100, 100), grid_size=(3, 3)):
+    """
+    Lay out face crops as a summary grid, without decoding the original images.
+    :param crops: JPEG bytes of the faces, only the first rows x columns are used
+    :param thumbnail_size: Size of each grid cell
+    :param grid_size: Layout of the grid (rows, columns)
+    :return: PIL Image
+    """
+    summary_image = Image.new("RGB", (grid_size[1] * thumbnail_size[0], grid_size[0] * thumbnail_size[1]), "white")
+    for index, crop in enumerate(crops[:grid_size[0] * grid_size[1]]):
+        face_pil = Image.open(io.BytesIO(crop)).convert("RGB")
+        face_pil.thumbnail(thumbnail_size)
+        x_offset = (index % grid_size[1]) * thumbnail_size[0]
+        y_offset = (index // grid_size[1]) * thumbnail_size[1]
+        summary_image.paste(face_pil, (x_offset, y_offset))
+    return summary_image
@@ -1,11 +1,209 @@
-def get_face(image, face_recognition):
+import time
+import cv2
+import numpy as np
+
+# Smallest face side, in detection-image pixels, that HOG finds without upsampling
+HOG_MIN_FACE = 80
+# Tiered detection escalates to CNN when the smallest face HOG found is below this many HOG_MIN_FACE,
+# as faces near the limit suggest smaller ones were missed, or when the image is this dark (mean 0-255)
+SMALL_FACE_RATIO = 1.5
+LOW_LIGHT_MEAN = 50
+# Smallest downscale the CNN pass may use to fit the time budget before it is skipped
+MIN_BUDGET_FACTOR = 0.25
+# CNN cost per detection-image pixel assumed before this process measured one: the CNN detector with one
+# upsampling runs at about 3 s per megapixel on a CPU, so the first pass is downscaled as if it were slow
+CNN_SECONDS_PER_PIXEL_PRIOR = 3e-6
+# Running estimate of the CNN cost per pixel in this process, used to fit the CNN pass into the budget
+_cnn_seconds_per_pixel = None
+
+
+def tier_settings(time_budget=None):
+    """
+    Settings that decide what tiered detection finds, for cache and journal keys.
+    :param time_budget: Seconds per image for tiered detection, None for no limit
+    :return: Dict of the settings
+    """
+    return {"time_budget": time_budget, "hog_min_face": HOG_MIN_FACE, "small_face_ratio": SMALL_FACE_RATIO,
+            "low_light_mean": LOW_LIGHT_MEAN, "min_budget_factor": MIN_BUDGET_FACTOR}
+
+
+def detection_factor(image_shape, max_long_edge=None, scale=None):
+    """
+    Compute the factor used to downscale an image before face detection.
+    :param image_shape: Shape of the image matrix
+    :param max_long_edge: Maximum length in pixels of the longest image side, None for no limit
+    :param scale: Fixed downscale factor, takes precedence over max_long_edge
+    :return: Factor in (0, 1], 1 meaning detection runs at full resolution
+    """
+    if scale is not None:
+        return min(float(scale), 1.0)
+    if max_long_edge is not None:
+        return min(max_long_edge / max(image_shape[:2]), 1.0)
+    return 1.0
+
+
+def scale_locations(locations, factor, image_shape):
+    """
+    Map face locations found on a resized image back to the coordinates of the original image.
+    :param locations: List of (top, right, bottom, left) tuples
+    :param factor: Ratio between the original and the resized image sizes
+    :param image_shape: Shape of the original image matrix, used to clamp the boxes
+    :return: List of (top, right, bottom, left) tuples in original image coordinates
+    """
+    height, width = image_shape[:2]
+    scaled = []
+    for top, right, bottom, left in locations:
+        scaled.append((max(int(round(top * factor)), 0),
+                       min(int(round(right * factor)), width),
+                       min(int(round(bottom * factor)), height),
+                       max(int(round(left * factor)), 0)))
+    return scaled
+
+
+def _overlaps(box, other, min_iou=0.3):
+    top, right, bottom, left = box
+    other_top, other_right, other_bottom, other_left = other
+    width = min(right, other_right) - max(left, other_left)
+    height = min(bottom, other_bottom) - max(top, other_top)
+    if width <= 0 or height <= 0:
+        return False
+    intersection = width * height
+    union = (right - left) * (bottom - top) + (other_right - other_left) * (other_bottom - other_top) - intersection
+    return intersection >= min_iou * union
+
+
+def needs_escalation(image, locations):
+    """
+    Whether a HOG pass probably missed faces: it found none, the smallest face it found is close to
+    the smallest size HOG can find (crowds and far-away groups), or the scene is too dark for HOG.
+    :param image: Detection image matrix
+    :param locations: Boxes found by HOG without upsampling
+    :return: True if the CNN detector should look at the image
+    """
+    if not locations:
+        return True
+    if min(bottom - top for top, _, bottom, _ in locations) < SMALL_FACE_RATIO * HOG_MIN_FACE:
+        return True
+    return float(np.mean(image[::8, ::8])) < LOW_LIGHT_MEAN
+
+
+def tiered_face_locations(image, face_recognition, time_budget=None, timings=None):
+    """
+    Detect faces with HOG without upsampling first, and with the CNN detector only when
+    needs_escalation() says HOG probably missed faces. CNN boxes replace overlapping HOG boxes.
+    The CNN pass runs on a copy downscaled to fit what is left of the time budget (estimated from
+    the earlier CNN passes of this process, or from CNN_SECONDS_PER_PIXEL_PRIOR before the first one),
+    and is skipped if that would take more than a 1/4 downscale.
+    :param image: Detection image matrix
+    :param face_recognition: object of face recognition library
+    :param time_budget: Seconds per image for both passes, None for no limit
+    :param timings: Optional dict receiving the CNN seconds as "escalate" and the count as "escalations"
+    :return: List of (top, right, bottom, left) tuples in image coordinates
+    """
+    global _cnn_seconds_per_pixel
+    tic = time.perf_counter()
+    locations = face_recognition.face_locations(image, 0, "hog")
+    if not needs_escalation(image, locations):
+        return locations
+
+    height, width = image.shape[:2]
+    factor = 1.0
+    if time_budget is not None:
+        seconds_per_pixel = CNN_SECONDS_PER_PIXEL_PRIOR if _cnn_seconds_per_pixel is None else _cnn_seconds_per_pixel
+        remaining = time_budget - (time.perf_counter() - tic)
+        expected = seconds_per_pixel * height * width
+        if expected > remaining:
+            factor = np.sqrt(max(remaining, 0.0) / expected)
+            if factor < MIN_BUDGET_FACTOR:
+                return locations
+
+    tic = time.perf_counter()
+    cnn_image = image
+    if factor < 1.0:
+        cnn_image = cv2.resize(image, (max(int(width * factor), 1), max(int(height * factor), 1)),
+                               interpolation=cv2.INTER_AREA)
+    cnn_locations = face_recognition.face_locations(cnn_image, 1, "cnn")
+    if factor < 1.0:
+        cnn_locations = scale_locations(cnn_locations, width / cnn_image.shape[1], image.shape)
+    seconds = time.perf_counter() - tic
+    # Smoothed, so one unusual image doesn't decide the downscale of the next ones
+    cost = seconds / (cnn_image.shape[0] * cnn_image.shape[1])
+    _cnn_seconds_per_pixel = cost if _cnn_seconds_per_pixel is None else 0.8 * _cnn_seconds_per_pixel + 0.2 * cost
+    if timings is not None:
+        timings["escalate"] = timings.get("escalate", 0.0) + seconds
+        timings["escalations"] = timings.get("escalations", 0) + 1
+    missed_by_cnn = [box for box in locations if not any(_overlaps(box, other) for other in cnn_locations)]
+    return list(cnn_locations) + missed_by_cnn
+
+
+def _face_locations(image, face_recognition, number_of_times_to_upsample, model, time_budget, timings):
+    if model == "tiered":
+        return tiered_face_locations(image, face_recognition, time_budget, timings)
+    return face_recognition.face_locations(image, number_of_times_to_upsample, model)
+
+
+def detect_face_locations(image, face_recognition, model="hog", max_long_edge=None, scale=None,
+                          number_of_times_to_upsample=1, time_budget=None, timings=None):
+    """
+    Detect faces on a downscaled copy of the image and return full-resolution boxes.
+    :param image: Image matrix
+    :param face_recognition: object of face recognition library
+    :param model: Face detection model, "hog", "cnn" or "tiered" (see tiered_face_locations)
+    :param max_long_edge: Maximum longest side of the detection image, None for no limit
+    :param scale: Fixed downscale factor, takes precedence over max_long_edge
+    :param number_of_times_to_upsample: Upsampling passed to the detector (tiered detection sets its own)
+    :param time_budget: Seconds per image for tiered detection, None for no limit
+    :param timings: Optional dict receiving the escalation time and count of tiered detection
+    :return: List of (top, right, bottom, left) tuples in original image coordinates
+    """
+    factor = detection_factor(image.shape, max_long_edge, scale)
+    if factor >= 1.0:
+        return _face_locations(image, face_recognition, number_of_times_to_upsample, model, time_budget, timings)
+
+    height, width = image.shape[:2]
+    small_image = cv2.resize(image, (max(int(width * factor), 1), max(int(height * factor), 1)),
+                             interpolation=cv2.INTER_AREA)
+    locations = _face_locations(small_image, face_recognition, number_of_times_to_upsample, model, time_budget,
+                                timings)
+    return scale_locations(locations, width / small_image.shape[1], image.shape)
+
+
+def detect_face_locations_reduced(image, full_shape, face_recognition, model="hog", max_long_edge=None,
+                                  scale=None, number_of_times_to_upsample=1, time_budget=None, timings=None):
+    """
+    Detect faces on an image that was already decoded below full resolution.
+    :param image: Reduced image matrix, e.g. from face_loading.loading_face_reduced
+    :param full_shape: Shape of the original full-resolution image
+    :param face_recognition: object of face recognition library
+    :param model: Face detection model, "hog", "cnn" or "tiered"
+    :param max_long_edge: Maximum longest side of the detection image, relative to the original
+    :param scale: Fixed downscale factor relative to the original, takes precedence over max_long_edge
+    :param number_of_times_to_upsample: Upsampling passed to the detector
+    :param time_budget: Seconds per image for tiered detection, None for no limit
+    :param timings: Optional dict receiving the escalation time and count of tiered detection
+    :return: List of (top, right, bottom, left) tuples in original image coordinates
+    """
+    decode_factor = full_shape[1] / image.shape[1]
+    # The decoder only reduces by powers of two, so finish the downscale to the requested size
+    remaining = detection_factor(full_shape, max_long_edge, scale) * decode_factor
+    locations = detect_face_locations(image, face_recognition, model=model, scale=remaining,
+                                      number_of_times_to_upsample=number_of_times_to_upsample,
+                                      time_budget=time_budget, timings=timings)
+    if decode_factor == 1.0:
+        return locations
+    return scale_locations(locations, decode_factor, full_shape)
+
+
+def get_face(image, face_recognition, max_long_edge=None, scale=None):
     """
     Face Detection
     :param image: Image matrix
     :param face_recognition: object of face recognition library
+    :param max_long_edge: Maximum longest side of the detection image, None for no limit
+    :param scale: Fixed downscale factor for detection
     :return: Image matrix of face
     """
-    locations = face_recognition.face_locations(image)
+    locations = detect_face_locations(image, face_recognition, max_long_edge=max_long_edge, scale=scale)
     if len(locations) > 0:
         # handle only one face and return face with large area
         face_area = 0
@@ -1,16 +1,71 @@
-def get_face_encoding(image, face_recognition):
+import numpy as np
+from face_detection import detect_face_locations
+
+try:
+    import dlib
+except ImportError:
+    dlib = None
+
+# dlib's ResNet encoder works on 150 x 150 aligned chips with 25% padding around the landmarks
+CHIP_SIZE = 150
+CHIP_PADDING = 0.25
+
+
+def batch_encoding_supported(face_recognition):
+    """Whether the dlib models behind face_recognition can be driven directly for batched encoding."""
+    return dlib is not None and hasattr(getattr(face_recognition, 'api', None), 'face_encoder')
+
+
+def face_chips(image, face_locations, face_recognition):
+    """
+    Align every face of an image the way dlib's encoder does, so the chips of many images can be
+    encoded in one batch.
+    :param image: RGB image
+    :param face_locations: List of (top, right, bottom, left) tuples
+    :param face_recognition: The face recognition library
+    :return: List of CHIP_SIZE x CHIP_SIZE RGB chips, one per location
+    """
+    # The 5-point landmarks are the ones face_recognition.face_encodings uses by default
+    landmarks = face_recognition.api._raw_face_landmarks(image, face_locations, model="small")
+    return [dlib.get_face_chip(image, shape, size=CHIP_SIZE, padding=CHIP_PADDING) for shape in landmarks]
+
+
+def encode_face_chips(chips, face_recognition, batch_size=256):
+    """
+    Encode aligned face chips with dlib's batched compute_face_descriptor.
+    Matches face_recognition.face_encodings (no jittering) without its per-face Python overhead,
+    and runs one network pass per batch.
+    :param chips: List of chips from face_chips(), possibly from many images
+    :param face_recognition: The face recognition library
+    :param batch_size: Maximum number of chips per network pass
+    :return: Contiguous float32 array of shape (len(chips), 128)
+    """
+    encodings = np.empty((len(chips), 128), dtype=np.float32)
+    for start in range(0, len(chips), batch_size):
+        descriptors = face_recognition.api.face_encoder.compute_face_descriptor(chips[start:start + batch_size])
+        encodings[start:start + len(descriptors)] = [np.asarray(descriptor) for descriptor in descriptors]
+    return encodings
+
+
+def get_face_encoding(image, face_recognition, max_long_edge=None, scale=None):
     """
     Generate face encodings from the original image with face locations detected.
     :param image: The original image
     :param face_recognition: The face recognition library
+    :param max_long_edge: Maximum longest side of the detection image, None for no limit
+    :param scale: Fixed downscale factor for detection
     :return: List of face encodings, or None if no faces are found
     """
-    # Detect face locations in the original image
-    face_locations = face_recognition.face_locations(image)
+    # Detect face locations, possibly on a downscaled copy, in original image coordinates
+    face_locations = detect_face_locations(image, face_recognition, max_long_edge=max_long_edge, scale=scale)
 
     # Proceed only if there are detected face locations
     if face_locations:
-        # Generate face encodings based on detected locations
-        face_encodings = face_recognition.face_encodings(image, known_face_locations=face_locations)
+        # Generate face encodings from the full-resolution pixels, all faces in one batch
+        if batch_encoding_supported(face_recognition):
+            face_encodings = list(encode_face_chips(face_chips(image, face_locations, face_recognition),
+                                                    face_recognition))
+        else:
+            face_encodings = face_recognition.face_encodings(image, known_face_locations=face_locations)
         return face_encodings if face_encodings else None
     return None
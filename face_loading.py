@@ -1,6 +1,7 @@
 from PIL import Image
 import numpy as np
 import face_recognition
+from face_detection import detection_factor
 
 
 def loading_face(file_path, face_recognition_module):
@@ -20,3 +21,32 @@ def loading_face(file_path, face_recognition_module):
     except Exception as e:
         print(f"Error loading image {file_path}: {e}")
         return None
+
+
+def loading_face_reduced(file_path, max_long_edge=None, scale=None):
+    """
+    Loads an image decoded straight at (or just above) the face detection resolution.
+    JPEGs are downscaled in the DCT domain by PIL's draft mode, so the full-resolution
+    pixels are never materialized; other formats are decoded at full size.
+
+    Parameters:
+    - file_path: Path to the image file.
+    - max_long_edge: Maximum longest side of the detection image, None for full resolution.
+    - scale: Fixed detection downscale factor, takes precedence over max_long_edge.
+
+    Returns:
+    - Tuple (image, full_shape): the RGB numpy array and the (height, width) of the original
+      image, or (None, None) if the image could not be loaded.
+    """
+    try:
+        with Image.open(file_path) as img:
+            width, height = img.size
+            factor = detection_factor((height, width), max_long_edge, scale)
+            if factor < 1.0:
+                # draft() only picks among the 1/2, 1/4 and 1/8 JPEG scales that stay at or above the request
+                img.draft('RGB', (max(int(width * factor), 1), max(int(height * factor), 1)))
+            image = np.array(img.convert('RGB'))
+        return image, (height, width)
+    except Exception as e:
+        print(f"Error loading image {file_path}: {e}")
+        return None, None
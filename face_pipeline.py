@@ -0,0 +1,518 @@
+import io
+import time
+import queue
+import threading
+from collections import deque, Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+import face_recognition
+from face_loading import loading_face, loading_face_reduced
+from face_detection import detect_face_locations, detect_face_locations_reduced, tier_settings
+from encoding_cache import EncodingCache
+from face_crops import encode_face_crop
+from face_encoding import batch_encoding_supported, face_chips, encode_face_chips
+from metrics import peak_rss_bytes, peak_child_rss_bytes
+
+
+class StageStats:
+    """Throughput counters of one pipeline stage; safe to update from several threads."""
+
+    def __init__(self, name, parallelism=1):
+        self.name = name
+        self.parallelism = max(parallelism, 1)
+        self.items = 0
+        self.busy = 0.0  # seconds spent working, summed over the stage's threads or processes
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds, items=1, nbytes=0):
+        with self._lock:
+            self.busy += seconds
+            self.items += items
+            self.bytes += nbytes
+
+
+class PipelineStats:
+    """Per-stage timers and run-wide counters of a pipeline run, used to find the bottleneck stage."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.worker_pool = False  # whether a process pool ran, i.e. whether a worker peak RSS means anything
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def stage(self, name, parallelism=1):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = StageStats(name, parallelism)
+            return self.stages[name]
+
+    def count(self, name, value=1):
+        """Add to a run-wide counter such as "images" or "faces"."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name, items=1):
+        """Time the enclosed block as one item of a stage, e.g. `with stats.timer("cluster"):`."""
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage(name).add(time.perf_counter() - tic, items)
+
+    def summary(self):
+        """
+        Machine-readable totals: counters with their rate, and per stage the items, busy time,
+        milliseconds per item, bytes and utilization, plus the peak RSS of this process and, when a
+        process pool ran, of its largest finished worker process.
+        :return: JSON-serializable dict
+        """
+        wall = max(time.perf_counter() - self.started, 1e-9)
+        stages = {}
+        for stage in list(self.stages.values()):
+            stages[stage.name] = {"items": stage.items, "busy_seconds": stage.busy, "bytes": stage.bytes,
+                                  "ms_per_item": 1000 * stage.busy / stage.items if stage.items else 0.0,
+                                  "items_per_second": stage.items / wall,
+                                  "utilization": stage.busy / (wall * stage.parallelism)}
+        return {"wall_seconds": wall,
+                "counters": dict(self.counters),
+                "rates": {f"{name}_per_second": value / wall for name, value in self.counters.items()},
+                "stages": stages,
+                "bottleneck": max(stages, key=lambda name: stages[name]["utilization"]) if stages else None,
+                "peak_rss_bytes": peak_rss_bytes(),
+                "peak_child_rss_bytes": peak_child_rss_bytes() if self.worker_pool else None}
+
+    def report(self):
+        """
+        Summarize every stage: items, items per second of wall time and utilization, i.e. the
+        share of its threads' wall time spent busy. The busiest stage is the bottleneck.
+        :return: Report text
+        """
+        wall = max(time.perf_counter() - self.started, 1e-9)
+        lines = [f"{'stage':<10} {'items':>8} {'items/s':>9} {'ms/item':>9} {'MB/s':>8} {'busy':>7}"]
+        utilization = {}
+        for stage in list(self.stages.values()):
+            utilization[stage.name] = stage.busy / (wall * stage.parallelism)
+            ms_per_item = 1000 * stage.busy / stage.items if stage.items else 0.0
+            lines.append(f"{stage.name:<10} {stage.items:>8} {stage.items / wall:>9.2f} {ms_per_item:>9.1f} "
+                         f"{stage.bytes / wall / 1e6:>8.2f} {utilization[stage.name]:>7.1%}")
+        for name, value in self.counters.items():
+            lines.append(f"{name}: {value} ({value / wall:.2f}/s)")
+        rss, child_rss = peak_rss_bytes(), peak_child_rss_bytes() if self.worker_pool else None
+        if rss is not None:
+            lines.append(f"Peak RSS: {rss / 2 ** 20:.0f} MiB")
+        if child_rss is not None:
+            lines.append(f"Peak RSS of a worker process: {child_rss / 2 ** 20:.0f} MiB")
+        if utilization:
+            lines.append(f"Bottleneck: {max(utilization, key=utilization.get)}")
+        return "\n".join(lines)
+
+
+class AsyncWriter:
+    """
+    Output stage: runs file copies, moves and CSV writes on a background thread.
+    A single thread keeps writes in submission order; the bounded queue applies backpressure.
+    """
+
+    def __init__(self, max_pending=256, stats=None):
+        """
+        :param max_pending: Maximum number of queued writes before submit() blocks
+        :param stats: Optional PipelineStats receiving a "write" stage
+        """
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stats = stats.stage("write") if stats is not None else None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue function(*args, **kwargs) to run on the writer thread."""
+        self._queue.put((function, args, kwargs))
+
+    def close(self):
+        """Wait for every queued write to finish."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            function, args, kwargs = task
+            tic = time.perf_counter()
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                print(f"Error writing output with {getattr(function, '__name__', function)}{args}: {e}")
+            if self._stats is not None:
+                self._stats.add(time.perf_counter() - tic)
+
+
+def ordered_map(function, items, threads, max_in_flight):
+    """
+    Apply function to items on a thread pool, yielding results in input order.
+    At most max_in_flight items are submitted ahead of the consumer.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(executor.submit(function, item))
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+class _Duplicate:
+    """Placeholder for a near-duplicate file in encode_files; it takes the result of its leader."""
+
+    def __init__(self, leader):
+        self.leader = leader
+        self.file_path = None
+
+
+def _lap(timings, stage, since):
+    # Add the time elapsed since `since` to a sub-stage and restart the clock
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0.0) + now - since
+    return now
+
+
+def _load_and_detect(file_path, data, model, max_long_edge, scale, time_budget, timings):
+    # Returns (image, face_locations); image is None if the file could not be loaded
+    # Each decode gets a fresh stream, as a face image may be decoded twice
+    source = (lambda: io.BytesIO(data)) if data is not None else (lambda: file_path)
+    clock = time.perf_counter()
+    if max_long_edge is None and scale is None:
+        image = loading_face(source(), face_recognition)
+        clock = _lap(timings, "decode", clock)
+        if image is None:
+            return None, None
+        face_locations = detect_face_locations(image, face_recognition, model=model, time_budget=time_budget,
+                                               timings=timings)
+        _lap(timings, "detect", clock)
+        return image, face_locations
+
+    # Decode JPEGs directly at the detection size; boxes come back in full-resolution coordinates
+    image, full_shape = loading_face_reduced(source(), max_long_edge, scale)
+    clock = _lap(timings, "decode", clock)
+    if image is None:
+        return None, None
+    face_locations = detect_face_locations_reduced(image, full_shape, face_recognition, model=model,
+                                                   max_long_edge=max_long_edge, scale=scale,
+                                                   time_budget=time_budget, timings=timings)
+    clock = _lap(timings, "detect", clock)
+    # Images without faces are never decoded at full resolution
+    if face_locations and image.shape[:2] != full_shape:
+        image = loading_face(source(), face_recognition)
+        _lap(timings, "decode", clock)
+    return image, face_locations
+
+
+def encode_file_batch(files, model="hog", max_long_edge=None, scale=None, crops=False, crop_max_edge=None,
+                      time_budget=None, timings=None):
+    """
+    Load several images, detect their faces and compute all encodings in one batch.
+    Every image is decoded, detected and aligned on its own; the aligned face chips of all images
+    then go through dlib's encoder together (see face_encoding.encode_face_chips), which saves the
+    per-face overhead on images with many small faces. Falls back to per-image
+    face_recognition.face_encodings when the dlib models cannot be driven directly.
+    Runs inside pool workers, so it only takes picklable arguments and never raises.
+
+    Parameters:
+    - files: List of (file_path, data) pairs; data holds the contents of the file if they were
+      already read, e.g. by the prefetching reader, and None otherwise.
+    - model: Face detection model, "hog", "cnn" or "tiered" (HOG first, CNN where HOG probably missed faces).
+    - max_long_edge: Maximum longest side of the detection image, None for full resolution.
+    - scale: Fixed downscale factor for detection, takes precedence over max_long_edge.
+    - crops: Whether to also return a JPEG crop of every face, cut from the decoded image.
+    - crop_max_edge: Maximum longest side of the crops, None keeps the detected size.
+    - time_budget: Seconds per image for tiered detection, None for no limit.
+    - timings: Optional dict receiving the seconds spent per sub-stage ("decode", "detect", "align",
+      "encode", "crop", and "escalate" for the CNN passes of tiered detection, part of "detect"),
+      summed over the batch, and the number of "escalations".
+
+    Returns:
+    - List of tuples (file_path, face_locations, face_encodings, face_crops, error), one per file in
+      order. face_locations is None if the image could not be loaded or processed; error holds the
+      message in the latter case. face_crops is None unless crops were requested.
+    """
+    timings = timings if timings is not None else {}
+    batched = batch_encoding_supported(face_recognition)
+    results = [None] * len(files)
+    pending = []  # (index, face_locations, chips, face_crops) of the images waiting for the batched encoder
+    for index, (file_path, data) in enumerate(files):
+        try:
+            image, face_locations = _load_and_detect(file_path, data, model, max_long_edge, scale, time_budget,
+                                                     timings)
+            if image is None:
+                results[index] = (file_path, None, None, None, None)
+                continue
+            if not face_locations:
+                results[index] = (file_path, [], [], [] if crops else None, None)
+                continue
+
+            # Crops are cut while the image is decoded, so the output stage never decodes it again
+            clock = time.perf_counter()
+            face_crops = None
+            if crops:
+                face_crops = [encode_face_crop(image, location, crop_max_edge) for location in face_locations]
+                clock = _lap(timings, "crop", clock)
+            # Encodings are always computed from the full-resolution pixels
+            if batched:
+                pending.append((index, face_locations, face_chips(image, face_locations, face_recognition),
+                                face_crops))
+                _lap(timings, "align", clock)
+            else:
+                face_encodings = face_recognition.face_encodings(image, face_locations)
+                _lap(timings, "encode", clock)
+                results[index] = (file_path, face_locations, face_encodings, face_crops, None)
+        except Exception as e:
+            results[index] = (file_path, None, None, None, str(e))
+
+    if pending:
+        clock = time.perf_counter()
+        try:
+            encodings = encode_face_chips([chip for _, _, chips, _ in pending for chip in chips], face_recognition)
+            _lap(timings, "encode", clock)
+        except Exception as e:
+            for index, _, _, _ in pending:
+                results[index] = (files[index][0], None, None, None, str(e))
+            return results
+        offset = 0
+        for index, face_locations, chips, face_crops in pending:
+            face_encodings = list(encodings[offset:offset + len(chips)])
+            offset += len(chips)
+            results[index] = (files[index][0], face_locations, face_encodings, face_crops, None)
+    return results
+
+
+def encode_file(file_path, model="hog", max_long_edge=None, scale=None, data=None, crops=False, crop_max_edge=None,
+                time_budget=None, timings=None):
+    """
+    Load an image, detect its faces and compute their encodings.
+    A batch of one for encode_file_batch; see there for the parameters.
+
+    Returns:
+    - Tuple (file_path, face_locations, face_encodings, face_crops, error).
+    """
+    return encode_file_batch([(file_path, data)], model, max_long_edge, scale, crops, crop_max_edge, time_budget,
+                             timings)[0]
+
+
+def _timed_encode_batch(*args):
+    tic = time.perf_counter()
+    timings = {}
+    results = encode_file_batch(*args, timings=timings)
+    return results, time.perf_counter() - tic, timings
+
+
+def encode_files(file_paths, workers=1, model="hog", max_long_edge=None, scale=None, cache=None,
+                 max_in_flight=None, read_threads=0, stats=None, crops=False, crop_max_edge=None, batch_files=8,
+                 duplicates=None, time_budget=None):
+    """
+    Encode many files as a staged pipeline: a prefetching reader, the compute stage
+    (optionally fanned out to a process pool) and the caller consuming the results.
+    Results are yielded in the order of file_paths regardless of which worker finishes first,
+    so callers can checkpoint on the number of files consumed.
+
+    Parameters:
+    - file_paths: Iterable of image paths.
+    - workers: Number of worker processes; 1 or less runs everything in the calling process.
+    - model: Face detection model, "hog", "cnn" or "tiered" (see face_detection.tiered_face_locations).
+    - max_long_edge: Maximum longest side of the detection image, None for full resolution.
+    - scale: Fixed downscale factor for detection.
+    - cache: Optional EncodingCache; files with an entry for these settings are not decoded again.
+    - max_in_flight: Maximum number of submitted but not yet consumed files
+      (default max(4, 2 * batch_files) per worker).
+    - read_threads: Number of threads reading files ahead of the compute stage, 0 to read in the compute stage.
+    - stats: Optional PipelineStats receiving "read", "cache" and "compute" stage timers, the
+      "decode", "detect", "escalate", "align", "encode" and "crop" sub-stages of compute, and "images",
+      "faces", "duplicates" and "escalations" counts.
+    - crops: Whether to also return a JPEG crop of every face (see encode_file_batch).
+    - crop_max_edge: Maximum longest side of the crops.
+    - batch_files: Number of consecutive uncached files encoded together in one batch
+      (see encode_file_batch); 1 encodes every file on its own.
+    - duplicates: Optional dict sibling path -> leader path from near_duplicates.find_near_duplicates.
+      A sibling that comes after its leader is neither read nor encoded; it gets the leader's
+      faces, encodings and crops.
+    - time_budget: Seconds per image for tiered detection, None for no limit.
+
+    Yields:
+    - Tuples (file_path, face_locations, face_encodings, face_crops, error) as returned by encode_file.
+    """
+    settings = EncodingCache.settings_key(model, max_long_edge, scale, crop_max_edge if crops else None,
+                                          tier_settings(time_budget))
+    stats = stats if stats is not None else PipelineStats()
+    read_stats = stats.stage("read", read_threads)
+    cache_stats = stats.stage("cache")
+    compute_stats = stats.stage("compute", workers)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    stats.worker_pool = stats.worker_pool or executor is not None
+    batch_files = max(batch_files, 1)
+    max_in_flight = (max_in_flight or workers * max(4, 2 * batch_files)) if executor is not None else batch_files
+
+    duplicates = duplicates or {}
+    file_paths = list(file_paths)
+    # Siblings reuse the result of a leader scheduled before them; the others are encoded themselves.
+    # Counting only those keeps each leader's result just until its last scheduled sibling
+    siblings_left = Counter()
+    scheduled = set()
+    for file_path in file_paths:
+        leader = duplicates.get(file_path)
+        if leader in scheduled:
+            siblings_left[leader] += 1
+        scheduled.add(file_path)
+    del scheduled
+    leader_results = {}  # results of leaders kept until their last sibling is yielded
+
+    def lookup():
+        seen = set()
+        for file_path in file_paths:
+            leader = duplicates.get(file_path)
+            if leader is not None and leader in seen:
+                yield file_path, None, _Duplicate(leader)
+                continue
+            if file_path in siblings_left:
+                seen.add(file_path)
+            file_key, cached = None, None
+            if cache is not None:
+                tic = time.perf_counter()
+                try:
+                    file_key = cache.file_key(file_path)
+                    cached = cache.get(file_key, settings)
+                    # Entries stored before crops were kept are encoded again when crops are needed
+                    if crops and cached is not None and cached[2] is None:
+                        cached = None
+                except OSError:
+                    file_key = None
+                cache_stats.add(time.perf_counter() - tic)
+            yield file_path, file_key, cached
+
+    def read(item):
+        # Cache hits are not read; unreadable files are left for encode_file to report
+        file_path, file_key, cached = item
+        if cached is not None:
+            return file_path, file_key, cached, None
+        tic = time.perf_counter()
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = None
+        read_stats.add(time.perf_counter() - tic, nbytes=len(data) if data is not None else 0)
+        return file_path, file_key, cached, data
+
+    if read_threads > 0:
+        # The read-ahead depth bounds memory: at most this many file contents are held at once
+        items = ordered_map(read, lookup(), read_threads, max_in_flight + 2 * read_threads)
+    else:
+        items = ((file_path, file_key, cached, None) for file_path, file_key, cached in lookup())
+
+    def record(seconds, timings, results):
+        # Per-image stages count images; aligning, encoding and cropping count faces
+        compute_stats.add(seconds, items=len(results))
+        faces = sum(len(result[1] or []) for result in results)
+        # The CNN passes of tiered detection count the images that escalated
+        escalations = timings.pop("escalations", 0)
+        if escalations:
+            stats.count("escalations", escalations)
+        for name, stage_seconds in timings.items():
+            if name == "escalate":
+                items = escalations
+            elif name in ("align", "encode", "crop"):
+                items = faces
+            else:
+                items = len(results)
+            stats.stage(name, workers).add(stage_seconds, items=items)
+
+    def resolve(duplicate):
+        # The leader came earlier in the order, so its result is already known
+        leader = duplicate.leader
+        _, face_locations, face_encodings, face_crops, error = leader_results[leader]
+        siblings_left[leader] -= 1
+        if siblings_left[leader] == 0:
+            del leader_results[leader]
+        stats.count("duplicates")
+        stats.count("faces", len(face_locations or []))
+        return duplicate.file_path, face_locations, face_encodings, face_crops, error
+
+    def finish(entries, outcome):
+        # entries holds, in file order, the cache key of every computed or cached result and the siblings in between
+        if isinstance(outcome, Future):
+            results, seconds, timings = outcome.result()
+            record(seconds, timings, results)
+        else:
+            results = outcome
+        results = iter(results)
+        finished = []
+        for entry in entries:
+            if isinstance(entry, _Duplicate):
+                finished.append(resolve(entry))
+                continue
+            result = next(results)
+            stats.count("images")
+            stats.count("faces", len(result[1] or []))
+            # Only fresh, successful results are stored; a None key marks a cache hit or an unkeyed file
+            if entry is not None and result[1] is not None and result[4] is None:
+                cache.put(entry, settings, result[1], result[2], result[3])
+            if result[0] in siblings_left:
+                leader_results[result[0]] = result
+            finished.append(result)
+        return finished
+
+    # Each entry is (entries, list of results or a Future of it); `queued` also counts the open batch
+    in_flight = deque()
+    queued = 0
+    batch = []
+
+    def submit_batch():
+        files = [(item[1], item[2]) for item in batch if not isinstance(item, _Duplicate)]
+        entries = [item if isinstance(item, _Duplicate) else item[0] for item in batch]
+        if executor is not None and files:
+            in_flight.append((entries, executor.submit(_timed_encode_batch, files, model, max_long_edge, scale,
+                                                       crops, crop_max_edge, time_budget)))
+        elif files:
+            results, seconds, timings = _timed_encode_batch(files, model, max_long_edge, scale, crops, crop_max_edge,
+                                                            time_budget)
+            record(seconds, timings, results)
+            in_flight.append((entries, results))
+        else:
+            in_flight.append((entries, []))
+        batch.clear()
+
+    try:
+        for file_path, file_key, cached, data in items:
+            if isinstance(cached, _Duplicate):
+                # Siblings ride along in the open batch, so they neither break it nor overtake it
+                cached.file_path = file_path
+                batch.append(cached)
+            elif cached is not None:
+                # A cache hit closes the open batch, so results keep the order of file_paths
+                if batch:
+                    submit_batch()
+                in_flight.append(([None], [(file_path, cached[0], cached[1], cached[2], None)]))
+            else:
+                batch.append((file_key, file_path, data))
+                if len(batch) >= batch_files:
+                    submit_batch()
+            queued += 1
+
+            # Bound the amount of queued work; wait on the oldest batch to keep the output ordered
+            while queued >= max_in_flight:
+                if not in_flight:
+                    submit_batch()
+                entries, outcome = in_flight.popleft()
+                queued -= len(entries)
+                yield from finish(entries, outcome)
+        if batch:
+            submit_batch()
+        while in_flight:
+            yield from finish(*in_flight.popleft())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if cache is not None:
+            cache.commit()
@@ -0,0 +1,109 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileScanner:
+    """
+    Parallel recursive listing of the image files under a directory, with a manifest of the previous scan.
+
+    Directories are listed with os.scandir on a thread pool, breadth first, and the paths are
+    yielded while the scan is still going (directory by directory, in a stable order), so the
+    pipeline can start on the first files right away. The size and mtime of every file come from
+    the directory entry's stat.
+
+    With a manifest path, the listing of every directory is saved at the end of the scan together
+    with the directory's mtime. The next scan stats each directory and only lists the directories
+    whose mtime changed; the others are taken from the manifest. A directory's mtime changes when
+    entries are added, removed or renamed, not when a file is rewritten in place, so the sizes and
+    mtimes of an unchanged directory are those of its last listing (the encoding cache still checks
+    the files themselves).
+    """
+
+    def __init__(self, root, extensions, manifest_path=None, threads=16):
+        """
+        :param root: Directory to scan
+        :param extensions: Lower-case file extensions to keep, e.g. {'.jpg', '.png'}
+        :param manifest_path: Path of the JSON manifest, None to always list every directory
+        :param threads: Number of threads listing directories; network mounts benefit from many
+        """
+        self.root = root
+        self.extensions = set(extensions)
+        self.manifest_path = manifest_path
+        self.threads = threads
+        self.files = {}  # path -> (size, mtime_ns), filled during the scan
+        self.listed = 0  # directories listed with os.scandir
+        self.reused = 0  # directories taken from the manifest
+        self._directories = {}  # directory relative to root -> [mtime_ns, files, subdirectories]
+
+    def __iter__(self):
+        previous = self._load_manifest()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            pending = deque([executor.submit(self._scan_directory, '', previous)])
+            while pending:
+                relative, listing, reused = pending.popleft().result()
+                if listing is None:
+                    continue
+                self._directories[relative] = listing
+                if reused:
+                    self.reused += 1
+                else:
+                    self.listed += 1
+                _, files, subdirectories = listing
+                for name in subdirectories:
+                    pending.append(executor.submit(self._scan_directory, os.path.join(relative, name), previous))
+                directory = os.path.join(self.root, relative)
+                for name, size, mtime_ns in files:
+                    path = os.path.join(directory, name)
+                    self.files[path] = (size, mtime_ns)
+                    yield path
+        self.save()
+
+    def save(self):
+        """Write the manifest of the last complete scan."""
+        if self.manifest_path is None:
+            return
+        manifest = {"root": os.path.abspath(self.root), "extensions": sorted(self.extensions),
+                    "directories": self._directories}
+        with open(self.manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _load_manifest(self):
+        if self.manifest_path is None or not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable scan manifest {self.manifest_path}: {e}")
+            return {}
+        # A manifest of another folder or extension list says nothing about this scan
+        if manifest.get("root") != os.path.abspath(self.root) or manifest.get("extensions") != sorted(self.extensions):
+            return {}
+        return manifest["directories"]
+
+    def _scan_directory(self, relative, previous):
+        # Returns (relative, [mtime_ns, files, subdirectories] or None if unreadable, taken from the manifest)
+        directory = os.path.join(self.root, relative)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            if relative in previous and previous[relative][0] == mtime_ns:
+                return relative, previous[relative], True
+            files, subdirectories = [], []
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        # Symlinked directories are not followed, as with os.walk
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.name)
+                        elif entry.is_file() and os.path.splitext(entry.name.lower())[1] in self.extensions:
+                            stat = entry.stat()
+                            files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                    except OSError:
+                        continue  # vanished or unreadable entry
+        except OSError as e:
+            print(f"Error scanning {directory}: {e}")
+            return relative, None, False
+        return relative, [mtime_ns, sorted(files), sorted(subdirectories)], False
@@ -1,19 +1,46 @@
 import os
-import pickle
-import numpy as np
 import face_recognition
 import config
-from sklearn.metrics.pairwise import cosine_similarity
-import platform
+from ann_index import (ClusterIndex, build_cluster_index, update_cluster_index, build_catalog_index,
+                       update_catalog_index)
+from face_catalog import FaceCatalog
+from face_detection import detect_face_locations
+
+# Cluster index shared by every query of this process
+_cluster_index = None
+
+
+def load_cluster_index():
+    """
+    Load the on-disk cluster index once per process, building it if it does not exist yet.
+    Clusters created, grown, merged or removed since the index was saved are refreshed in place.
+    Clusters are read from the face catalog with indexed queries, or from the pickles of
+    config.cluster_path without one.
+
+    Returns:
+    - ClusterIndex over the encodings of every cluster.
+    """
+    global _cluster_index
+    if _cluster_index is None:
+        catalog = FaceCatalog(config.face_catalog_path) if FaceCatalog.exists(config.face_catalog_path) else None
+        if os.path.exists(os.path.join(config.cluster_index_path, 'index.json')):
+            _cluster_index = ClusterIndex.load(config.cluster_index_path)
+            if catalog is not None:
+                changed = update_catalog_index(_cluster_index, catalog)
+            else:
+                changed = update_cluster_index(_cluster_index, config.cluster_path)
+            if changed:
+                _cluster_index.save(config.cluster_index_path)
+        else:
+            if catalog is not None:
+                _cluster_index = build_catalog_index(catalog)
+            else:
+                _cluster_index = build_cluster_index(config.cluster_path)
+            _cluster_index.save(config.cluster_index_path)
+        if catalog is not None:
+            catalog.close()
+    return _cluster_index
 
-# Determine the model based on machine type
-def select_model():
-    if platform.system() == 'Darwin':  # MacOS system
-        print("Using 'cnn' model for face detection on MacOS.")
-        return "cnn"
-    else:
-        print("Using 'hog' model for face detection.")
-        return "hog"
 
 def find_cluster_for_new_face(new_image_path, threshold=0.5):
     """
@@ -28,7 +55,9 @@ def find_cluster_for_new_face(new_image_path, threshold=0.5):
     """
     # Load the new image and extract the face encoding
     image = face_recognition.load_image_file(new_image_path)
-    face_locations = face_recognition.face_locations(image, model="hog")  # Use selected model
+    # HOG first; the CNN detector only runs when HOG probably missed the face
+    face_locations = detect_face_locations(image, face_recognition, model="tiered",
+                                           time_budget=config.tiered_time_budget)
     if not face_locations:
         print("No faces detected in the new image.")
         return None
@@ -40,37 +69,12 @@ def find_cluster_for_new_face(new_image_path, threshold=0.5):
         return None
     new_face_encoding = face_encodings[0]
 
-    # Path to clusters
-    cluster_path = config.cluster_path
+    # Query the prebuilt cluster index instead of unpickling every cluster
     best_match_label = None
     highest_similarity = 0
-
-    # Iterate over each .pkl file in the cluster path
-    for pkl_file in os.listdir(cluster_path):
-        if not pkl_file.endswith('.pkl'):
-            continue
-
-        # Load encodings from the .pkl file
-        pkl_path = os.path.join(cluster_path, pkl_file)
-        with open(pkl_path, 'rb') as f:
-            cluster_encodings = pickle.load(f)
-
-        # Ensure the encodings are a 2D array
-        if len(cluster_encodings) == 0:
-            continue
-
-        cluster_encodings = np.array(cluster_encodings)
-        if cluster_encodings.ndim == 1:
-            cluster_encodings = cluster_encodings.reshape(1, -1)
-
-        # Calculate similarity with each encoding in the cluster
-        similarities = cosine_similarity([new_face_encoding], cluster_encodings)
-        max_similarity = np.max(similarities)
-
-        # If similarity exceeds threshold and is the highest similarity so far, update best match
-        if max_similarity > threshold and max_similarity > highest_similarity:
-            highest_similarity = max_similarity
-            best_match_label = pkl_file.replace('.pkl', '')
+    matches = load_cluster_index().search(new_face_encoding, k=1)
+    if matches and matches[0][1] > threshold:
+        best_match_label, highest_similarity = matches[0]
 
     # Report the best matching cluster
     if best_match_label:
@@ -80,10 +84,11 @@ def find_cluster_for_new_face(new_image_path, threshold=0.5):
 
     return best_match_label
 
-# Example usage
-omer_test_new_image_path = r"C:\Users\omerr\Desktop\09_49 31.10.2024(5jn).png"  # Replace with the path to the new face image
-omer_test2_new_image_path = r"C:\Users\omerr\Desktop\10_12 31.10.2024(5jp).png"  # Replace with the path to the new face image
-shira_test_new_image_path = r"C:\Users\omerr\Desktop\09_50 31.10.2024(5jo).png"  # Replace with the path to the new face image
-find_cluster_for_new_face(omer_test_new_image_path)
-find_cluster_for_new_face(omer_test2_new_image_path)
-find_cluster_for_new_face(shira_test_new_image_path)
+# Example usage; guarded so that importing this module (e.g. from matching_service.py) runs no queries
+if __name__ == "__main__":
+    omer_test_new_image_path = r"C:\Users\omerr\Desktop\09_49 31.10.2024(5jn).png"  # Replace with the path to the new face image
+    omer_test2_new_image_path = r"C:\Users\omerr\Desktop\10_12 31.10.2024(5jp).png"  # Replace with the path to the new face image
+    shira_test_new_image_path = r"C:\Users\omerr\Desktop\09_50 31.10.2024(5jo).png"  # Replace with the path to the new face image
+    find_cluster_for_new_face(omer_test_new_image_path)
+    find_cluster_for_new_face(omer_test2_new_image_path)
+    find_cluster_for_new_face(shira_test_new_image_path)
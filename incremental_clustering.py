@@ -0,0 +1,127 @@
+import os
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from clustering import load_or_build_graph, eps_degrees
+
+
+class IncrementalClustering:
+    """
+    DBSCAN clustering that is updated in place as faces are appended to the encoding store.
+
+    Only new rows and their eps-neighbourhoods are revisited: new faces join the cluster of
+    their nearest core point, points that become core connect clusters locally, and clusters
+    joined by a new core point are merged into the oldest one. Cluster IDs are never reused
+    or renumbered, so output directories stay stable between runs. Appending points can only
+    grow or merge DBSCAN clusters, so no split is ever needed.
+
+    After any sequence of updates the core points, the noise points and the partition of the
+    core points are those of DBSCAN run once on every row; a border point within eps of several
+    clusters may join another of them, which DBSCAN itself decides by visiting order.
+    """
+
+    def __init__(self, eps=0.5, min_samples=3):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.labels = np.zeros(0, dtype=np.int64)  # stable cluster ID per store row, -1 for noise
+        self.is_core = np.zeros(0, dtype=bool)
+        self.next_label = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    @classmethod
+    def load(cls, path, eps=0.5, min_samples=3):
+        """
+        Load saved state, or start empty if there is none or it was made with other parameters.
+        :param path: .npz state file
+        :return: IncrementalClustering
+        """
+        state = cls(eps, min_samples)
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                if float(saved["eps"]) == eps and int(saved["min_samples"]) == min_samples:
+                    state.labels = saved["labels"]
+                    state.is_core = saved["is_core"]
+                    state.next_label = int(saved["next_label"])
+        return state
+
+    def save(self, path):
+        np.savez(path, eps=self.eps, min_samples=self.min_samples, labels=self.labels,
+                 is_core=self.is_core, next_label=self.next_label)
+
+    def update(self, encodings, graph_path=None, graph_radius=0.6):
+        """
+        Cluster the rows appended since the last update.
+        :param encodings: Every encoding in the store, the first len(self) rows already clustered
+        :param graph_path: .npz file of the reusable neighbour graph (see clustering.NeighbourGraph)
+        :param graph_radius: Radius of a newly built graph
+        :return: Tuple (changed_rows, merges): rows whose label changed (new rows included) and a
+                 dict mapping each merged cluster ID to the ID it was merged into
+        """
+        n_old, n = len(self.labels), len(encodings)
+        if n < n_old:
+            raise ValueError("The encoding store has fewer rows than were already clustered")
+        previous = np.concatenate([self.labels, np.full(n - n_old, -1)])
+        if n == n_old:
+            return np.zeros(0, dtype=np.int64), {}
+
+        graph = load_or_build_graph(encodings, graph_path, radius=max(graph_radius, self.eps))
+        edges = graph.edges(self.eps)
+
+        # Only new rows and their neighbours can change core status. Their neighbourhoods are
+        # counted exactly, as the graph keeps at most max_neighbours edges per point
+        new_rows = np.arange(n_old, n)
+        affected = np.union1d(new_rows, edges[new_rows].indices)
+        is_core = np.concatenate([self.is_core, np.zeros(n - n_old, dtype=bool)])
+        is_core[affected] = eps_degrees(encodings, affected, self.eps) >= self.min_samples
+        labels = previous.copy()
+
+        # Connect the core points of the affected region to their core neighbours
+        core_affected = affected[is_core[affected]]
+        region = np.union1d(core_affected, edges[core_affected].indices)
+        region = region[is_core[region]]
+        links = []  # pairs of existing cluster IDs joined by a component
+        if len(region):
+            local = edges[region][:, region]
+            _, components = connected_components(local, directed=False)
+            for component in np.unique(components):
+                members = region[components == component]
+                existing = np.unique(labels[members][labels[members] >= 0])
+                if len(existing) == 0:
+                    target = self.next_label
+                    self.next_label += 1
+                else:
+                    target = int(existing[0])
+                    links += [(target, int(other)) for other in existing[1:]]
+                labels[members] = target
+
+        # Merge every group of linked clusters into its oldest (smallest) ID
+        merges = {}
+        if links:
+            pairs = np.array(links)
+            link_graph = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                                           shape=(self.next_label, self.next_label))
+            _, groups = connected_components(link_graph, directed=False)
+            oldest = np.full(groups.max() + 1, self.next_label)
+            np.minimum.at(oldest, groups, np.arange(self.next_label))
+            involved = np.unique(pairs)
+            merges = {int(label): int(oldest[groups[label]]) for label in involved
+                      if oldest[groups[label]] != label}
+            relabel = np.arange(self.next_label)
+            relabel[list(merges)] = list(merges.values())
+            labels[labels >= 0] = relabel[labels[labels >= 0]]
+
+        # Unlabelled non-core points near a changed core point join its cluster (nearest core first)
+        newly_core = core_affected[~np.concatenate([self.is_core, np.zeros(n - n_old, dtype=bool)])[core_affected]]
+        candidates = np.union1d(affected, edges[newly_core].indices)
+        border = candidates[(~is_core[candidates]) & (labels[candidates] < 0)]
+        for row in border:
+            start, end = edges.indptr[row], edges.indptr[row + 1]
+            neighbours, distances = edges.indices[start:end], edges.data[start:end]
+            core = is_core[neighbours]
+            if core.any():
+                labels[row] = labels[neighbours[core][np.argmin(distances[core])]]
+
+        self.labels, self.is_core = labels, is_core
+        return np.flatnonzero(labels != previous), merges
@@ -1,159 +1,135 @@
 import os
-import shutil
 import config
-import face_recognition
-from face_loading import loading_face
-from face_encoding import get_face_encoding
+from face_pipeline import encode_files, PipelineStats
+from output_tree import OutputTree
+from near_duplicates import find_near_duplicates
+from file_scanner import FileScanner
+from encoding_cache import EncodingCache
 from face_detection import get_face
+from face_crops import crop_grid
 from face_comparision import compare
 import utils
+from cluster_store import ClusterStore
+from face_catalog import FaceCatalog
+from ann_index import build_catalog_index
 from tqdm import tqdm
-from PIL import Image
 import numpy as np
 
 # Ensure cluster and sorted directories exist
 utils.check_and_create_dir(config.cluster_path)
 utils.check_and_create_dir(config.sorted_path)
 
+# Load every existing cluster into one resident store; clusters are flushed to disk in batches
+cluster_store = ClusterStore(config.cluster_path, dtype=config.encoding_dtype,
+                             tolerance=config.encoding_max_distance_error).load()
+
+# Catalog of images, faces and clusters, rewritten with the clusters; the output stages query it
+catalog = FaceCatalog(config.face_catalog_path)
+catalog.clear()
+
 # Initialize cluster count
-cluster_count = sorted(os.listdir(config.cluster_path))
-if len(cluster_count) > 0:
-    count = int(cluster_count[-1].split('.')[0]) + 1  # Parse last cluster and increment
-else:
-    count = 0
+numeric_names = [int(name) for name in cluster_store.names if name.isdigit()]
+count = max(numeric_names) + 1 if numeric_names else 0
 
 # Define allowed image extensions
 allowed_extensions = {'.png', '.jpeg', '.jpg', '.gif', '.bmp', '.tiff'}
 
-# Use os.walk to process only image files in the input directory and all subdirectories
-all_files = []
-for root, dirs, files in os.walk(config.input_path):
-    for file in files:
-        # Check if the file extension is in the allowed list
-        if os.path.splitext(file.lower())[1] in allowed_extensions:
-            all_files.append(os.path.join(root, file))
-
-# Helper function to calculate average distance for matching
-def is_encoding_match(cluster_encodings, new_encoding, threshold=0.5):
-    distances = face_recognition.face_distance(cluster_encodings, new_encoding)
-    avg_distance = np.mean(distances)
-    return avg_distance < threshold
-
-# Track faces that have already been clustered in each run
-clustered_faces = set()
+# List the image files in the input directory and all subdirectories on a thread pool,
+# reusing the saved listing of directories that did not change since the last run
+scanner = FileScanner(config.input_path, allowed_extensions, config.scan_manifest_path)
+all_files = list(scanner)
+print(f"Found {len(all_files)} images ({scanner.listed} directories listed, {scanner.reused} unchanged).")
 
 # Process each file found in all directories and subdirectories
-for file_path in tqdm(all_files, total=len(all_files)):
-    print(f"Processing file: {file_path}")
-
-    # Load the image
-    image = loading_face(file_path, face_recognition)
-
-    # Get all face encodings from the original image (not cropped)
-    face_encodings = get_face_encoding(image, face_recognition)
-    if face_encodings is None:
-        utils.create_dir(os.path.join(config.sorted_path, 'others'))
-        shutil.copy(file_path, os.path.join(config.sorted_path, 'others', os.path.basename(file_path)))
-        continue
-
-    # Dictionary to keep track of cluster assignments for each unique face in the current image
-    assigned_clusters = {}
-
-    # Process each detected face encoding in the image
-    for face_encoding in face_encodings:
-        encoding_hash = hash(tuple(face_encoding))  # Create a unique hash for each face encoding
-        if encoding_hash in clustered_faces:
-            continue  # Skip if this face has already been clustered in previous images
-
-        is_found = False  # Flag to indicate if encoding matched an existing cluster
-
-        # Check if there are existing clusters
-        if len(os.listdir(config.cluster_path)) > 0:
-            for cluster in os.listdir(config.cluster_path):
-                # Load encoding list from the cluster
-                cluster_path = os.path.join(config.cluster_path, cluster)
-                encoding_lists = utils.load_cluster_in_pickle(cluster_path)
-
-                # Use the improved matching function based on average distance
-                if is_encoding_match(encoding_lists, face_encoding):
-                    is_found = True
-                    # If the face has already been assigned a cluster in this image, skip further assignments
-                    if encoding_hash in assigned_clusters:
-                        break  # Skip to the next face encoding
-
-                    # Append the encoding to the cluster and save it
-                    encoding_lists.append(face_encoding)
-                    utils.save_cluster_in_pickle(cluster_path, encoding_lists)
-                    shutil.copy(file_path,
-                                os.path.join(config.sorted_path, cluster.split(".")[0], os.path.basename(file_path)))
-                    clustered_faces.add(encoding_hash)  # Mark face as clustered
-                    assigned_clusters[encoding_hash] = cluster.split(".")[0]  # Track assignment for this image
-                    break
-
-        # If no matching cluster was found, create a new one
-        if not is_found:
-            new_cluster_id = str(count)
-            utils.create_dir(os.path.join(config.sorted_path, new_cluster_id))
-            shutil.copy(file_path, os.path.join(config.sorted_path, new_cluster_id, os.path.basename(file_path)))
-            utils.save_cluster_in_pickle(os.path.join(config.cluster_path, f"{new_cluster_id}.pkl"), [face_encoding])
-            clustered_faces.add(encoding_hash)  # Mark face as clustered
-            assigned_clusters[encoding_hash] = new_cluster_id  # Track assignment for this image
-            count += 1
+# Unchanged files are served from the persistent encoding cache instead of being decoded again
+encoding_cache = EncodingCache(config.encoding_cache_path, config.encoding_cache_key)
+# Files are read ahead on background threads; photos are linked (or copied) into sorted/ on a thread pool
+stats = PipelineStats()
+output_tree = OutputTree(config.sorted_path, config.output_mode, config.output_manifest_name, stats=stats)
+# Near-duplicate frames are detected once per group; the others go to the clusters of the group's first file
+duplicates = {}
+if config.near_duplicate_max_distance is not None:
+    duplicates = find_near_duplicates(all_files, config.near_duplicate_max_distance, stats=stats)
+    print(f"Found {len(duplicates)} near-duplicate files; detection is skipped for them.")
+results = encode_files(all_files, model="hog", max_long_edge=config.detection_max_long_edge,
+                       scale=config.detection_scale, cache=encoding_cache, read_threads=4, stats=stats,
+                       crops=True, crop_max_edge=config.face_crop_max_edge, duplicates=duplicates)
+# Clusters that received faces, for the summary images
+changed_clusters = set()
+try:
+    for file_path, face_locations, face_encodings, face_crops, error in tqdm(results, total=len(all_files)):
+        print(f"Processing file: {file_path}")
+
+        # Images are loaded with a reduced JPEG decode when a detection size is configured
+        if error is not None or face_locations is None:
+            print(f"Error processing file {file_path}: {error}")
+            continue
+        if not face_encodings:
+            catalog.add_image(file_path)
+            output_tree.place(file_path, 'others', os.path.basename(file_path))
+            continue
+
+        # A near-duplicate takes the clusters of its leader without adding its faces to the clusters again
+        leader_clusters = catalog.image_clusters(duplicates[file_path]) if file_path in duplicates else []
+        if leader_clusters:
+            catalog.add_image(file_path, face_locations, face_encodings, leader_clusters, face_crops)
+            for cluster_id in dict.fromkeys(leader_clusters):
+                output_tree.place(file_path, cluster_id, os.path.basename(file_path))
+            continue
+
+        # Match all faces of the image at once: one faces x clusters distance matrix, prefiltered by
+        # the cluster centroids, with at most one face of the image per cluster
+        matches = cluster_store.match_faces(np.asarray(face_encodings), threshold=0.5)
+
+        image_clusters = []
+        for face_encoding, cluster_id in zip(face_encodings, matches):
+            if cluster_id is not None:
+                # Append the encoding to the resident cluster; it is written to disk on the next flush
+                cluster_store.append(cluster_id, face_encoding)
+            else:
+                # If no matching cluster was found, create a new one
+                cluster_id = str(count)
+                cluster_store.new_cluster(cluster_id, face_encoding)
+                count += 1
+            image_clusters.append(cluster_id)
+        catalog.add_image(file_path, face_locations, face_encodings, image_clusters, face_crops)
+        changed_clusters.update(image_clusters)
+
+        # Place the photo once in the folder of every cluster it was assigned to
+        for cluster_id in dict.fromkeys(image_clusters):
+            output_tree.place(file_path, cluster_id, os.path.basename(file_path))
+finally:
+    # Write any clusters changed since the last batch flush
+    cluster_store.flush()
+    catalog.commit()
+    encoding_cache.close()
+    output_tree.close()
+    print(stats.report())
+
+# Rebuild the cluster index used by find_cluster_for_new_face from the catalog
+build_catalog_index(catalog).save(config.cluster_index_path)
 
 # Thumbnail Summary Generation Function
-def generate_cluster_images(thumbnail_size=(100, 100), grid_size=(3, 3)):
+def generate_cluster_images(catalog, cluster_ids, thumbnail_size=(100, 100), grid_size=(3, 3)):
     """
-    Generate summary images for each cluster using only the face region in thumbnails.
+    Generate summary images for clusters from the face crops stored in the catalog,
+    without decoding the sorted images or running face detection again.
     Each summary image will be named according to its cluster ID.
+    :param catalog: FaceCatalog holding the crops
+    :param cluster_ids: IDs of the clusters to summarize
     :param thumbnail_size: Size of each face thumbnail
     :param grid_size: Layout of thumbnails in the summary image (rows, columns)
     """
-    sorted_path = config.sorted_path
-
-    # Iterate through each cluster directory
-    for cluster_id in os.listdir(sorted_path):
-        cluster_dir = os.path.join(sorted_path, cluster_id)
-        if not os.path.isdir(cluster_dir):
-            continue  # Skip if not a directory
-
-        # Collect image paths in this cluster
-        image_files = [os.path.join(cluster_dir, f) for f in os.listdir(cluster_dir) if f.endswith(('.jpg', '.png'))]
-
-        # Limit to grid size if there are more images than grid slots
-        image_files = image_files[:grid_size[0] * grid_size[1]]
-
-        # Create a blank canvas for the grid
-        canvas_width = grid_size[1] * thumbnail_size[0]
-        canvas_height = grid_size[0] * thumbnail_size[1]
-        summary_image = Image.new("RGB", (canvas_width, canvas_height), "white")
-
-        # Place each cropped face thumbnail in the grid
-        for index, img_path in enumerate(image_files):
-            # Open the image
-            image = face_recognition.load_image_file(img_path)
-
-            # Detect face locations
-            face_locations = face_recognition.face_locations(image)
-            if not face_locations:
-                continue  # Skip if no face is detected
-
-            # Use the first detected face for thumbnail
-            top, right, bottom, left = face_locations[0]
-            face_image = image[top:bottom, left:right]  # Crop to face region
-
-            # Convert to PIL Image and resize to thumbnail size
-            face_pil = Image.fromarray(face_image)
-            face_pil.thumbnail(thumbnail_size)
-
-            # Calculate position in the grid
-            x_offset = (index % grid_size[1]) * thumbnail_size[0]
-            y_offset = (index // grid_size[1]) * thumbnail_size[1]
-            summary_image.paste(face_pil, (x_offset, y_offset))
+    for cluster_id in sorted(cluster_ids):
+        crops = catalog.cluster_crops(cluster_id, limit=grid_size[0] * grid_size[1])
+        summary_image = crop_grid(crops, thumbnail_size, grid_size)
 
         # Save the summary image with the cluster ID as the filename
-        output_path = os.path.join(sorted_path, f"{cluster_id}.jpg")
+        output_path = os.path.join(config.sorted_path, f"{cluster_id}.jpg")
         summary_image.save(output_path)
         print(f"Saved summary image for cluster {cluster_id} at {output_path}")
 
-# Run the thumbnail generation after clustering
-generate_cluster_images()
+# Run the thumbnail generation after clustering, with up to 3 x 3 faces per summary image
+summary_grid_size = (3, 3)
+generate_cluster_images(catalog, changed_clusters, grid_size=summary_grid_size)
+catalog.close()
@@ -1,160 +1,392 @@
 import os
 import shutil
 import pickle
+import argparse
 import config
-import face_recognition
 import utils
 from tqdm import tqdm
 import numpy as np
-from sklearn.cluster import DBSCAN
-import cv2
+from clustering import cluster_faces, CLUSTERING_METHODS
+from incremental_clustering import IncrementalClustering
 import csv
-from face_loading import loading_face
+from face_pipeline import encode_files, AsyncWriter, PipelineStats
+from output_tree import OutputTree
+from near_duplicates import find_near_duplicates
+from file_scanner import FileScanner
+from encoding_cache import EncodingCache
+from face_detection import tier_settings
+from encoding_store import EncodingStore
+from run_journal import RunJournal
+from face_crops import iter_face_crops
+from face_catalog import FaceCatalog, label_names
+from ann_index import build_catalog_index, build_results_index
+from result_sink import open_result_sink, result_table_path, ArrowResultSink
+from metrics import MetricsExporter, write_json_summary, profiled
 import time
 from datetime import timedelta
-tic=time.time()
-# Ensure cluster and sorted directories exist
-utils.check_and_create_dir(config.cluster_path)
-utils.check_and_create_dir(config.sorted_path)
-no_face_dir = os.path.join(config.sorted_path, 'no_faces')
-utils.check_and_create_dir(no_face_dir)
-
-# Define allowed image extensions
-allowed_extensions = {'.png', '.jpeg', '.jpg', '.gif', '.bmp', '.tiff'}
-
-# Prepare CSV to log face details for easy future matching
-csv_path = os.path.join(config.sorted_path, 'face_clusters.csv')
-with open(csv_path, mode='w', newline='') as csv_file:
-    writer = csv.writer(csv_file)
-    writer.writerow(['Image Path', 'Location', 'Cluster Label'])
-
-# Use os.walk to process only image files in the input directory and all subdirectories
-all_files = []
-for root, dirs, files in os.walk(config.input_path):
-    for file in files:
-        if os.path.splitext(file.lower())[1] in allowed_extensions:
-            all_files.append(os.path.join(root, file))
-
-# Dictionary to track processed faces by unique identifier
-processed_faces = {}
-
-# Load previous progress if a checkpoint exists
-checkpoint_path = "data_checkpoint.pkl"
-data = []
-if os.path.exists(checkpoint_path):
-    with open(checkpoint_path, "rb") as f:
-        data = pickle.load(f)
-    print(f"Resumed from checkpoint, with {len(data)} items in 'data' list.")
-
-# Load images and extract face encodings
-save_interval = 10  # Save checkpoint every 10 files
-for idx, file_path in enumerate(tqdm(all_files, total=len(all_files))):
-    print(f"Processing file: {file_path}")
 
-    try:
-        # Check if the file exists before processing
-        if not os.path.exists(file_path):
-            print(f"File not found: {file_path}. Skipping.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Cluster the faces found in config.input_path")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes used for face detection and encoding (default: 1)")
+    parser.add_argument('--read-threads', type=int, default=4,
+                        help="Number of threads reading files ahead of detection, 0 to disable (default: 4)")
+    parser.add_argument('--model', default="hog", choices=("hog", "cnn", "tiered"),
+                        help="Face detection model; tiered runs CNN only where HOG probably missed faces "
+                             "(default: hog)")
+    parser.add_argument('--cluster-method', default=config.clustering_method, choices=CLUSTERING_METHODS,
+                        help=f"Clustering algorithm (default: {config.clustering_method})")
+    parser.add_argument('--eps', type=float, default=config.clustering_eps,
+                        help=f"Maximum distance between faces of one neighbourhood (default: {config.clustering_eps})")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only cluster photos added since the last incremental run, keeping cluster IDs stable "
+                             "(DBSCAN only: --cluster-method must be dbscan or graph_dbscan). Photos already "
+                             "clustered keep their faces even if they changed; a full run redoes them")
+    parser.add_argument('--fresh', action='store_true',
+                        help="Discard the encoding store and its journal and process every file again")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Ignore the persistent encoding cache and re-encode every file")
+    parser.add_argument('--profile', choices=('cprofile', 'pyinstrument'),
+                        help="Profile the run (the main process only, not --workers pool processes)")
+    parser.add_argument('--metrics', default=config.metrics_path,
+                        help=f"Path of the JSON metrics summary (default: {config.metrics_path})")
+    args = parser.parse_args()
+    if args.incremental and args.cluster_method not in ("dbscan", "graph_dbscan"):
+        parser.error(f"--incremental clusters with DBSCAN and cannot use --cluster-method {args.cluster_method}")
+    return args
+
+
+def write_cluster_output(faces, labels, results_sink, output_writer):
+    """
+    Write the crops, result rows and cluster pickles of a full clustering run.
+    :param faces: FaceTable of the encoding store
+    :param labels: Cluster label of every face, -1 for noise
+    :param results_sink: Sink of the face_clusters.csv rows (see result_sink.open_result_sink)
+    :param output_writer: AsyncWriter running the file writes
+    """
+    # Create a directory for each unique face cluster; label -1 marks noise, i.e. unclustered faces
+    unique_labels = sorted(set(labels) - {-1})
+    for label in unique_labels:
+        utils.check_and_create_dir(os.path.join(config.sorted_path, f"face_{label}"))
+
+    # Crops are numbered within their cluster, then written grouped by source image
+    crop_names = {}
+    for label in unique_labels:
+        for idx, row in enumerate(np.flatnonzero(labels == label)):
+            crop_names[int(row)] = f"face_{label}_{idx}.jpg"
+    write_face_crops(faces, labels, crop_names, results_sink, output_writer)
+
+    # Save the encodings of every cluster to a .pkl file
+    for label in unique_labels:
+        pkl_path = os.path.join(config.cluster_path, f"face_{label}.pkl")
+        with open(pkl_path, "wb") as f:
+            pickle.dump(list(np.asarray(faces.encodings[labels == label])), f)
+        print(f"Saved cluster encodings to {pkl_path}")
+
+
+def write_face_crops(faces, labels, crop_names, results_sink, output_writer):
+    """
+    Write face crops into their cluster directories and log them in the results.
+    Stored crops are written as they are; any other face is cut from its image, which is
+    decoded once for all of its faces.
+    :param faces: FaceTable of the encoding store
+    :param labels: Cluster label of every face
+    :param crop_names: Dict of row -> crop file name
+    :param results_sink: Sink of the face_clusters.csv rows
+    :param output_writer: AsyncWriter running the file writes
+    """
+    for row, crop in iter_face_crops(faces, list(crop_names), config.face_crop_max_edge):
+        label, image_path, loc = labels[row], faces.image_path(row), faces.location(row)
+        if crop is None:
+            print(f"Warning: Failed to load image {image_path}. Skipping this face.")
             continue
+        crop_path = os.path.join(config.sorted_path, f"face_{label}", crop_names[row])
+        output_writer.submit(utils.write_bytes, crop_path, crop)
+        # Log the image path, location, cluster label and encoding; the sink writes them in bulk
+        results_sink.write(image_path, loc, label, faces.encodings[row])
+
+
+def update_cluster_output(faces, state, previous_labels, changed_rows, merges, csv_path, results_sink,
+                          output_writer):
+    """
+    Update the output of an incremental run, touching only the clusters that changed.
+    Merged clusters are moved into the cluster they joined; faces that were just assigned get
+    their crop and result row; the pickles of changed clusters are rewritten.
+    :param faces: FaceTable of the encoding store
+    :param state: IncrementalClustering after update()
+    :param previous_labels: Labels of the rows clustered before this run
+    :param changed_rows: Rows whose label changed, as returned by update()
+    :param merges: Dict of merged cluster ID -> surviving cluster ID
+    :param csv_path: Path of face_clusters.csv
+    :param results_sink: Sink appending to face_clusters.csv, written after the merged rows are relabelled
+    :param output_writer: AsyncWriter running the file writes
+    """
+    labels = state.labels
+    for merged, target in merges.items():
+        merged_dir = os.path.join(config.sorted_path, f"face_{merged}")
+        target_dir = os.path.join(config.sorted_path, f"face_{target}")
+        utils.create_dir(target_dir)
+        if os.path.isdir(merged_dir):
+            for filename in os.listdir(merged_dir):
+                shutil.move(os.path.join(merged_dir, filename), os.path.join(target_dir, filename))
+            os.rmdir(merged_dir)
+        merged_pkl = os.path.join(config.cluster_path, f"face_{merged}.pkl")
+        if os.path.exists(merged_pkl):
+            os.remove(merged_pkl)
+
+    if merges and os.path.exists(csv_path):
+        # Relabel the CSV rows of merged clusters; the other rows are written back unchanged
+        with open(csv_path, newline='') as csv_file:
+            rows = list(csv.reader(csv_file))
+        renamed = {str(merged): str(target) for merged, target in merges.items()}
+        for row in rows[1:]:
+            row[2] = renamed.get(row[2], row[2])
+        with open(csv_path, mode='w', newline='') as csv_file:
+            csv.writer(csv_file).writerows(rows)
+
+    # Faces that were new or noise before this run and now belong to a cluster
+    newly_assigned = [row for row in changed_rows if row >= len(previous_labels) or previous_labels[row] < 0]
+    for label in set(int(labels[row]) for row in newly_assigned):
+        utils.create_dir(os.path.join(config.sorted_path, f"face_{label}"))
+    # Crops are named by store row so they never collide across runs
+    write_face_crops(faces, labels, {int(row): f"face_{labels[row]}_{row}.jpg" for row in newly_assigned},
+                     results_sink, output_writer)
+
+    # Rewrite the pickles of every cluster that gained faces
+    for label in set(int(labels[row]) for row in newly_assigned) | set(merges.values()):
+        pkl_path = os.path.join(config.cluster_path, f"face_{label}.pkl")
+        with open(pkl_path, "wb") as f:
+            pickle.dump(list(np.asarray(faces.encodings[labels == label])), f)
+        print(f"Saved cluster encodings to {pkl_path}")
+
+
+def main(args):
+    tic=time.time()
+    if args.fresh and os.path.isdir(config.encoding_store_path):
+        shutil.rmtree(config.encoding_store_path)
+    no_face_dir = os.path.join(config.sorted_path, 'no_faces')
+    csv_path = os.path.join(config.sorted_path, 'face_clusters.csv')
+
+    # Incremental runs keep their clustering state next to the encoding store
+    state_path = os.path.join(config.encoding_store_path, 'incremental_clustering.npz')
+    if args.incremental:
+        state = IncrementalClustering.load(state_path, args.eps, config.clustering_min_samples)
+    elif os.path.exists(state_path):
+        os.remove(state_path)  # a full run renumbers the clusters, so the saved IDs no longer apply
+    keep_output = args.incremental and len(state) > 0
+
+    # Ensure cluster and sorted directories exist; incremental runs only touch the clusters that change
+    if keep_output:
+        utils.create_dir(config.cluster_path)
+        utils.create_dir(config.sorted_path)
+        utils.create_dir(no_face_dir)
+    else:
+        utils.check_and_create_dir(config.cluster_path)
+        utils.check_and_create_dir(config.sorted_path)
+        utils.check_and_create_dir(no_face_dir)
+
+    # Define allowed image extensions
+    allowed_extensions = {'.png', '.jpeg', '.jpg', '.gif', '.bmp', '.tiff'}
+
+    # List the image files in the input directory and all subdirectories on a thread pool,
+    # reusing the saved listing of directories that did not change since the last run
+    scanner = FileScanner(config.input_path, allowed_extensions, config.scan_manifest_path)
+
+    # Faces are appended to a columnar on-disk store; previous progress is kept if the store exists.
+    # Every finished file is journalled with its faces, so an interrupted run resumes after the last
+    # finished file, and faces journalled after the store's last flush are put back into the store
+    store = EncodingStore(config.encoding_store_path)
+    journal = RunJournal(os.path.join(config.encoding_store_path, 'journal.sqlite'))
+    restored = journal.recover(store)
+    # Journal entries are only reused for files unchanged since they were processed with these settings
+    settings = EncodingCache.settings_key(args.model, config.detection_max_long_edge, config.detection_scale,
+                                          config.face_crop_max_edge, tier_settings(config.tiered_time_budget))
+    graph_path = os.path.join(config.encoding_store_path, 'neighbour_graph.npz')
+    all_files = None
+    if not keep_output:
+        # A full run clusters the current input only: the faces of files that were deleted, moved out of
+        # input_path, rewritten or processed with other settings are dropped, and those files are redone.
+        # This needs the whole listing before the pipeline starts.
+        all_files = list(scanner)
+        current = set(all_files)
+        stale = [file_path for file_path in set(journal) | set(store.paths) if file_path not in current
+                 or not journal.is_current(file_path, RunJournal.file_version(file_path, settings))]
+        if stale:
+            removed = store.remove(stale)
+            journal.forget(stale)
+            if removed and os.path.exists(graph_path):
+                os.remove(graph_path)  # the store rows were renumbered
+            print(f"Dropped {removed} faces of {len(stale)} files that changed or are no longer in the input.")
+    if len(journal) > 0:
+        print(f"Resumed from the journal: {len(journal)} files already processed ({restored} restored), "
+              f"{len(store)} faces in the encoding store.")
+
+    # Files that vanished since the scan are reported by the workers as unreadable
+    def new_files(file_paths):
+        for file_path in file_paths:
+            if journal.is_current(file_path, RunJournal.file_version(file_path, settings)):
+                continue  # Already processed by an earlier or interrupted run
+            if keep_output and file_path in store:
+                continue  # Incremental runs keep the faces already clustered and only add new files
+            yield file_path
+
+    # Load images and extract face encodings. Detection uses the HOG model by default for memory efficiency.
+    # With --workers > 1 files are processed in a process pool; results still arrive in file order.
+    # The journal already makes every file durable, so the store columns are only fsynced every 100 files
+    save_interval = 100
+    # Unchanged files are served from the persistent encoding cache instead of being decoded again
+    encoding_cache = None if args.no_cache else EncodingCache(config.encoding_cache_path, config.encoding_cache_key)
+    # Reading, detection/encoding and output writes run as separate stages with bounded queues
+    stats = PipelineStats()
+    output_writer = AsyncWriter(stats=stats)
+    # Photos without faces are linked (or copied, or moved) into no_faces/ on a thread pool
+    output_tree = OutputTree(config.sorted_path, config.output_mode, config.output_manifest_name,
+                             keep_existing=keep_output, stats=stats)
+    # Optionally publish the running metrics as a Prometheus text file
+    exporter = None
+    if config.prometheus_path is not None:
+        exporter = MetricsExporter(stats, config.prometheus_path, config.prometheus_interval)
+    try:
+        # Near-duplicate frames are detected once per group and take the faces of the group's first file.
+        # Grouping needs the whole listing; without it, paths stream into the pipeline as they are found.
+        duplicates = {}
+        if config.near_duplicate_max_distance is not None:
+            all_files = list(scanner) if all_files is None else all_files
+            duplicates = find_near_duplicates(all_files, config.near_duplicate_max_distance,
+                                              threads=max(args.read_threads, 1), stats=stats)
+            print(f"Found {len(duplicates)} near-duplicate files; detection is skipped for them.")
+        if not keep_output:
+            # no_faces/ was emptied with the rest of the output; put back the files journalled without faces
+            for file_path in journal.files_without_faces():
+                output_tree.place(file_path, os.path.basename(no_face_dir), os.path.basename(file_path))
+        file_paths = new_files(scanner if all_files is None else all_files)
+        results = encode_files(file_paths, workers=args.workers, model=args.model,
+                               max_long_edge=config.detection_max_long_edge, scale=config.detection_scale,
+                               cache=encoding_cache, read_threads=args.read_threads, stats=stats,
+                               crops=True, crop_max_edge=config.face_crop_max_edge, duplicates=duplicates,
+                               time_budget=config.tiered_time_budget)
+        for idx, (file_path, face_locations, face_encodings, face_crops, error) in enumerate(
+                tqdm(results, total=len(all_files) if all_files is not None else None)):
+            print(f"Processing file: {file_path}")
+
+            try:
+                if error is not None:
+                    raise RuntimeError(error)
+
+                if face_locations is None:
+                    continue  # Skip if the image failed to load
+
+                # Check if face locations are found
+                if not face_locations:
+                    print(f"No faces found in {file_path}, placing it in the no_faces folder.")
+                    output_tree.place(file_path, os.path.basename(no_face_dir), os.path.basename(file_path))
+                    journal.record(file_path, [], [], version=RunJournal.file_version(file_path, settings))
+                    continue  # Skip this file if no faces are found
+
+                # Append the face encodings, crops and metadata to the store for clustering, then
+                # mark the file as finished; journalled files are not processed again while they are unchanged
+                store.append(file_path, face_locations, face_encodings, face_crops)
+                journal.record(file_path, face_locations, face_encodings, face_crops,
+                               version=RunJournal.file_version(file_path, settings))
+
+            except Exception as e:
+                print(f"Error processing file {file_path}: {e}")
+
+            # Commit the rows appended since the last checkpoint after every `save_interval` files
+            if (idx + 1) % save_interval == 0:
+                store.flush()
+                print(f"Checkpoint saved with {len(store)} faces in the encoding store.")
+
+        print(f"Scanned {len(scanner.files)} images ({scanner.listed} directories listed, {scanner.reused} unchanged).")
+        if encoding_cache is not None:
+            encoding_cache.close()
+            print(f"Encoding cache: {encoding_cache.hits} hits, {encoding_cache.misses} misses.")
+
+        # Final save after processing all files
+        store.close()
+        no_face_files = journal.files_without_faces()
+        journal.close()
+        print(f"Final checkpoint saved with {len(store)} faces in the encoding store.")
+
+        # Clustering on the memory-mapped encodings; graph methods reuse the neighbour graph kept in the store
+        faces = EncodingStore.load(config.encoding_store_path)
+        encodings = faces.encodings
+        with stats.timer("cluster"):
+            if args.incremental:
+                # Only faces added since the last run are clustered; cluster IDs stay stable
+                previous_labels = state.labels.copy()
+                changed_rows, merges = state.update(encodings, graph_path=graph_path,
+                                                    graph_radius=config.neighbour_graph_radius)
+                print(f"Incremental clustering: {len(encodings) - len(previous_labels)} new faces, "
+                      f"{len(changed_rows)} faces assigned, {len(merges)} clusters merged.")
+            else:
+                labels = cluster_faces(encodings, args.cluster_method, eps=args.eps,
+                                       min_samples=config.clustering_min_samples, graph_path=graph_path,
+                                       graph_radius=config.neighbour_graph_radius)
+
+        # Log face details for easy future matching: face_clusters.csv, plus an optional columnar table with encodings
+        table_format = config.results_table_format
+        with stats.timer("output"):
+            if args.incremental:
+                results_sink = open_result_sink(csv_path, append=keep_output)
+                update_cluster_output(faces, state, previous_labels, changed_rows, merges, csv_path, results_sink,
+                                      output_writer)
+                results_sink.close()
+                state.save(state_path)
+                if table_format is not None:
+                    # A columnar file cannot be appended to, so the table is rewritten from the store in one batch
+                    clustered = np.flatnonzero(state.labels >= 0)
+                    table = ArrowResultSink(result_table_path(csv_path, table_format), table_format)
+                    table.write_batch([faces.image_path(row) for row in clustered], faces.locations[clustered],
+                                      state.labels[clustered], faces.encodings[clustered])
+                    table.close()
+            else:
+                results_sink = open_result_sink(csv_path, table_format)
+                write_cluster_output(faces, labels, results_sink, output_writer)
+                results_sink.close()
+
+            # The face catalog gets the new faces and the clusters that changed when the output is kept;
+            # otherwise store rows may have been dropped and renumbered, so it is rewritten
+            catalog = FaceCatalog(config.face_catalog_path)
+            if keep_output:
+                start = min(len(catalog), len(faces))
+                catalog.add_face_table(faces, label_names(state.labels), start=start)
+                old_rows = changed_rows[changed_rows < start]
+                catalog.set_clusters(old_rows, label_names(state.labels[old_rows]))
+            else:
+                catalog.clear()
+                catalog.add_face_table(faces, label_names(state.labels if args.incremental else labels))
+            catalog.add_images(no_face_files)
+
+        # Wait for the queued output writes, then report which stage limited throughput
+        output_writer.close()
+        output_tree.close()
+        print(stats.report())
+
+        # Rebuild the cluster index used by find_cluster_for_new_face, from the results table when there is one
+        if table_format is not None:
+            build_results_index(result_table_path(csv_path, table_format),
+                                versions=catalog.cluster_versions()).save(config.cluster_index_path)
+        else:
+            build_catalog_index(catalog).save(config.cluster_index_path)
+        catalog.close()
+
+        # Per-stage timings, counters and peak RSS of the run
+        write_json_summary(stats, args.metrics)
+    finally:
+        # The last metrics are exported even when the run fails
+        if exporter is not None:
+            exporter.close()
+    print(f"Metrics saved to {args.metrics}")
+
+    print("Clustering complete. Face data saved to CSV.")
+    formatted_dur = str(timedelta(seconds=(time.time()-tic)))
+    print(f'Runtime is {formatted_dur}')
+
 
-        # Load image
-        image = loading_face(file_path, face_recognition)
-        if image is None:
-            continue  # Skip if the image failed to load
-
-        # Detect faces using HOG model for memory efficiency
-        face_locations = face_recognition.face_locations(image, model="hog")
-
-        # Check if face locations are found
-        if not face_locations:
-            print(f"No faces found in {file_path}, moving to no_faces folder.")
-            shutil.move(file_path, os.path.join(no_face_dir, os.path.basename(file_path)))
-            continue  # Skip this file if no faces are found
-
-        # Get face encodings
-        face_encodings = face_recognition.face_encodings(image, face_locations)
-
-        # Process each face location and encoding
-        for loc, encoding in zip(face_locations, face_encodings):
-            # Create a unique identifier using the image path and face location
-            face_id = f"{file_path}_{loc}"
-
-            # Check if this face has already been processed
-            if face_id in processed_faces:
-                print(f"Skipping duplicate face in {file_path} at location {loc}")
-                continue
-
-            # Mark this face as processed
-            processed_faces[face_id] = True
-
-            # Append the face encoding and metadata to the data list for clustering
-            data.append({"imagePath": file_path, "loc": loc, "encoding": encoding})
-
-    except Exception as e:
-        print(f"Error processing file {file_path}: {e}")
-
-    # Save checkpoint after processing every `save_interval` files
-    if (idx + 1) % save_interval == 0:
-        with open(checkpoint_path, "wb") as f:
-            pickle.dump(data, f)
-        print(f"Checkpoint saved with {len(data)} items in 'data' list.")
-
-# Final save after processing all files
-with open(checkpoint_path, "wb") as f:
-    pickle.dump(data, f)
-print(f"Final checkpoint saved with {len(data)} items in 'data' list.")
-
-# Clustering with DBSCAN
-encodings = [item["encoding"] for item in data]
-dbscan_model = DBSCAN(eps=0.5, min_samples=3, metric="euclidean")
-labels = dbscan_model.fit_predict(encodings)
-unique_labels = set(labels)
-
-# Process clusters based on DBSCAN results
-for label in unique_labels:
-    if label == -1:
-        # Label -1 indicates noise, or unclustered faces
-        continue
-
-    # Create a directory for each unique face cluster
-    cluster_dir = os.path.join(config.sorted_path, f"face_{label}")
-    utils.check_and_create_dir(cluster_dir)
-
-    # Collect encodings for the current cluster to save in a .pkl file
-    cluster_encodings = []
-
-    for idx, item in enumerate([data[i] for i in range(len(data)) if labels[i] == label]):
-        try:
-            # Load the original image
-            image = cv2.imread(item["imagePath"])
-
-            # Verify that the image was successfully loaded
-            if image is None:
-                print(f"Warning: Failed to load image {item['imagePath']}. Skipping this face.")
-                continue  # Skip this iteration if the image couldn't be loaded
-
-            # Extract the face region from the image
-            top, right, bottom, left = item["loc"]
-            face_image = image[top:bottom, left:right]
-            cv2.imwrite(os.path.join(cluster_dir, f"face_{label}_{idx}.jpg"), face_image)
-
-            # Add the encoding to the cluster's list of encodings
-            cluster_encodings.append(item["encoding"])
-
-            # Append entry to CSV with image path, location, and cluster label
-            with open(csv_path, mode='a', newline='') as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow([item["imagePath"], item["loc"], label])
-
-        except Exception as e:
-            print(f"Error processing face for cluster {label} in file {item['imagePath']}: {e}")
-
-    # Save the cluster encodings to a .pkl file
-    pkl_path = os.path.join(config.cluster_path, f"face_{label}.pkl")
-    with open(pkl_path, "wb") as f:
-        pickle.dump(cluster_encodings, f)
-    print(f"Saved cluster encodings to {pkl_path}")
-
-print("Clustering complete. Face data saved to CSV.")
-formatted_dur = str(timedelta(seconds=(time.time()-tic)))
-print(f'Runtime is {formatted_dur}')
\ No newline at end of file
+# The guard keeps spawned pool workers from re-running the script when they import this module
+if __name__ == "__main__":
+    args = parse_args()
+    with profiled(args.profile, 'main_v2_profile'):
+        main(args)
@@ -1,5 +1,4 @@
 import os
-import shutil
 import pickle
 import config
 import face_recognition
@@ -7,10 +6,18 @@ import utils
 from tqdm import tqdm
 from PIL import Image
 import numpy as np
-from sklearn.cluster import DBSCAN
-import cv2
-import csv
-from face_loading import loading_face
+from clustering import cluster_faces
+from face_pipeline import encode_files, AsyncWriter, PipelineStats
+from output_tree import OutputTree
+from near_duplicates import find_near_duplicates
+from file_scanner import FileScanner
+from encoding_cache import EncodingCache
+from encoding_store import EncodingStore
+from face_crops import iter_face_crops
+from face_catalog import FaceCatalog, label_names
+from ann_index import build_catalog_index, build_results_index
+from result_sink import open_result_sink, result_table_path
+from metrics import MetricsExporter, write_json_summary
 
 # Ensure cluster and sorted directories exist
 utils.check_and_create_dir(config.cluster_path)
@@ -23,55 +30,67 @@ allowed_extensions = {'.png', '.jpeg', '.jpg', '.gif', '.bmp', '.tiff'}
 
 # Logging paths for CSV and encodings log
 csv_path = os.path.join(config.sorted_path, 'face_clusters.csv')
-encoding_log_path = os.path.join(config.sorted_path, 'face_encodings_log.pkl')
+encoding_log_path = os.path.join(config.sorted_path, 'face_encodings_log')
 
-# Prepare CSV to log face details for easy future matching
-with open(csv_path, mode='w', newline='') as csv_file:
-    writer = csv.writer(csv_file)
-    writer.writerow(['Image Path', 'Location', 'Cluster Label'])
+# Log face details for easy future matching: face_clusters.csv, plus an optional columnar table with encodings.
+# Rows are buffered and written in bulk.
+results_sink = open_result_sink(csv_path, config.results_table_format)
 
-# List to hold all encoding logs for saving at the end
-encoding_log = []
+# Columnar store holding every encoding and location, used for clustering and kept as the encodings log
+encoding_log = EncodingStore(encoding_log_path)
 
-# Use os.walk to process only image files in the input directory and all subdirectories
-all_files = []
-for root, dirs, files in os.walk(config.input_path):
-    for file in files:
-        if os.path.splitext(file.lower())[1] in allowed_extensions:
-            all_files.append(os.path.join(root, file))
+# List the image files in the input directory and all subdirectories on a thread pool,
+# reusing the saved listing of directories that did not change since the last run
+scanner = FileScanner(config.input_path, allowed_extensions, config.scan_manifest_path)
+all_files = list(scanner)
+print(f"Found {len(all_files)} images ({scanner.listed} directories listed, {scanner.reused} unchanged).")
 
 # Dictionary to track processed faces by unique identifier
 processed_faces = {}
+# Images without faces, recorded in the face catalog
+no_face_files = []
 
 # Load images and extract face encodings
-data = []
-for file_path in tqdm(all_files, total=len(all_files)):
+# Load image, decoding JPEGs at the detection size, and detect faces using CNN model for improved accuracy.
+# Unchanged files are served from the persistent encoding cache.
+encoding_cache = EncodingCache(config.encoding_cache_path, config.encoding_cache_key)
+# Files are read ahead on background threads and output writes run on a writer thread.
+stats = PipelineStats()
+output_writer = AsyncWriter(stats=stats)
+# Photos without faces are linked (or copied, or moved) into no_faces/ on a thread pool
+output_tree = OutputTree(config.sorted_path, config.output_mode, config.output_manifest_name, stats=stats)
+# Optionally publish the running metrics as a Prometheus text file
+exporter = None
+if config.prometheus_path is not None:
+    exporter = MetricsExporter(stats, config.prometheus_path, config.prometheus_interval)
+# Near-duplicate frames are detected once per group and take the faces of the group's first file
+duplicates = {}
+if config.near_duplicate_max_distance is not None:
+    duplicates = find_near_duplicates(all_files, config.near_duplicate_max_distance, stats=stats)
+    print(f"Found {len(duplicates)} near-duplicate files; detection is skipped for them.")
+results = encode_files(all_files, model="cnn",  # Updated to cnn model
+                       max_long_edge=config.detection_max_long_edge, scale=config.detection_scale,
+                       cache=encoding_cache, read_threads=4, stats=stats,
+                       crops=True, crop_max_edge=config.face_crop_max_edge, duplicates=duplicates)
+for file_path, face_locations, face_encodings, face_crops, error in tqdm(results, total=len(all_files)):
     print(f"Processing file: {file_path}")
 
-    # Check if the file exists before processing
-    if not os.path.exists(file_path):
-        print(f"File not found: {file_path}. Skipping.")
+    if error is not None:
+        print(f"Error processing file {file_path}: {error}")
         continue
-
-    # Load image
-    image = loading_face(file_path, face_recognition)
-    if image is None:
+    if face_locations is None:
         continue  # Skip if the image failed to load
 
-    # Detect faces using CNN model for improved accuracy
-    face_locations = face_recognition.face_locations(image, model="cnn")  # Updated to cnn model
-
     # Check if face locations are found
     if not face_locations:
-        print(f"No faces found in {file_path}, moving to no_faces folder.")
-        shutil.move(file_path, os.path.join(no_face_dir, os.path.basename(file_path)))
+        print(f"No faces found in {file_path}, placing it in the no_faces folder.")
+        output_tree.place(file_path, os.path.basename(no_face_dir), os.path.basename(file_path))
+        no_face_files.append(file_path)
         continue  # Skip this file if no faces are found
 
-    # Get face encodings
-    face_encodings = face_recognition.face_encodings(image, face_locations)
-
     # Process each face location and encoding
-    for loc, encoding in zip(face_locations, face_encodings):
+    new_locations, new_encodings, new_crops = [], [], []
+    for loc, encoding, crop in zip(face_locations, face_encodings, face_crops):
         # Create a unique identifier using the image path and face location
         face_id = f"{file_path}_{loc}"
 
@@ -83,57 +102,78 @@ for file_path in tqdm(all_files, total=len(all_files)):
         # Mark this face as processed
         processed_faces[face_id] = True
 
-        # Append the face encoding and metadata to the data list for clustering
-        data.append({"imagePath": file_path, "loc": loc, "encoding": encoding})
+        new_locations.append(loc)
+        new_encodings.append(encoding)
+        new_crops.append(crop)
 
-        # Log encoding and location data for future reference
-        encoding_log.append({"file_path": file_path, "location": loc, "encoding": encoding})
+    # Append the face encodings, crops and metadata to the store for clustering and future reference
+    encoding_log.append(file_path, new_locations, new_encodings, new_crops)
 
-# Convert data to numpy array for DBSCAN clustering
-encodings = [item["encoding"] for item in data]
+encoding_cache.close()
+encoding_log.close()
+print(f"Encodings log saved to {encoding_log_path}")
+
+# Memory-map the stored encodings for clustering
+faces = EncodingStore.load(encoding_log_path)
+encodings = faces.encodings
 
-# Initialize DBSCAN and fit the model on the encodings
-dbscan_model = DBSCAN(eps=0.5, min_samples=3, metric="euclidean")
-labels = dbscan_model.fit_predict(encodings)
-unique_labels = set(labels)
+# Cluster the encodings with the configured method (DBSCAN by default)
+with stats.timer("cluster"):
+    labels = cluster_faces(encodings, config.clustering_method, eps=config.clustering_eps,
+                           min_samples=config.clustering_min_samples,
+                           graph_path=os.path.join(encoding_log_path, 'neighbour_graph.npz'),
+                           graph_radius=config.neighbour_graph_radius)
+unique_labels = sorted(set(labels) - {-1})  # label -1 marks noise, i.e. unclustered faces
 
-# Process clusters based on DBSCAN results
+# Create a directory for each unique face cluster and number the crops within it
+crop_names = {}
 for label in unique_labels:
-    if label == -1:
-        # Label -1 indicates noise, or unclustered faces
+    utils.check_and_create_dir(os.path.join(config.sorted_path, f"face_{label}"))
+    for idx, row in enumerate(np.flatnonzero(labels == label)):
+        crop_names[int(row)] = f"face_{label}_{idx}.jpg"
+
+# Write the crops captured during encoding; faces without one are cut from their image, decoded once per image
+for row, crop in iter_face_crops(faces, list(crop_names), config.face_crop_max_edge):
+    label, image_path, loc = labels[row], faces.image_path(row), faces.location(row)
+    if crop is None:
+        print(f"Warning: Failed to load image {image_path}. Skipping this face.")
         continue
+    output_writer.submit(utils.write_bytes, os.path.join(config.sorted_path, f"face_{label}", crop_names[row]), crop)
 
-    # Create a directory for each unique face cluster
-    cluster_dir = os.path.join(config.sorted_path, f"face_{label}")
-    utils.check_and_create_dir(cluster_dir)
-
-    # Collect encodings for the current cluster to save in a .pkl file
-    cluster_encodings = []
+    # Log the image path, location, cluster label and encoding
+    results_sink.write(image_path, loc, label, encodings[row])
+results_sink.close()
 
-    for idx, item in enumerate([data[i] for i in range(len(data)) if labels[i] == label]):
-        # Load the original image and crop the detected face
-        image = cv2.imread(item["imagePath"])
-        top, right, bottom, left = item["loc"]
-        face_image = image[top:bottom, left:right]
-        cv2.imwrite(os.path.join(cluster_dir, f"face_{label}_{idx}.jpg"), face_image)
-
-        # Add the encoding to the cluster's list of encodings
-        cluster_encodings.append(item["encoding"])
-
-        # Append entry to CSV with image path, location, and cluster label
-        with open(csv_path, mode='a', newline='') as csv_file:
-            writer = csv.writer(csv_file)
-            writer.writerow([item["imagePath"], item["loc"], label])
-
-    # Save the cluster encodings to a .pkl file
+# Save the encodings of every cluster to a .pkl file
+for label in unique_labels:
     pkl_path = os.path.join(config.cluster_path, f"face_{label}.pkl")
     with open(pkl_path, "wb") as f:
-        pickle.dump(cluster_encodings, f)
+        pickle.dump(list(np.asarray(encodings[labels == label])), f)
     print(f"Saved cluster encodings to {pkl_path}")
 
-# Save the encoding log for future inspection and troubleshooting
-with open(encoding_log_path, "wb") as f:
-    pickle.dump(encoding_log, f)
-print(f"Encodings log saved to {encoding_log_path}")
+# Rewrite the face catalog queried by find_cluster_for_new_face and the other scripts
+catalog = FaceCatalog(config.face_catalog_path)
+catalog.clear()
+catalog.add_face_table(faces, label_names(labels))
+catalog.add_images(no_face_files)
+
+# Wait for the queued output writes, then report which stage limited throughput
+output_writer.close()
+output_tree.close()
+print(stats.report())
+
+# Rebuild the cluster index used by find_cluster_for_new_face
+if config.results_table_format is not None:
+    build_results_index(result_table_path(csv_path, config.results_table_format),
+                        versions=catalog.cluster_versions()).save(config.cluster_index_path)
+else:
+    build_catalog_index(catalog).save(config.cluster_index_path)
+catalog.close()
+
+# Per-stage timings, counters and peak RSS of the run
+write_json_summary(stats, config.metrics_path)
+if exporter is not None:
+    exporter.close()
+print(f"Metrics saved to {config.metrics_path}")
 
 print("Clustering complete. Face data saved to CSV.")
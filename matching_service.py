@@ -0,0 +1,202 @@
+"""
+Long-lived face matching service.
+
+Loads the dlib models and the cluster index once and answers match requests over HTTP
+(TCP or a Unix socket). Concurrent requests are coalesced into one batched index query.
+
+POST /match with a JSON body holding either
+- "encodings": list of 128-d face encodings, or
+- "images": list of image paths readable by the service,
+and optionally "k" (clusters per face, default 1) and "threshold" (cosine similarity, default 0.5).
+
+The response holds one entry per face: {"cluster": label or null, "similarity": best score,
+"distance": 1 - similarity, "candidates": [[label, similarity], ...]}; for images, faces are
+grouped per image and carry their "location".
+
+Usage: python matching_service.py [--host 127.0.0.1] [--port 8765] [--socket /tmp/faces.sock]
+"""
+import os
+import json
+import queue
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import config
+from face_pipeline import encode_file_batch
+from find_cluster_for_new_face import load_cluster_index
+
+
+class MatchBatcher:
+    """
+    Coalesces concurrent match requests into a single vectorized index query.
+
+    Requests are queued by the handler threads; one worker thread drains everything that
+    arrives within max_wait seconds (up to max_batch encodings) and runs one search_batch.
+    """
+
+    def __init__(self, index, max_batch=256, max_wait=0.002):
+        """
+        :param index: ClusterIndex to query
+        :param max_batch: Maximum number of encodings per batched query
+        :param max_wait: Seconds to wait for more requests after the first one arrives
+        """
+        self.index = index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.queries = 0
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def search(self, encodings, k=1):
+        """
+        Queue encodings for matching and wait for the result.
+        :param encodings: Array of shape (n, 128)
+        :param k: Number of clusters to return per encoding
+        :return: One list of (cluster name, cosine similarity) pairs per encoding
+        """
+        request = {"encodings": np.asarray(encodings, dtype=np.float32).reshape(-1, 128), "k": k,
+                   "done": threading.Event(), "result": None}
+        if len(request["encodings"]) == 0:
+            return []
+        self._queue.put(request)
+        request["done"].wait()
+        if isinstance(request["result"], Exception):
+            raise request["result"]
+        return request["result"]
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            size = len(pending[0]["encodings"])
+            while size < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                size += len(request["encodings"])
+
+            try:
+                k = max(request["k"] for request in pending)
+                results = self.index.search_batch(np.concatenate([r["encodings"] for r in pending]), k)
+                self.batches += 1
+                self.queries += size
+                start = 0
+                for request in pending:
+                    end = start + len(request["encodings"])
+                    request["result"] = [matches[:request["k"]] for matches in results[start:end]]
+                    start = end
+            except Exception as e:
+                for request in pending:
+                    request["result"] = e
+            for request in pending:
+                request["done"].set()
+
+
+def describe_matches(matches, threshold):
+    best_label, best_similarity = matches[0] if matches else (None, None)
+    return {"cluster": best_label if best_similarity is not None and best_similarity > threshold else None,
+            "similarity": best_similarity,
+            "distance": None if best_similarity is None else 1.0 - best_similarity,
+            "candidates": [[label, similarity] for label, similarity in matches]}
+
+
+def make_handler(batcher):
+    class MatchHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/health':
+                return self._reply(404, {"error": "not found"})
+            self._reply(200, {"clusters": len(batcher.index.label_names), "encodings": len(batcher.index),
+                              "batches": batcher.batches, "queries": batcher.queries})
+
+        def do_POST(self):
+            if self.path != '/match':
+                return self._reply(404, {"error": "not found"})
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                k = int(body.get("k", 1))
+                threshold = float(body.get("threshold", 0.5))
+                if "encodings" in body:
+                    results = batcher.search(body["encodings"], k)
+                    return self._reply(200, {"results": [describe_matches(m, threshold) for m in results]})
+                if "images" in body:
+                    return self._reply(200, {"results": self._match_images(body["images"], k, threshold)})
+                self._reply(400, {"error": "expected 'encodings' or 'images'"})
+            except Exception as e:
+                self._reply(400, {"error": str(e)})
+
+        def _match_images(self, image_paths, k, threshold):
+            # Detect every image first, then encode all their faces in one batch and match them in one batch
+            per_image = []
+            for image_path, locations, image_encodings, _, error in encode_file_batch(
+                    [(image_path, None) for image_path in image_paths], model="hog",
+                    max_long_edge=config.detection_max_long_edge, scale=config.detection_scale):
+                if locations is None:
+                    raise ValueError(f"cannot process {image_path}: {error or 'failed to load'}")
+                per_image.append((image_path, locations, image_encodings))
+            encodings = [encoding for _, _, image_encodings in per_image for encoding in image_encodings]
+            matches = iter(batcher.search(encodings, k)) if encodings else iter(())
+            results = []
+            for image_path, locations, image_encodings in per_image:
+                faces = [dict(describe_matches(next(matches), threshold), location=list(location))
+                         for location in locations[:len(image_encodings)]]
+                results.append({"image": image_path, "faces": faces})
+            return results
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # one line per request would dominate the output under load
+
+    return MatchHandler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', help="Serve on this Unix socket path instead of TCP")
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    batcher = MatchBatcher(load_cluster_index(), args.max_batch, args.max_wait_ms / 1000.0)
+    handler = make_handler(batcher)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, handler)
+        print(f"Matching service listening on {args.socket}")
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print(f"Matching service listening on http://{args.host}:{args.port}")
+    print(f"{len(batcher.index.label_names)} clusters, {len(batcher.index)} encodings loaded.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process.
+    :return: Bytes, or None when the platform exposes neither resource nor psutil
+    """
+    if resource is not None:
+        return _maxrss_bytes(resource.RUSAGE_SELF)
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)  # peak working set on Windows
+    return None
+
+
+def peak_child_rss_bytes():
+    """
+    Peak resident set size of the largest finished child process, whatever started it; callers
+    report it as a worker's peak only when a --workers pool ran (see PipelineStats.worker_pool).
+    :return: Bytes, or None when no child has finished or the platform has no resource module
+    """
+    if resource is None:
+        return None
+    return _maxrss_bytes(resource.RUSAGE_CHILDREN) or None
+
+
+def _maxrss_bytes(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return unit * resource.getrusage(who).ru_maxrss
+
+
+def _write_atomic(path, text):
+    # Readers (e.g. the node_exporter textfile collector) never see a half-written file
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(path + '.tmp', path)
+
+
+def write_json_summary(stats, path):
+    """Write PipelineStats.summary() as JSON."""
+    _write_atomic(path, json.dumps(stats.summary(), indent=2))
+
+
+def prometheus_text(summary, prefix="face_pipeline"):
+    """
+    Render a PipelineStats summary in the Prometheus text exposition format.
+    :param summary: Dict returned by PipelineStats.summary()
+    :return: Metrics text
+    """
+    lines = [f"# TYPE {prefix}_wall_seconds gauge", f"{prefix}_wall_seconds {summary['wall_seconds']:.3f}"]
+    for name, value in summary["counters"].items():
+        lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value}"]
+    for metric in ("peak_rss_bytes", "peak_child_rss_bytes"):
+        if summary.get(metric) is not None:
+            lines += [f"# TYPE {prefix}_{metric} gauge", f"{prefix}_{metric} {summary[metric]}"]
+    for metric, key, kind in (("stage_items", "items", "counter"), ("stage_busy_seconds", "busy_seconds", "counter"),
+                              ("stage_bytes", "bytes", "counter"), ("stage_utilization", "utilization", "gauge")):
+        lines.append(f"# TYPE {prefix}_{metric} {kind}")
+        for name, stage in summary["stages"].items():
+            lines.append(f'{prefix}_{metric}{{stage="{name}"}} {stage[key]:g}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(stats, path):
+    """Write the current metrics of a PipelineStats as a Prometheus text file."""
+    _write_atomic(path, prometheus_text(stats.summary()))
+
+
+class MetricsExporter:
+    """Rewrites a Prometheus text file from a PipelineStats every `interval` seconds while a run is going."""
+
+    def __init__(self, stats, path, interval=15.0):
+        self.stats = stats
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop exporting and write the final values."""
+        self._stop.set()
+        self._thread.join()
+        write_prometheus(self.stats, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                write_prometheus(self.stats, self.path)
+            except OSError as e:
+                print(f"Error writing metrics to {self.path}: {e}")
+
+
+@contextmanager
+def profiled(profiler, output_path):
+    """
+    Profile the enclosed block.
+    :param profiler: None (no profiling), "cprofile" (writes a .prof file for pstats/snakeviz)
+                     or "pyinstrument" (writes an HTML report, requires pyinstrument)
+    :param output_path: Path of the report, without extension
+    """
+    if profiler is None:
+        yield
+        return
+    if profiler == "cprofile":
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_path + '.prof')
+            print(f"Saved cProfile output to {output_path}.prof")
+    elif profiler == "pyinstrument":
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            _write_atomic(output_path + '.html', profile.output_html())
+            print(f"Saved pyinstrument output to {output_path}.html")
+    else:
+        raise ValueError(f"Unknown profiler: {profiler}")
@@ -0,0 +1,69 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+
+
+def dhash(file_path, hash_size=8):
+    """
+    Difference hash of an image: the signs of the horizontal gradients of a tiny grayscale copy.
+    JPEGs are decoded at 1/8 scale by PIL's draft mode, so hashing costs a fraction of a full decode.
+    :param file_path: Path to the image file
+    :param hash_size: Side of the gradient grid; the hash has hash_size ** 2 bits
+    :return: Tuple (hash as int, (width, height) of the image), or None if the image can't be read
+    """
+    try:
+        with Image.open(file_path) as img:
+            size = img.size
+            img.draft('L', (8 * (hash_size + 1), 8 * hash_size))
+            pixels = np.asarray(img.convert('L').resize((hash_size + 1, hash_size), Image.BOX), dtype=np.int16)
+    except Exception:
+        return None
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big'), size
+
+
+def find_near_duplicates(file_paths, max_distance=4, threads=4, hash_size=8, stats=None):
+    """
+    Group near-identical images, such as burst shots and exported copies, by their difference hash.
+    Each group is led by its first file in file_paths; a later file joins a group when it has the
+    same dimensions and its hash is within max_distance bits of the leader's. Comparing with the
+    leader only (not with every member) keeps a slowly drifting burst from chaining into one group.
+    Candidate leaders are found with a multi-index: the hash is split into max_distance + 1 bands,
+    and two hashes within max_distance bits must agree exactly on at least one band.
+    :param file_paths: List of image paths
+    :param max_distance: Maximum number of differing hash bits for a duplicate
+    :param threads: Number of threads hashing files
+    :param hash_size: Side of the gradient grid of the hash
+    :param stats: Optional PipelineStats receiving a "dedup" stage timer
+    :return: Dict sibling path -> leader path, for every file that is a near-duplicate of an earlier one
+    """
+    bits = hash_size * hash_size
+    bands = max_distance + 1
+    edges = [bits * band // bands for band in range(bands + 1)]
+    masks = [((1 << (end - start)) - 1, start) for start, end in zip(edges, edges[1:])]
+    stage = stats.stage("dedup", threads) if stats is not None else None
+
+    def timed_hash(file_path):
+        tic = time.perf_counter()
+        result = dhash(file_path, hash_size)
+        if stage is not None:
+            stage.add(time.perf_counter() - tic)
+        return result
+
+    leaders = {}  # (band, band value, image size) -> list of (leader hash, leader path)
+    duplicates = {}
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        for file_path, hashed in zip(file_paths, executor.map(timed_hash, file_paths)):
+            if hashed is None:
+                continue
+            value, size = hashed
+            keys = [(band, (value >> shift) & mask, size) for band, (mask, shift) in enumerate(masks)]
+            leader = next((path for key in keys for leader_value, path in leaders.get(key, ())
+                           if bin(value ^ leader_value).count('1') <= max_distance), None)
+            if leader is not None:
+                duplicates[file_path] = leader
+            else:
+                for key in keys:
+                    leaders.setdefault(key, []).append((value, file_path))
+    return duplicates
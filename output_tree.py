@@ -0,0 +1,207 @@
+import os
+import csv
+import sys
+import json
+import errno
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# "manifest" only records where every file would go; "move" takes the file out of the input tree
+OUTPUT_MODES = ("hardlink", "symlink", "reflink", "copy", "move", "manifest")
+
+# FICLONE ioctl request on Linux (btrfs, XFS, ...): share the extents of another file
+_FICLONE = 0x40049409
+
+
+def _reflink(source, destination):
+    # Copy-on-write clone: no data is written until one of the files changes
+    if sys.platform == 'darwin':
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), destination)
+    elif sys.platform.startswith('linux'):
+        import fcntl
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+    else:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported on this platform", destination)
+
+
+def _replace_with(create, destination):
+    # Links can't overwrite, so create them next to the destination and rename over it
+    temporary = f"{destination}.{threading.get_ident()}.tmp"
+    try:
+        create(temporary)
+        os.replace(temporary, destination)
+    except OSError:
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def place_file(source, destination, mode="hardlink"):
+    """
+    Materialize a file of the output tree.
+    Links and reflinks that the file system refuses (another device, no support, no privilege)
+    fall back to a copy.
+    :param source: Original file
+    :param destination: Path in the output tree; its directory must exist
+    :param mode: One of OUTPUT_MODES except "manifest"
+    :return: The mode actually used
+    """
+    if mode == "move":
+        shutil.move(source, destination)
+        return mode
+    try:
+        if mode == "hardlink":
+            _replace_with(lambda path: os.link(source, path), destination)
+            return mode
+        if mode == "symlink":
+            _replace_with(lambda path: os.symlink(os.path.abspath(source), path), destination)
+            return mode
+        if mode == "reflink":
+            _replace_with(lambda path: _reflink(source, path), destination)
+            return mode
+    except OSError:
+        pass
+    shutil.copy(source, destination)
+    return "copy"
+
+
+class OutputTree:
+    """
+    Output stage that places original photos into the sorted tree as links instead of copies.
+
+    Placements are queued, grouped into batches and run on a thread pool; every placement is also
+    recorded in a manifest (CSV or JSON, by extension) written to the tree root on close(), which
+    in "manifest" mode is the only output.
+
+    In "move" mode a file placed at several destinations (a photo with faces in several clusters) is
+    moved to the first one, and hard-linked (or copied) from there to the others on close().
+    """
+
+    def __init__(self, root, mode="hardlink", manifest_name='output_manifest.csv', threads=8, batch_size=64,
+                 keep_existing=False, stats=None):
+        """
+        :param root: Root of the output tree
+        :param mode: One of OUTPUT_MODES
+        :param manifest_name: File name of the manifest in root, None for no manifest
+        :param threads: Number of threads placing files
+        :param batch_size: Number of placements per thread pool task
+        :param keep_existing: Keep the entries of an existing manifest (for runs that add to the tree)
+        :param stats: Optional PipelineStats receiving a "place" stage
+        """
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {mode}")
+        self.root = root
+        self.mode = mode
+        self.manifest_name = manifest_name
+        self.batch_size = batch_size
+        self.fallbacks = 0  # placements that had to copy instead of linking
+        self._rows = []
+        self._batch = []
+        self._lock = threading.Lock()
+        self._stats = stats.stage("place", threads) if stats is not None else None
+        self._executor = ThreadPoolExecutor(max_workers=threads) if mode != "manifest" else None
+        # Bounds the queued batches, so a slow disk holds back the producer instead of filling memory
+        self._slots = threading.BoundedSemaphore(2 * threads)
+        self._futures = []
+        self._moved = {}  # source -> destination it is moved to, in "move" mode
+        self._extra = []  # (source, destination) placed from the moved file on close(), in "move" mode
+        if keep_existing and manifest_name is not None:
+            self._rows = self._read_manifest(os.path.join(root, manifest_name))
+
+    def place(self, source, *parts):
+        """
+        Queue placing a file at os.path.join(root, *parts); missing directories are created.
+        :param source: Original file
+        :param parts: Path of the destination relative to root
+        """
+        destination = os.path.join(self.root, *parts)
+        if self.mode == "move":
+            # The file can only be moved once; it may still be queued, so later destinations wait for close()
+            if source in self._moved:
+                self._extra.append((source, destination))
+                return
+            self._moved[source] = destination
+        self._batch.append((source, destination))
+        if len(self._batch) >= self.batch_size:
+            self._submit()
+
+    def close(self):
+        """Wait for every queued placement and write the manifest."""
+        if self._batch:
+            self._submit()
+        for future in self._futures:
+            future.result()
+        if self._executor is not None:
+            self._executor.shutdown()
+        for source, destination in self._extra:
+            try:
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                used = place_file(self._moved[source], destination, "hardlink")
+            except OSError as e:
+                print(f"Error placing {source} at {destination}: {e}")
+                continue
+            self._rows.append((destination, source, used))
+        if self.fallbacks:
+            print(f"{self.fallbacks} files were copied because {self.mode} is not possible for them.")
+        if self.manifest_name is not None:
+            self._write_manifest(os.path.join(self.root, self.manifest_name))
+
+    def _submit(self):
+        batch, self._batch = self._batch, []
+        if self._executor is None:
+            self._rows.extend((destination, source, self.mode) for source, destination in batch)
+            return
+        self._slots.acquire()
+        self._futures = [future for future in self._futures if not future.done()]
+        self._futures.append(self._executor.submit(self._place_batch, batch))
+
+    def _place_batch(self, batch):
+        try:
+            tic = time.perf_counter()
+            rows, fallbacks = [], 0
+            for source, destination in batch:
+                try:
+                    os.makedirs(os.path.dirname(destination), exist_ok=True)
+                    used = place_file(source, destination, self.mode)
+                except OSError as e:
+                    print(f"Error placing {source} at {destination}: {e}")
+                    continue
+                fallbacks += used != self.mode
+                rows.append((destination, source, used))
+            with self._lock:
+                self._rows.extend(rows)
+                self.fallbacks += fallbacks
+            if self._stats is not None:
+                self._stats.add(time.perf_counter() - tic, items=len(batch))
+        finally:
+            self._slots.release()
+
+    def _read_manifest(self, path):
+        if not os.path.exists(path):
+            return []
+        with open(path, newline='', encoding='utf-8') as f:
+            entries = json.load(f) if path.endswith('.json') else list(csv.DictReader(f))
+        return [(os.path.join(self.root, entry["path"]), entry["source"], entry["mode"]) for entry in entries]
+
+    def _write_manifest(self, path):
+        # A later placement at the same path replaces the earlier one
+        latest = {destination: (destination, source, mode) for destination, source, mode in self._rows}
+        rows = sorted(latest.values())
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            if path.endswith('.json'):
+                json.dump([{"path": os.path.relpath(destination, self.root), "source": source, "mode": mode}
+                           for destination, source, mode in rows], f, indent=1)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(["path", "source", "mode"])
+                writer.writerows((os.path.relpath(destination, self.root), source, mode)
+                                 for destination, source, mode in rows)
+        print(f"Output manifest with {len(rows)} files saved to {path}")
@@ -0,0 +1,187 @@
+import os
+import csv
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+RESULT_TABLE_FORMATS = ("parquet", "arrow")
+
+
+class CsvResultSink:
+    """
+    Buffered writer of face_clusters.csv.
+    Rows are collected in memory and appended in bulk, one open per buffer instead of one per face.
+    """
+
+    def __init__(self, path, encoding=None, buffer_rows=1000, append=False):
+        """
+        :param path: CSV file
+        :param encoding: Text encoding of the file, None for the platform default
+        :param buffer_rows: Number of rows collected before they are written
+        :param append: Keep the rows of an existing file instead of starting a new one
+        """
+        self.path = path
+        self.encoding = encoding
+        self.buffer_rows = buffer_rows
+        self._rows = []
+        if not (append and os.path.exists(path)):
+            with open(path, mode='w', newline='', encoding=encoding) as csv_file:
+                csv.writer(csv_file).writerow(['Image Path', 'Location', 'Cluster Label'])
+
+    def write(self, image_path, location, label, face_encoding=None):
+        self._rows.append([image_path, tuple(location), label])
+        if len(self._rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        with open(self.path, mode='a', newline='', encoding=self.encoding) as csv_file:
+            csv.writer(csv_file).writerows(self._rows)
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+
+class ArrowResultSink:
+    """
+    Columnar results table with the face encodings included, written as Parquet or Arrow IPC.
+    Downstream matching loads every face, its cluster and its encoding with one read_results()
+    call instead of joining the CSV against the cluster pickles. Requires pyarrow.
+    """
+
+    def __init__(self, path, table_format="parquet", dim=128, buffer_rows=10000):
+        """
+        :param path: Output file, replaced if it exists
+        :param table_format: "parquet" or "arrow" (Arrow IPC file, memory-mappable)
+        :param dim: Length of a face encoding
+        :param buffer_rows: Number of rows per written batch (Parquet row group)
+        """
+        if pyarrow is None:
+            raise ImportError("Columnar result tables require the pyarrow package")
+        if table_format not in RESULT_TABLE_FORMATS:
+            raise ValueError(f"Unknown result table format: {table_format}")
+        self.path = path
+        self.table_format = table_format
+        self.dim = dim
+        self.buffer_rows = buffer_rows
+        self.schema = pyarrow.schema([
+            ("image_path", pyarrow.string()),
+            ("location", pyarrow.list_(pyarrow.int32(), 4)),
+            ("cluster", pyarrow.int64()),
+            ("encoding", pyarrow.list_(pyarrow.float32(), dim)),
+        ])
+        if table_format == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            self._writer = pyarrow.ipc.new_file(path, self.schema)
+        self._batches = []
+        self._rows = 0
+
+    def write(self, image_path, location, label, face_encoding=None):
+        self.write_batch([image_path], [location], [label], [face_encoding])
+
+    def write_batch(self, image_paths, locations, labels, face_encodings):
+        """
+        Add many faces at once.
+        :param image_paths: Image path of every face
+        :param locations: Array of shape (n, 4)
+        :param labels: Cluster label of every face
+        :param face_encodings: Array of shape (n, dim); rows of None are stored as NaN
+        """
+        if any(encoding is None for encoding in face_encodings):
+            face_encodings = [np.full(self.dim, np.nan) if encoding is None else encoding
+                              for encoding in face_encodings]
+        self._batches.append((list(image_paths), np.asarray(locations, dtype=np.int32).reshape(-1, 4),
+                              np.asarray(labels, dtype=np.int64),
+                              np.asarray(face_encodings, dtype=np.float32).reshape(-1, self.dim)))
+        self._rows += len(self._batches[-1][0])
+        if self._rows >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._batches:
+            return
+        image_paths = [path for batch in self._batches for path in batch[0]]
+        locations, labels, encodings = (np.concatenate([batch[i] for batch in self._batches]) for i in (1, 2, 3))
+        self._batches, self._rows = [], 0
+        self._writer.write_batch(pyarrow.record_batch([
+            pyarrow.array(image_paths, pyarrow.string()),
+            pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(locations.ravel()), 4),
+            pyarrow.array(labels),
+            pyarrow.FixedSizeListArray.from_arrays(pyarrow.array(encodings.ravel()), self.dim),
+        ], schema=self.schema))
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class ResultSinks:
+    """Fans every result row out to several sinks, e.g. the CSV and a columnar table."""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, image_path, location, label, face_encoding=None):
+        for sink in self.sinks:
+            sink.write(image_path, location, label, face_encoding)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def result_table_path(csv_path, table_format):
+    """Path of the columnar table written next to face_clusters.csv."""
+    return os.path.splitext(csv_path)[0] + ('.parquet' if table_format == "parquet" else '.arrow')
+
+
+def open_result_sink(csv_path, table_format=None, encoding=None, append=False):
+    """
+    Open the result writers of a clustering run.
+    :param csv_path: Path of face_clusters.csv
+    :param table_format: None for the CSV only, or "parquet" / "arrow" to also write a columnar
+                         table with encodings next to it
+    :param encoding: Text encoding of the CSV
+    :param append: Keep the rows of an existing CSV
+    :return: Sink with write(image_path, location, label, face_encoding), flush() and close()
+    """
+    sinks = [CsvResultSink(csv_path, encoding=encoding, append=append)]
+    if table_format is not None:
+        sinks.append(ArrowResultSink(result_table_path(csv_path, table_format), table_format))
+    return ResultSinks(sinks)
+
+
+def read_results(path):
+    """
+    Load a columnar results table in a single read.
+    :param path: .parquet or .arrow file written by ArrowResultSink
+    :return: Dict of image_path (list), location (n x 4 int32), cluster (n int64) and
+             encoding (n x dim float32) arrays
+    """
+    if pyarrow is None:
+        raise ImportError("Reading result tables requires the pyarrow package")
+    if path.endswith('.parquet'):
+        return _table_columns(pyarrow.parquet.read_table(path))
+    with pyarrow.memory_map(path) as source:
+        # Columns are copied out before the mapping is closed
+        return _table_columns(pyarrow.ipc.open_file(source).read_all())
+
+
+def _table_columns(table):
+    dim = table.schema.field("encoding").type.list_size
+    return {"image_path": table.column("image_path").to_pylist(),
+            "location": table.column("location").combine_chunks().flatten().to_numpy().reshape(-1, 4).copy(),
+            "cluster": table.column("cluster").to_numpy().copy(),
+            "encoding": table.column("encoding").combine_chunks().flatten().to_numpy().reshape(-1, dim).copy()}
@@ -0,0 +1,135 @@
+import os
+import json
+import sqlite3
+import numpy as np
+
+
+class RunJournal:
+    """
+    Append-only journal of the files a run has finished, with the faces found in each.
+
+    Every file is recorded in its own SQLite transaction (WAL mode), so an interrupted run
+    resumes from the last finished file: completed files are skipped with a dict lookup, and
+    faces that were journalled but not yet committed to the encoding store are restored from
+    the journal by recover(). Files that failed to load are not recorded and are retried.
+
+    Every entry carries the version of the file it was made from (see file_version): a file
+    rewritten in place, or a run with other detection settings, no longer matches its entry
+    and is processed again.
+    """
+
+    def __init__(self, path, dim=128):
+        """
+        :param path: Path of the SQLite journal file, normally inside the encoding store directory
+        :param dim: Length of a face encoding
+        """
+        self.path = path
+        self.dim = dim
+        self._connection = sqlite3.connect(path)
+        # WAL appends each commit to a log instead of rewriting pages; with synchronous=NORMAL a
+        # power loss may drop the last commits, but never leaves a half-written one
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS completed ("
+            " path TEXT PRIMARY KEY,"
+            " face_count INTEGER NOT NULL,"
+            " locations TEXT NOT NULL,"
+            " encodings BLOB NOT NULL,"
+            " crop_lengths TEXT,"
+            " crops BLOB,"
+            " version TEXT)")
+        # Journals written before entries were versioned get the column; their entries match no version
+        if "version" not in [row[1] for row in self._connection.execute("PRAGMA table_info(completed)")]:
+            self._connection.execute("ALTER TABLE completed ADD COLUMN version TEXT")
+        self._connection.commit()
+        self._completed = dict(self._connection.execute("SELECT path, version FROM completed"))
+
+    def __len__(self):
+        return len(self._completed)
+
+    def __contains__(self, file_path):
+        return file_path in self._completed
+
+    def __iter__(self):
+        return iter(list(self._completed))
+
+    @staticmethod
+    def file_version(file_path, settings):
+        """
+        Version of a file as processed with some detection settings.
+        :param file_path: Path of the image
+        :param settings: Detection settings, see EncodingCache.settings_key
+        :return: String made of the size, mtime_ns and settings, None if the file cannot be read
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return json.dumps([stat.st_size, stat.st_mtime_ns, settings])
+
+    def is_current(self, file_path, version):
+        """Whether a file was finished in the given version (see file_version)."""
+        return version is not None and self._completed.get(file_path) == version
+
+    def forget(self, file_paths):
+        """Remove the entries of files, e.g. files that changed or left the input directory."""
+        file_paths = [file_path for file_path in file_paths if file_path in self._completed]
+        with self._connection:
+            self._connection.executemany("DELETE FROM completed WHERE path = ?", [(path,) for path in file_paths])
+        for file_path in file_paths:
+            del self._completed[file_path]
+
+    def record(self, file_path, face_locations, face_encodings, face_crops=None, version=None):
+        """
+        Mark a file as finished, together with its faces; an empty face_locations list records a
+        file without faces. The entry is committed before this returns.
+        :param file_path: Path of the image
+        :param face_locations: List of (top, right, bottom, left) tuples
+        :param face_encodings: List of encodings, one per location
+        :param face_crops: Optional list of JPEG crops (bytes or None), one per location
+        :param version: Version of the file, see file_version
+        """
+        locations = json.dumps([[int(value) for value in location] for location in face_locations])
+        encodings = np.asarray(face_encodings, dtype=np.float32).tobytes()
+        crop_lengths, crops = None, None
+        if face_crops is not None:
+            crop_lengths = json.dumps([len(crop) if crop else 0 for crop in face_crops])
+            crops = b''.join(crop for crop in face_crops if crop)
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO completed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (file_path, len(face_locations), locations, encodings, crop_lengths, crops,
+                                      version))
+        self._completed[file_path] = version
+
+    def files_without_faces(self):
+        """Paths of the finished files in which no face was found."""
+        return [row[0] for row in self._connection.execute("SELECT path FROM completed WHERE face_count = 0")]
+
+    def recover(self, store):
+        """
+        Append to an encoding store the faces of every journalled file it does not hold, i.e.
+        files finished after the store's last flush before a crash. The store is flushed after.
+        :param store: EncodingStore opened for appending
+        :return: Number of files restored
+        """
+        restored = 0
+        for file_path, locations, encodings, crop_lengths, crops in self._connection.execute(
+                "SELECT path, locations, encodings, crop_lengths, crops FROM completed WHERE face_count > 0"
+                " ORDER BY rowid"):
+            if file_path in store:
+                continue
+            face_locations = [tuple(location) for location in json.loads(locations)]
+            face_encodings = np.frombuffer(encodings, dtype=np.float32).reshape(len(face_locations), self.dim)
+            face_crops = None
+            if crop_lengths is not None:
+                bounds = np.concatenate([[0], np.cumsum(json.loads(crop_lengths))])
+                face_crops = [crops[start:end] or None for start, end in zip(bounds[:-1], bounds[1:])]
+            store.append(file_path, face_locations, face_encodings, face_crops)
+            restored += 1
+        if restored:
+            store.flush()
+        return restored
+
+    def close(self):
+        self._connection.close()
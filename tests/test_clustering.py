@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+from clustering import NeighbourGraph, cluster_faces
+from synthetic import make_dataset
+
+
+def edge_set(graph):
+    return set(zip(graph.rows.tolist(), graph.cols.tolist()))
+
+
+def test_extended_graph_matches_fresh_build():
+    encodings, _ = make_dataset(3000, seed=1)
+    fresh = NeighbourGraph.build(encodings)
+    extended = NeighbourGraph.build(encodings[:1000])
+    for end in (1500, 2200, 3000):
+        extended.extend(encodings[:end], chunk_size=300)
+    assert edge_set(extended) == edge_set(fresh)
+
+
+def test_extend_then_cluster_matches_dbscan():
+    encodings, _ = make_dataset(3000, seed=1)
+    graph = NeighbourGraph.build(encodings[:1000]).extend(encodings)
+    labels = cluster_faces(encodings, "graph_dbscan", eps=0.5, min_samples=3, graph=graph)
+    expected = DBSCAN(eps=0.5, min_samples=3).fit_predict(encodings)
+    np.testing.assert_array_equal(labels, expected)
@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+from sklearn.metrics import adjusted_rand_score
+from incremental_clustering import IncrementalClustering
+from synthetic import make_dataset
+
+
+@pytest.mark.parametrize("steps", [(3000,), (1000, 3000), (1000, 1500, 2200, 3000)])
+def test_incremental_matches_full_dbscan(tmp_path, steps):
+    encodings, _ = make_dataset(3000, seed=1)
+    dbscan = DBSCAN(eps=0.5, min_samples=3).fit(encodings)
+    core = np.zeros(len(encodings), dtype=bool)
+    core[dbscan.core_sample_indices_] = True
+
+    state = IncrementalClustering(eps=0.5, min_samples=3)
+    for end in steps:
+        state.update(encodings[:end], graph_path=str(tmp_path / 'neighbour_graph.npz'))
+
+    np.testing.assert_array_equal(state.is_core, core)
+    np.testing.assert_array_equal(state.labels == -1, dbscan.labels_ == -1)
+    assert adjusted_rand_score(state.labels[core], dbscan.labels_[core]) == 1.0
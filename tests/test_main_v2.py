@@ -0,0 +1,62 @@
+import os
+import sys
+import sqlite3
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image
+
+# A stand-in detector: one face in every bright image, encoded from the image brightness
+fake_face_recognition = types.ModuleType("face_recognition")
+fake_face_recognition.load_image_file = lambda path, mode='RGB': np.array(Image.open(path).convert(mode))
+fake_face_recognition.face_locations = lambda image, up=1, model='hog': [(10, 60, 50, 20)] if image.mean() > 100 else []
+fake_face_recognition.face_encodings = lambda image, locations, *args, **kwargs: [
+    np.full(128, image.mean() / 255.0) for _ in locations]
+sys.modules.setdefault("face_recognition", fake_face_recognition)
+
+import config
+import face_pipeline
+import main_v2
+from encoding_store import EncodingStore
+from face_catalog import label_names
+from incremental_clustering import IncrementalClustering
+
+
+def run(monkeypatch, *arguments):
+    monkeypatch.setattr(sys, "argv", ["main_v2.py", "--no-cache", "--read-threads", "0", *arguments])
+    main_v2.main(main_v2.parse_args())
+
+
+def catalog_rows():
+    with sqlite3.connect(config.face_catalog_path) as connection:
+        return connection.execute(
+            "SELECT faces.id, images.path, clusters.name FROM faces JOIN images ON images.id = faces.image_id"
+            " LEFT JOIN clusters ON clusters.id = faces.cluster_id ORDER BY faces.id").fetchall()
+
+
+def test_catalog_matches_store_after_file_changes_before_incremental_run(tmp_path, monkeypatch):
+    input_path = tmp_path / "photos"
+    input_path.mkdir()
+    for i, gray in enumerate([150, 151, 152, 153, 220, 221, 222, 223, 30]):
+        Image.fromarray(np.full((80, 80, 3), gray, dtype=np.uint8)).save(input_path / f"img_{i:02d}.png")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(face_pipeline, "face_recognition", fake_face_recognition)
+    monkeypatch.setattr(config, "input_path", str(input_path))
+    monkeypatch.setattr(config, "near_duplicate_max_distance", None)
+    monkeypatch.setattr(config, "output_mode", "copy")
+
+    run(monkeypatch)
+    os.remove(input_path / "img_00.png")
+    Image.fromarray(np.full((80, 80, 3), 224, dtype=np.uint8)).save(input_path / "img_01.png")
+    os.utime(input_path / "img_01.png", ns=(1, 1))
+    run(monkeypatch, "--incremental")
+
+    faces = EncodingStore.load(config.encoding_store_path)
+    labels = IncrementalClustering.load(os.path.join(config.encoding_store_path, 'incremental_clustering.npz'),
+                                        config.clustering_eps, config.clustering_min_samples).labels
+    expected = [(row, os.path.abspath(faces.image_path(row)), name)
+                for row, name in enumerate(label_names(labels))]
+    assert len(faces) == 7
+    assert catalog_rows() == expected
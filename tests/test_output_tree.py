@@ -0,0 +1,27 @@
+import os
+import sys
+import csv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from output_tree import OutputTree
+
+
+def test_move_places_an_image_in_every_cluster(tmp_path):
+    source = tmp_path / "input" / "photo.jpg"
+    source.parent.mkdir()
+    source.write_bytes(b"jpeg")
+    root = tmp_path / "sorted"
+
+    tree = OutputTree(str(root), mode="move", batch_size=1, threads=4)
+    for cluster in ("face_0", "face_1", "face_2"):
+        tree.place(str(source), cluster, "photo.jpg")
+    tree.close()
+
+    assert not source.exists()
+    for cluster in ("face_0", "face_1", "face_2"):
+        assert (root / cluster / "photo.jpg").read_bytes() == b"jpeg"
+    with open(root / "output_manifest.csv", newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [row["path"] for row in rows] == [os.path.join(c, "photo.jpg") for c in ("face_0", "face_1", "face_2")]
+    assert {row["source"] for row in rows} == {str(source)}
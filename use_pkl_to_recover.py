@@ -3,10 +3,13 @@ import pickle
 import config
 import face_recognition
 import numpy as np
-from sklearn.cluster import DBSCAN
-import cv2
-import csv
+from clustering import cluster_faces
 import utils
+from encoding_store import EncodingStore, FaceTable
+from face_crops import iter_face_crops
+from face_catalog import FaceCatalog, label_names
+from ann_index import build_catalog_index
+from result_sink import open_result_sink
 from datetime import timedelta
 import time
 
@@ -23,82 +26,65 @@ csv_path = os.path.join(sorted_path, 'face_clusters.csv')
 utils.check_and_create_dir(cluster_path)
 utils.check_and_create_dir(sorted_path)
 
-# Function to safely load images with non-ASCII characters in paths
-def load_image(image_path):
-    try:
-        with open(image_path, 'rb') as file:
-            file_bytes = np.asarray(bytearray(file.read()), dtype=np.uint8)
-            image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-            return image
-    except Exception as e:
-        print(f"Warning: Could not load image at {image_path}: {e}")
-        return None
-
-# Load checkpoint data
-if os.path.exists(checkpoint_path):
+# Load checkpoint data: memory-map the columnar encoding store, or fall back to a legacy pickle checkpoint
+if EncodingStore.exists(config.encoding_store_path):
+    faces = EncodingStore.load(config.encoding_store_path)
+    print(f"Resumed from encoding store with {len(faces)} faces.")
+elif os.path.exists(checkpoint_path):
     with open(checkpoint_path, "rb") as f:
-        data = pickle.load(f)
-    print(f"Resumed from checkpoint with {len(data)} items in 'data' list.")
+        faces = FaceTable.from_records(pickle.load(f))
+    print(f"Resumed from checkpoint with {len(faces)} items in 'data' list.")
 else:
     print("No checkpoint found. Exiting.")
     exit()
 
-# Clustering with DBSCAN
-encodings = [item["encoding"] for item in data]
-dbscan_model = DBSCAN(eps=0.5, min_samples=3, metric="euclidean")
-labels = dbscan_model.fit_predict(encodings)
-unique_labels = set(labels)
-
-# Prepare CSV to log face details with UTF-8 encoding
-with open(csv_path, mode='w', newline='', encoding='utf-8') as csv_file:
-    writer = csv.writer(csv_file)
-    writer.writerow(['Image Path', 'Location', 'Cluster Label'])
-
-# Process clusters based on DBSCAN results
+# Clustering with the configured method; re-running with a new eps reuses the saved neighbour graph
+encodings = faces.encodings
+graph_path = None
+if EncodingStore.exists(config.encoding_store_path):
+    graph_path = os.path.join(config.encoding_store_path, 'neighbour_graph.npz')
+labels = cluster_faces(encodings, config.clustering_method, eps=config.clustering_eps,
+                       min_samples=config.clustering_min_samples, graph_path=graph_path,
+                       graph_radius=config.neighbour_graph_radius)
+unique_labels = sorted(set(labels) - {-1})  # label -1 marks noise, i.e. unclustered faces
+
+# Prepare the UTF-8 CSV, plus an optional columnar table with encodings, to log face details
+results_sink = open_result_sink(csv_path, config.results_table_format, encoding='utf-8')
+
+# Create a directory for each unique face cluster and number the crops within it
+crop_names = {}
 for label in unique_labels:
-    if label == -1:
-        # Label -1 indicates noise, or unclustered faces
+    utils.check_and_create_dir(os.path.join(sorted_path, f"face_{label}"))
+    for idx, row in enumerate(np.flatnonzero(labels == label)):
+        crop_names[int(row)] = f"face_{label}_{idx}.jpg"
+
+# Write the crops stored with the encodings; faces without one (e.g. from a legacy pickle checkpoint)
+# are cut from their image, which is decoded once for all of its faces, also with non-ASCII paths
+for row, crop in iter_face_crops(faces, list(crop_names), config.face_crop_max_edge):
+    label, image_path, loc = labels[row], faces.image_path(row), faces.location(row)
+    if crop is None:
+        print(f"Warning: Failed to load image {image_path}. Skipping this face.")
         continue
+    utils.write_bytes(os.path.join(sorted_path, f"face_{label}", crop_names[row]), crop)
 
-    # Create a directory for each unique face cluster
-    cluster_dir = os.path.join(sorted_path, f"face_{label}")
-    utils.check_and_create_dir(cluster_dir)
-
-    # Collect encodings for the current cluster to save in a .pkl file
-    cluster_encodings = []
-
-    for idx, item in enumerate([data[i] for i in range(len(data)) if labels[i] == label]):
-        try:
-            # Use load_image() to read images with non-ASCII characters
-            image = load_image(item["imagePath"])
-
-            # Verify that the image was successfully loaded
-            if image is None:
-                print(f"Warning: Failed to load image {item['imagePath']}. Skipping this face.")
-                continue  # Skip this iteration if the image couldn't be loaded
+    # Log the face; rows are buffered and written in bulk
+    results_sink.write(image_path, loc, label, encodings[row])
+results_sink.close()
 
-            # Extract the face region from the image
-            top, right, bottom, left = item["loc"]
-            face_image = image[top:bottom, left:right]
-            cv2.imwrite(os.path.join(cluster_dir, f"face_{label}_{idx}.jpg"), face_image)
-
-            # Add the encoding to the cluster's list of encodings
-            cluster_encodings.append(item["encoding"])
-
-            # Append entry to CSV with UTF-8 encoding
-            with open(csv_path, mode='a', newline='', encoding='utf-8') as csv_file:
-                writer = csv.writer(csv_file)
-                writer.writerow([item["imagePath"], item["loc"], label])
-
-        except Exception as e:
-            print(f"Error processing face for cluster {label} in file {item['imagePath']}: {e}")
-
-    # Save the cluster encodings to a .pkl file
+# Save the encodings of every cluster to a .pkl file
+for label in unique_labels:
     pkl_path = os.path.join(cluster_path, f"face_{label}.pkl")
     with open(pkl_path, "wb") as f:
-        pickle.dump(cluster_encodings, f)
+        pickle.dump(list(np.asarray(encodings[labels == label])), f)
     print(f"Saved cluster encodings to {pkl_path}")
 
+# Rewrite the face catalog, and rebuild the cluster index used by find_cluster_for_new_face from it
+catalog = FaceCatalog(config.face_catalog_path)
+catalog.clear()
+catalog.add_face_table(faces, label_names(labels))
+build_catalog_index(catalog).save(config.cluster_index_path)
+catalog.close()
+
 # Print completion and runtime information
 print("Clustering complete. Face data saved to CSV.")
 formatted_dur = str(timedelta(seconds=(time.time() - tic)))
@@ -25,3 +25,8 @@ def check_and_create_dir(path):
         os.makedirs(path)
     else:
         os.makedirs(path)
+
+
+def write_bytes(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)